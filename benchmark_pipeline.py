@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+"""
+Offline end-to-end benchmark for the served recommendation pipeline.
+
+Replays a fixed, labeled query set (benchmark_queries.jsonl) through
+src.retriever and src.rag_pipeline.get_recommendations with Gemini replaced by the
+fake LLM backend (src.llm_backend.FakeLLMBackend), so runs are repeatable and cost
+nothing. Reports:
+
+- Retrieval quality: recall@k and MAP over the solutions of the retrieved chunks,
+  plus recall@k of the final recommendations (matched to solutions by URL).
+- Latency: p50/p95/p99 per stage (embed, search, prompt, llm) and end to end.
+
+Each run is saved to BENCHMARK_RESULTS_DIR tagged with the current git commit and
+compared against the previous run (or BENCHMARK_BASELINE), flagging regressions.
+Needs the embedding model and the populated vector DB, like the API.
+"""
+
+import csv
+import json
+import logging
+import math
+import os
+import subprocess
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Set
+
+# The benchmark never calls Gemini; select the fake backend before config is validated on import
+os.environ.setdefault("LLM_BACKEND", "fake")
+
+from src import config, llm_backend, prompt_templates, rag_pipeline, retriever
+from src.api import RecommendResponse # /recommend's response schema
+
+# --- Configuration ---
+QUERIES_FILE = Path("benchmark_queries.jsonl") # {"query_id", "query", "relevant_solutions": [...]} per line
+SOLUTIONS_CSV = Path("shl_solutions_merged_final.csv") # Maps recommendation URLs back to solution names
+BENCHMARK_RESULTS_DIR = Path("benchmark_results")
+BENCHMARK_BASELINE = os.getenv("BENCHMARK_BASELINE") # Result file to compare against; defaults to the latest saved run
+WARMUP_RUNS = 1 # Untimed passes over the query set (model/kernels/plan caches)
+MEASURED_RUNS = 5 # Timed passes; latency percentiles are over all of them
+RECALL_K_VALUES = (1, 3, 5, 10)
+MAP_K = 10
+STUB_LLM_LATENCY_SECONDS = float(os.getenv("BENCHMARK_STUB_LLM_LATENCY", "0")) # Simulated LLM latency
+
+# Regression thresholds used when comparing with the baseline
+MAX_QUALITY_DROP = 0.02 # Absolute drop in recall/MAP
+MAX_LATENCY_INCREASE = 0.20 # Relative increase in p95
+
+STAGES = ("embed", "search", "prompt", "llm", "total")
+
+# --- Setup Logging ---
+log = logging.getLogger(__name__)
+
+# --- Stage Timing ---
+class StageTimer:
+    """Collects per-stage durations (ms) for the query currently being replayed."""
+
+    def __init__(self):
+        self.current: Dict[str, float] = {}
+
+    def wrap(self, stage: str, func):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.current[stage] = self.current.get(stage, 0.0) + (time.perf_counter() - start) * 1000
+        return timed
+
+@contextmanager
+def instrumented_pipeline(timer: StageTimer, retrieved: List[List[Dict]]) -> Iterator[None]:
+    """Swaps in the fake LLM backend and stage timers for the duration of the benchmark, then restores them."""
+    def search_and_capture(*args, **kwargs):
+        chunks = original["search_similar_chunks"](*args, **kwargs)
+        retrieved.append(chunks)
+        return chunks
+
+    original = {
+        "generate_embedding": retriever.generate_embedding,
+        "search_similar_chunks": retriever.search_similar_chunks,
+        "get_recommendation_prompt": prompt_templates.get_recommendation_prompt,
+    }
+    backend = llm_backend.FakeLLMBackend(latency_ms=STUB_LLM_LATENCY_SECONDS * 1000, jitter_ms=0, error_rate=0)
+    backend.generate_recommendations = timer.wrap("llm", backend.generate_recommendations)
+    retriever.generate_embedding = timer.wrap("embed", original["generate_embedding"])
+    retriever.search_similar_chunks = timer.wrap("search", search_and_capture)
+    prompt_templates.get_recommendation_prompt = timer.wrap("prompt", original["get_recommendation_prompt"])
+    llm_backend.set_llm_backend(backend)
+    try:
+        yield
+    finally:
+        retriever.generate_embedding = original["generate_embedding"]
+        retriever.search_similar_chunks = original["search_similar_chunks"]
+        prompt_templates.get_recommendation_prompt = original["get_recommendation_prompt"]
+        llm_backend.set_llm_backend(None)
+
+# --- Data Loading ---
+def load_queries(path: Path) -> List[Dict]:
+    queries = []
+    with path.open("r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                queries.append(json.loads(line))
+    log.info(f"Loaded {len(queries)} benchmark queries from {path}.")
+    return queries
+
+def load_url_to_solution(path: Path) -> Dict[str, str]:
+    """Maps normalized detail URLs to solution names."""
+    url_map = {}
+    with path.open("r", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            url = (row.get("Detail URL") or "").strip()
+            if url and url != "N/A":
+                url_map[normalize_url(url)] = row["Solution Name"].strip()
+    return url_map
+
+def normalize_url(url: str) -> str:
+    return url.strip().lower().rstrip("/")
+
+# --- Metrics ---
+def ranked_solutions(chunks: List[Dict]) -> List[str]:
+    """Distinct solution names of retrieved chunks, in rank order."""
+    names, seen = [], set()
+    for chunk in chunks:
+        name = (chunk.get("metadata") or {}).get("solution_name")
+        if name and name not in seen:
+            seen.add(name)
+            names.append(name)
+    return names
+
+def recall_at_k(ranked: List[str], relevant: Set[str], k: int) -> float:
+    return len(set(ranked[:k]) & relevant) / len(relevant) if relevant else 0.0
+
+def average_precision(ranked: List[str], relevant: Set[str], k: int) -> float:
+    hits, score = 0, 0.0
+    for rank, name in enumerate(ranked[:k], start=1):
+        if name in relevant:
+            hits += 1
+            score += hits / rank
+    return score / min(len(relevant), k) if relevant else 0.0
+
+def percentile(values: List[float], pct: float) -> float:
+    """Nearest-rank percentile."""
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]
+
+# --- Benchmark ---
+def run_benchmark(queries: List[Dict], url_to_solution: Dict[str, str]) -> Dict:
+    timer = StageTimer()
+    retrieved: List[List[Dict]] = []
+    latencies: Dict[str, List[float]] = {stage: [] for stage in STAGES}
+    per_query: Dict[str, Dict] = {}
+    failures = 0
+    schema_errors = 0
+
+    with instrumented_pipeline(timer, retrieved):
+        for run in range(WARMUP_RUNS + MEASURED_RUNS):
+            measured = run >= WARMUP_RUNS
+            for item in queries:
+                timer.current = {}
+                retrieved.clear()
+                start = time.perf_counter()
+                result = rag_pipeline.get_recommendations(item["query"])
+                total_ms = (time.perf_counter() - start) * 1000
+                if not measured:
+                    continue
+                if result is None:
+                    failures += 1
+                else:
+                    # What /recommend does with the result; a mismatch there is a 500 for the client
+                    try:
+                        RecommendResponse(**result)
+                    except ValueError as e: # pydantic.ValidationError subclasses ValueError
+                        schema_errors += 1
+                        log.error(f"Result for '{item['query_id']}' does not match RecommendResponse: {e}")
+                for stage in STAGES[:-1]:
+                    if stage in timer.current:
+                        latencies[stage].append(timer.current[stage])
+                latencies["total"].append(total_ms)
+
+                # Quality is deterministic (stubbed LLM), so score the first measured run only
+                if item["query_id"] in per_query:
+                    continue
+                relevant = set(item["relevant_solutions"])
+                retrieved_names = ranked_solutions(retrieved[-1] if retrieved else [])
+                recommended_names = [
+                    url_to_solution.get(normalize_url(rec.get("url") or ""), "")
+                    for rec in (result or {}).get("recommended_assessments", [])
+                ]
+                per_query[item["query_id"]] = {
+                    "retrieved": retrieved_names,
+                    **{f"retrieval_recall@{k}": recall_at_k(retrieved_names, relevant, k) for k in RECALL_K_VALUES},
+                    f"retrieval_ap@{MAP_K}": average_precision(retrieved_names, relevant, MAP_K),
+                    **{f"recommendation_recall@{k}": recall_at_k(recommended_names, relevant, k) for k in RECALL_K_VALUES},
+                }
+
+    quality_keys = [key for key in next(iter(per_query.values())) if key != "retrieved"] if per_query else []
+    quality = {key: sum(q[key] for q in per_query.values()) / len(per_query) for key in quality_keys}
+    quality[f"retrieval_map@{MAP_K}"] = quality.pop(f"retrieval_ap@{MAP_K}", 0.0)
+    latency = {
+        stage: {"p50": percentile(values, 50), "p95": percentile(values, 95), "p99": percentile(values, 99), "count": len(values)}
+        for stage, values in latencies.items() if values
+    }
+    return {"quality": quality, "latency_ms": latency, "failures": failures, "schema_errors": schema_errors, "per_query": per_query}
+
+# --- Results ---
+def get_git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def find_baseline(exclude: Path) -> Optional[Path]:
+    if BENCHMARK_BASELINE:
+        return Path(BENCHMARK_BASELINE)
+    previous = sorted(p for p in BENCHMARK_RESULTS_DIR.glob("*.json") if p != exclude)
+    return previous[-1] if previous else None
+
+def compare_with_baseline(results: Dict, baseline: Dict) -> List[str]:
+    """Logs metric deltas against the baseline. Returns descriptions of regressions."""
+    regressions = []
+    log.info(f"--- Comparison with {baseline.get('commit', '?')} ({baseline.get('run_at', '?')}) ---")
+    for key, value in results["quality"].items():
+        old = baseline.get("quality", {}).get(key)
+        if old is None:
+            continue
+        log.info(f"{key:32s} {old:8.4f} -> {value:8.4f} ({value - old:+.4f})")
+        if old - value > MAX_QUALITY_DROP:
+            regressions.append(f"{key} dropped {old:.4f} -> {value:.4f}")
+    for stage, stats in results["latency_ms"].items():
+        old = baseline.get("latency_ms", {}).get(stage, {}).get("p95")
+        if not old:
+            continue
+        change = stats["p95"] / old - 1
+        log.info(f"{stage + ' p95 (ms)':32s} {old:8.2f} -> {stats['p95']:8.2f} ({change:+.1%})")
+        if change > MAX_LATENCY_INCREASE:
+            regressions.append(f"{stage} p95 rose {old:.2f}ms -> {stats['p95']:.2f}ms ({change:+.1%})")
+    return regressions
+
+def log_report(results: Dict):
+    log.info("--- Retrieval Quality ---")
+    for key, value in results["quality"].items():
+        log.info(f"{key:32s} {value:8.4f}")
+    log.info("--- Latency (ms) ---")
+    log.info(f"{'stage':10s} {'p50':>9s} {'p95':>9s} {'p99':>9s} {'n':>6s}")
+    for stage, stats in results["latency_ms"].items():
+        log.info(f"{stage:10s} {stats['p50']:9.2f} {stats['p95']:9.2f} {stats['p99']:9.2f} {stats['count']:6d}")
+    if results["failures"]:
+        log.warning(f"{results['failures']} pipeline calls returned no result.")
+    if results["schema_errors"]:
+        log.error(f"{results['schema_errors']} results failed RecommendResponse validation (/recommend would return 500).")
+
+# --- Main Execution ---
+def main() -> int:
+    if not config.IS_CONFIG_VALID:
+        log.error("Configuration is invalid (DB settings are needed). Cannot run the benchmark.")
+        return 1
+    queries = [q for q in load_queries(QUERIES_FILE) if not rag_pipeline.is_url(q["query"])]
+    url_to_solution = load_url_to_solution(SOLUTIONS_CSV)
+
+    retriever.import_model_libraries()
+    retriever.load_embedding_model()
+    retriever.init_connection_pool()
+    try:
+        retriever.load_chunk_store()
+        retriever.warm_up_model()
+        results = run_benchmark(queries, url_to_solution)
+    finally:
+        retriever.close_connection_pool()
+
+    results.update({
+        "run_at": datetime.now().isoformat(timespec="seconds"),
+        "commit": get_git_commit(),
+        "embedding_backend": config.EMBEDDING_BACKEND,
+        "top_k_retrieval": config.TOP_K_RETRIEVAL,
+        "num_queries": len(queries),
+        "measured_runs": MEASURED_RUNS,
+        "stub_llm_latency_seconds": STUB_LLM_LATENCY_SECONDS,
+    })
+    log_report(results)
+
+    BENCHMARK_RESULTS_DIR.mkdir(parents=True, exist_ok=True)
+    output_path = BENCHMARK_RESULTS_DIR / f"{datetime.now().strftime('%Y%m%d-%H%M%S')}_{results['commit']}.json"
+    baseline_path = find_baseline(exclude=output_path)
+    with output_path.open("w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    log.info(f"Saved benchmark results to {output_path}.")
+
+    if baseline_path and baseline_path.is_file():
+        with baseline_path.open("r", encoding="utf-8") as f:
+            regressions = compare_with_baseline(results, json.load(f))
+        for regression in regressions:
+            log.warning(f"REGRESSION: {regression}")
+        return 1 if regressions or results["schema_errors"] else 0
+    log.info("No baseline found; this run will serve as the baseline for the next one.")
+    return 1 if results["schema_errors"] else 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
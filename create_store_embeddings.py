@@ -14,13 +14,22 @@ import logging
 import time
 import json
 import os
+import hashlib
+import multiprocessing
+from collections import deque
+import io
+import queue
+import struct
+import threading
 # Remove direct load_dotenv from here, rely on config.py
 # from dotenv import load_dotenv
 import psycopg2
 from psycopg2.extras import execute_batch # For efficient batch insertion
 from pgvector.psycopg2 import register_vector # Import pgvector adapter
 import numpy as np # Needed by pgvector adapter
+from typing import Optional
 from src import config # Import the central config module
+from src.chunk_corpus import iter_chunks # Streaming JSONL reader shared with chunk_data
 
 # --- Configuration ---
 # REMOVED: load_dotenv() - Handled by config.py
@@ -41,9 +50,63 @@ DB_PORT = config.DB_PORT
 print(f"DEBUG: Using DB_PASSWORD from config: '{DB_PASSWORD}' (Type: {type(DB_PASSWORD)})") # Adjusted debug print
 
 # Embedding/Processing Configuration
-BATCH_SIZE = 64 # Process N chunks at a time for encoding and DB insertion
+BATCH_SIZE = 64 # Chunks per encode batch (starting point when AUTOTUNE_BATCH_SIZE is on; upsert page size)
 DEVICE_PREFERENCE = config.DEVICE_PREFERENCE # Use device preference from config
 
+# Incremental Ingestion Configuration
+# Only chunks whose content hash or model version differ from the stored row are re-embedded,
+# and rows whose chunk_id is no longer in the corpus are deleted.
+FORCE_REEMBED = False # Set True to re-embed every chunk regardless of stored hashes
+DELETE_REMOVED_CHUNKS = True # Remove rows for chunk_ids that disappeared from the corpus
+# Records the in-progress run. Each batch commits its rows with their content hash, so an
+# interrupted run resumes by diffing again; the checkpoint reports what was already done.
+CHECKPOINT_FILE = Path("embedding_ingest_checkpoint.json")
+# Optional explicit model version tag; defaults to a fingerprint of the model files
+MODEL_VERSION = os.getenv("EMBEDDING_MODEL_VERSION")
+
+# Bulk Load Configuration
+# "copy": stream rows with binary COPY into a staging table and merge them into shl_embeddings
+#         with one INSERT ... SELECT ... ON CONFLICT per flush (fast for large re-ingests).
+# "upsert": row-wise INSERT ... ON CONFLICT via execute_batch.
+LOAD_METHOD = "copy"
+COPY_FLUSH_ROWS = 5000 # Encoded rows buffered before each COPY + merge (each merge is committed)
+STAGING_TABLE = "shl_embeddings_staging"
+# If enabled and at least this fraction of the table is (re)written, drop the HNSW index first
+# and rebuild it after the load instead of maintaining it row by row. The drop is immediate
+# (autocommit), so the API falls back to sequential scans until the rebuild finishes; leave it
+# off when ingesting into a table that is serving traffic.
+DROP_INDEX_FOR_BULK_LOAD = os.getenv("EMBEDDING_DROP_INDEX_FOR_BULK_LOAD", "false").lower() == "true"
+REBUILD_INDEX_FRACTION = 0.5
+HNSW_INDEX_NAME = "shl_embeddings_hnsw_idx"
+
+# Pipeline Configuration
+# The encoder thread puts encoded batches on a bounded queue; a writer thread with its own
+# DB connection drains it, so encoding and DB writes overlap.
+PIPELINE_QUEUE_BATCHES = 8 # Max encoded batches waiting for the writer (bounds memory)
+AUTOTUNE_BATCH_SIZE = True # Pick the encode batch size with the best measured throughput
+AUTOTUNE_CANDIDATES = [16, 32, 64, 128, 256]
+AUTOTUNE_MIN_GAIN = 0.05 # Stop growing the batch once throughput improves by less than this
+
+# Length-Sorted Batching
+# Chunks range from short core_info blocks to ~1500-character PDF fragments. Encoding them in
+# token-length order keeps each batch's lengths similar, so little compute is spent on padding.
+LENGTH_SORT_BATCHES = True
+# Encodes a sample in file order and in length order before the run and logs the speedup.
+# Off by default: it adds two extra encodes of the sample to every ingestion.
+REPORT_LENGTH_SORT_SPEEDUP = os.getenv("EMBEDDING_REPORT_LENGTH_SORT_SPEEDUP", "false").lower() == "true"
+LENGTH_SORT_BENCHMARK_SAMPLE = 256
+
+# Multi-Process CPU Encoding
+# On CPU, >1 shards batches across this many worker processes, each with its own model copy.
+# Results are merged back in batch order, so output does not depend on worker scheduling.
+CPU_ENCODE_WORKERS = int(os.getenv("EMBEDDING_ENCODE_WORKERS", "1"))
+# Torch intra-op threads per worker; workers * threads should not exceed the physical cores
+TORCH_THREADS_PER_WORKER = int(os.getenv(
+    "EMBEDDING_TORCH_THREADS_PER_WORKER", str(max(1, (os.cpu_count() or 1) // max(CPU_ENCODE_WORKERS, 1)))
+))
+# Batches submitted ahead per worker (bounds memory held by finished-but-unconsumed results)
+ENCODE_POOL_PREFETCH = 2
+
 # --- Setup Logging ---
 logging.basicConfig(
     level=logging.INFO,
@@ -51,30 +114,531 @@ logging.basicConfig(
 )
 log = logging.getLogger(__name__)
 
+# --- Helper Functions for Incremental Ingestion ---
+def derive_chunk_id(metadata: dict, fallback: str) -> str:
+    """Builds a stable chunk ID from solution name, source type and chunk index."""
+    solution_name = metadata.get('solution_name')
+    source_type = metadata.get('source_type')
+    if not solution_name or not source_type:
+        return fallback
+    return f"{solution_name}::{source_type}::{metadata.get('chunk_index', 0)}"
+
+def compute_content_hash(chunk_text: str, metadata: dict) -> str:
+    """SHA-256 of the chunk text and its metadata (key order independent)."""
+    digest = hashlib.sha256()
+    digest.update(chunk_text.encode('utf-8'))
+    digest.update(b'\0')
+    digest.update(json.dumps(metadata, sort_keys=True, ensure_ascii=False).encode('utf-8'))
+    return digest.hexdigest()
+
+def get_model_version(model_path: Path) -> str:
+    """
+    Returns MODEL_VERSION if set, otherwise '<model dir name>@<fingerprint>' where the
+    fingerprint hashes the model's config and weight files, so any retrain changes it.
+    """
+    if MODEL_VERSION:
+        return MODEL_VERSION
+    digest = hashlib.sha256()
+    for file_path in sorted(model_path.rglob('*')):
+        if file_path.is_file() and file_path.suffix in ('.json', '.safetensors', '.bin', '.txt'):
+            digest.update(str(file_path.relative_to(model_path)).encode('utf-8'))
+            with file_path.open('rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(block)
+    return f"{model_path.name}@{digest.hexdigest()[:12]}"
+
+def load_checkpoint(checkpoint_file: Path) -> Optional[dict]:
+    """Loads the run checkpoint if a previous run was interrupted."""
+    if not checkpoint_file.exists():
+        return None
+    try:
+        with checkpoint_file.open('r', encoding='utf-8') as f:
+            return json.load(f)
+    except (json.JSONDecodeError, OSError) as e:
+        log.warning(f"Ignoring unreadable checkpoint {checkpoint_file}: {e}")
+        return None
+
+def save_checkpoint(checkpoint_file: Path, state: dict):
+    """Atomically writes the run checkpoint."""
+    tmp_file = checkpoint_file.with_suffix('.tmp')
+    with tmp_file.open('w', encoding='utf-8') as f:
+        json.dump(state, f)
+    tmp_file.replace(checkpoint_file)
+
+def plan_ingestion(cursor, corpus_data: list[dict], model_version: str) -> tuple[list[dict], list[str]]:
+    """
+    Compares the corpus against stored rows.
+    Returns (items to embed, chunk_ids to delete).
+    """
+    cursor.execute("SELECT chunk_id, content_hash, model_version FROM shl_embeddings;")
+    stored = {row[0]: (row[1], row[2]) for row in cursor.fetchall()}
+    corpus_ids = {item['chunk_id'] for item in corpus_data}
+
+    to_embed = [
+        item for item in corpus_data
+        if FORCE_REEMBED or stored.get(item['chunk_id']) != (item['content_hash'], model_version)
+    ]
+    to_delete = sorted(set(stored) - corpus_ids) if DELETE_REMOVED_CHUNKS else []
+    new_count = sum(1 for item in to_embed if item['chunk_id'] not in stored)
+    log.info(
+        f"Ingestion plan: {len(corpus_data)} corpus chunks, {len(stored)} stored rows. "
+        f"New: {new_count}, changed/re-embed: {len(to_embed) - new_count}, "
+        f"unchanged: {len(corpus_data) - len(to_embed)}, to delete: {len(to_delete)}."
+    )
+    return to_embed, to_delete
+
+# --- Helper Functions for Bulk Loading ---
+COPY_COLUMNS = "chunk_id, chunk_text, metadata, embedding, content_hash, model_version"
+PGCOPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0) # Signature, flags, header extension length
+PGCOPY_TRAILER = struct.pack('!h', -1)
+JSONB_BINARY_VERSION = b'\x01'
+
+def _copy_field(value: Optional[bytes]) -> bytes:
+    """Encodes one binary COPY field (int32 length + bytes; -1 for NULL)."""
+    if value is None:
+        return struct.pack('!i', -1)
+    return struct.pack('!i', len(value)) + value
+
+def encode_vector_binary(embedding: np.ndarray) -> bytes:
+    """pgvector binary format: int16 dimension, int16 unused, big-endian float4 values."""
+    values = np.asarray(embedding, dtype='>f4')
+    return struct.pack('!hh', values.shape[0], 0) + values.tobytes()
+
+def build_copy_buffer(rows: list[tuple]) -> io.BytesIO:
+    """
+    Builds a binary COPY stream for (chunk_id, chunk_text, metadata_json, embedding,
+    content_hash, model_version) rows, matching COPY_COLUMNS.
+    """
+    buffer = io.BytesIO()
+    buffer.write(PGCOPY_HEADER)
+    field_count = struct.pack('!h', 6)
+    for chunk_id, chunk_text, metadata_json, embedding, content_hash, model_version in rows:
+        buffer.write(field_count)
+        buffer.write(_copy_field(chunk_id.encode('utf-8')))
+        buffer.write(_copy_field(chunk_text.encode('utf-8')))
+        buffer.write(_copy_field(JSONB_BINARY_VERSION + metadata_json.encode('utf-8')))
+        buffer.write(_copy_field(encode_vector_binary(embedding)))
+        buffer.write(_copy_field(content_hash.encode('utf-8')))
+        buffer.write(_copy_field(model_version.encode('utf-8')))
+    buffer.write(PGCOPY_TRAILER)
+    buffer.seek(0)
+    return buffer
+
+def create_staging_table(cursor, dimension: int):
+    """Creates the session-local staging table used by the COPY load path."""
+    cursor.execute(f"""
+        CREATE TEMP TABLE IF NOT EXISTS {STAGING_TABLE} (
+            chunk_id TEXT NOT NULL,
+            chunk_text TEXT,
+            metadata JSONB,
+            embedding vector({dimension}),
+            content_hash TEXT,
+            model_version TEXT
+        );
+    """)
+
+def copy_and_merge(cursor, rows: list[tuple]):
+    """Streams rows into the staging table with binary COPY, then merges them into shl_embeddings in one statement."""
+    cursor.execute(f"TRUNCATE {STAGING_TABLE};")
+    cursor.copy_expert(f"COPY {STAGING_TABLE} ({COPY_COLUMNS}) FROM STDIN WITH (FORMAT binary)", build_copy_buffer(rows))
+    cursor.execute(f"""
+        INSERT INTO shl_embeddings ({COPY_COLUMNS}, updated_at)
+        SELECT {COPY_COLUMNS}, now() FROM {STAGING_TABLE}
+        ON CONFLICT (chunk_id) DO UPDATE SET
+            chunk_text = EXCLUDED.chunk_text,
+            metadata = EXCLUDED.metadata,
+            embedding = EXCLUDED.embedding,
+            content_hash = EXCLUDED.content_hash,
+            model_version = EXCLUDED.model_version,
+            updated_at = now();
+    """)
+
+def upsert_rows(cursor, rows: list[tuple]):
+    """Row-wise upsert via execute_batch (LOAD_METHOD = "upsert")."""
+    insert_query = f"""
+        INSERT INTO shl_embeddings ({COPY_COLUMNS}, updated_at)
+        VALUES (%s, %s, %s, %s, %s, %s, now())
+        ON CONFLICT (chunk_id) DO UPDATE SET
+            chunk_text = EXCLUDED.chunk_text,
+            metadata = EXCLUDED.metadata,
+            embedding = EXCLUDED.embedding,
+            content_hash = EXCLUDED.content_hash,
+            model_version = EXCLUDED.model_version,
+            updated_at = now();
+    """
+    execute_batch(cursor, insert_query, rows, page_size=len(rows))
+
+def write_rows(cursor, rows: list[tuple]):
+    """Writes encoded rows with the configured LOAD_METHOD. Autocommit makes each call durable."""
+    if LOAD_METHOD == "copy":
+        copy_and_merge(cursor, rows)
+    else:
+        upsert_rows(cursor, rows)
+
+# --- Ingestion Pipeline ---
+def connect_db():
+    """Opens an autocommit connection with the pgvector adapter registered."""
+    conn = psycopg2.connect(
+        dbname=config.DB_NAME,
+        user=config.DB_USER,
+        password=config.DB_PASSWORD,
+        host=config.DB_HOST,
+        port=config.DB_PORT
+    )
+    conn.autocommit = True # Each write is durable on its own; resume relies on this
+    # *** Crucial: Register the pgvector adapter ***
+    # Needs to be registered *after* connection is established
+    register_vector(conn)
+    return conn
+
+def is_out_of_memory(error: Exception) -> bool:
+    """True for CUDA/MPS out-of-memory errors raised by model.encode."""
+    return isinstance(error, RuntimeError) and "out of memory" in str(error).lower()
+
+def autotune_batch_size(model, device, items: list[dict]) -> int:
+    """
+    Encodes a sample with growing batch sizes and returns the one with the best
+    chunks/sec. Stops at the first OOM or when the gain drops below AUTOTUNE_MIN_GAIN.
+    """
+    sample_texts = [item['chunk_text'] for item in items[:max(AUTOTUNE_CANDIDATES)]]
+    if not AUTOTUNE_BATCH_SIZE or len(sample_texts) < max(AUTOTUNE_CANDIDATES):
+        return BATCH_SIZE
+    model.encode(sample_texts[:AUTOTUNE_CANDIDATES[0]], show_progress_bar=False, device=device.type) # Warm-up
+    best_size, best_rate = BATCH_SIZE, 0.0
+    for batch_size in AUTOTUNE_CANDIDATES:
+        try:
+            start_time = time.perf_counter()
+            model.encode(sample_texts, batch_size=batch_size, show_progress_bar=False, device=device.type)
+            rate = len(sample_texts) / (time.perf_counter() - start_time)
+        except RuntimeError as e:
+            if not is_out_of_memory(e):
+                raise
+            log.info(f"Batch size autotune: {batch_size} ran out of memory.")
+            if device.type == "cuda":
+                torch.cuda.empty_cache()
+            break
+        log.info(f"Batch size autotune: {batch_size} -> {rate:.1f} chunks/sec")
+        if best_rate and rate < best_rate * (1 + AUTOTUNE_MIN_GAIN):
+            if rate > best_rate:
+                best_size, best_rate = batch_size, rate
+            break
+        best_size, best_rate = batch_size, rate
+    log.info(f"Using encode batch size {best_size} ({best_rate:.1f} chunks/sec on sample).")
+    return best_size
+
+def get_token_lengths(model, texts: list[str]) -> list[int]:
+    """Token count per text (including special tokens), capped at the model's max_seq_length."""
+    encoded = model.tokenizer(texts, add_special_tokens=True, truncation=False)['input_ids']
+    return [min(len(ids), model.max_seq_length) for ids in encoded]
+
+def length_sorted_order(lengths: list[int]) -> list[int]:
+    """Indices ordered longest first (stable), so the largest batches hit memory limits early."""
+    return sorted(range(len(lengths)), key=lambda i: -lengths[i])
+
+def padding_efficiency(lengths: list[int], batch_size: int) -> float:
+    """Fraction of encoded token positions that are real tokens when batching in the given order."""
+    real_tokens = sum(lengths)
+    padded_tokens = sum(
+        max(lengths[i : i + batch_size]) * len(lengths[i : i + batch_size])
+        for i in range(0, len(lengths), batch_size)
+    )
+    return real_tokens / padded_tokens if padded_tokens else 1.0
+
+def encode_in_order(model, device, texts: list[str], batch_size: int, order: Optional[list[int]] = None) -> np.ndarray:
+    """
+    Encodes texts in batches taken in `order` (default: as given) and returns the
+    embeddings in the original text order.
+    """
+    order = order if order is not None else list(range(len(texts)))
+    embeddings = np.empty((len(texts), model.get_sentence_embedding_dimension()), dtype=np.float32)
+    for i in range(0, len(order), batch_size):
+        batch_indices = order[i : i + batch_size]
+        embeddings[batch_indices] = model.encode(
+            [texts[j] for j in batch_indices],
+            batch_size=batch_size,
+            convert_to_numpy=True,
+            show_progress_bar=False,
+            device=device.type
+        )
+    return embeddings
+
+def benchmark_length_sorting(model, device, items: list[dict], batch_size: int):
+    """Times encoding a corpus sample in file order vs token-length order and checks both give the same vectors."""
+    sample = items[:LENGTH_SORT_BENCHMARK_SAMPLE]
+    texts = [item['chunk_text'] for item in sample]
+    lengths = [item['token_length'] for item in sample]
+    sorted_order = length_sorted_order(lengths)
+    model.encode(texts[:batch_size], show_progress_bar=False, device=device.type) # Warm-up
+
+    start_time = time.perf_counter()
+    file_order_emb = encode_in_order(model, device, texts, batch_size)
+    file_order_seconds = time.perf_counter() - start_time
+    start_time = time.perf_counter()
+    sorted_emb = encode_in_order(model, device, texts, batch_size, sorted_order)
+    sorted_seconds = time.perf_counter() - start_time
+
+    max_diff = float(np.abs(file_order_emb - sorted_emb).max())
+    log.info(f"--- Length-sorted batching ({len(sample)} chunks, batch size {batch_size}) ---")
+    log.info(
+        f"Padding efficiency: file order {padding_efficiency(lengths, batch_size):.1%}, "
+        f"length order {padding_efficiency([lengths[i] for i in sorted_order], batch_size):.1%}"
+    )
+    log.info(
+        f"Encode time: file order {file_order_seconds:.2f}s, length order {sorted_seconds:.2f}s "
+        f"({file_order_seconds / max(sorted_seconds, 1e-9):.2f}x speedup). Max abs embedding diff: {max_diff:.2e}"
+    )
+
+# Per-process model for the CPU encode pool (set by _init_encode_worker)
+_worker_model = None
+
+def _init_encode_worker(model_path: str, torch_threads: int):
+    """Pool initializer: pins torch threads and loads the model once per worker process."""
+    global _worker_model
+    torch.set_num_threads(torch_threads)
+    torch.set_num_interop_threads(1)
+    _worker_model = SentenceTransformer(model_path, device="cpu")
+
+def _encode_shard(texts: list[str], batch_size: int) -> np.ndarray:
+    """Encodes one batch in a pool worker."""
+    return _worker_model.encode(texts, batch_size=batch_size, convert_to_numpy=True, show_progress_bar=False)
+
+def start_encode_pool(device):
+    """Starts the CPU encode pool when CPU_ENCODE_WORKERS > 1 and encoding runs on CPU, else returns None."""
+    if device.type != "cpu" or CPU_ENCODE_WORKERS <= 1:
+        return None
+    log.info(f"Starting {CPU_ENCODE_WORKERS} encode worker processes ({TORCH_THREADS_PER_WORKER} torch threads each)...")
+    # spawn: forking a process that already holds torch thread pools can deadlock
+    return multiprocessing.get_context("spawn").Pool(
+        processes=CPU_ENCODE_WORKERS,
+        initializer=_init_encode_worker,
+        initargs=(str(MODEL_PATH), TORCH_THREADS_PER_WORKER)
+    )
+
+def iter_encoded_batches(model, device, items: list[dict], batch_size: int, stop_event: threading.Event, encode_pool=None):
+    """
+    Yields (batch_items, embeddings, encode_seconds) in item order.
+
+    Without a pool, batches are encoded in this thread and an OOM halves the batch size.
+    With a pool, up to ENCODE_POOL_PREFETCH batches per worker are in flight and results
+    are consumed in submission order (deterministic merge).
+    """
+    if encode_pool is None:
+        i = 0
+        while i < len(items) and not stop_event.is_set():
+            batch_items = items[i : i + batch_size]
+            encode_start = time.perf_counter()
+            try:
+                batch_embeddings_np = model.encode(
+                    [item['chunk_text'] for item in batch_items],
+                    batch_size=batch_size,
+                    convert_to_numpy=True,
+                    show_progress_bar=False,
+                    device=device.type
+                )
+            except RuntimeError as e:
+                if not is_out_of_memory(e) or batch_size == 1:
+                    raise
+                batch_size //= 2
+                if device.type == "cuda":
+                    torch.cuda.empty_cache()
+                log.warning(f"Out of memory while encoding. Retrying with batch size {batch_size}.")
+                continue
+            yield batch_items, batch_embeddings_np, time.perf_counter() - encode_start
+            i += len(batch_items)
+        return
+
+    in_flight = deque()
+    starts = iter(range(0, len(items), batch_size))
+    max_in_flight = CPU_ENCODE_WORKERS * ENCODE_POOL_PREFETCH
+    while not stop_event.is_set():
+        for start in starts:
+            batch_items = items[start : start + batch_size]
+            in_flight.append((batch_items, encode_pool.apply_async(
+                _encode_shard, ([item['chunk_text'] for item in batch_items], batch_size)
+            )))
+            if len(in_flight) >= max_in_flight:
+                break
+        if not in_flight:
+            return
+        batch_items, result = in_flight.popleft()
+        wait_start = time.perf_counter()
+        batch_embeddings_np = result.get()
+        yield batch_items, batch_embeddings_np, time.perf_counter() - wait_start
+
+def encoder_worker(model, device, items: list[dict], batch_size: int, model_version: str,
+                   out_queue: queue.Queue, stop_event: threading.Event, stats: dict, encode_pool=None):
+    """Encodes items in batches and puts row tuples on out_queue; None marks the end."""
+    try:
+        for batch_items, batch_embeddings_np, encode_seconds in iter_encoded_batches(
+                model, device, items, batch_size, stop_event, encode_pool):
+            stats['encode_seconds'] += encode_seconds
+            rows = [
+                (item['chunk_id'], item['chunk_text'], json.dumps(item.get('metadata', {})),
+                 embedding_np, item['content_hash'], model_version)
+                for item, embedding_np in zip(batch_items, batch_embeddings_np)
+            ]
+            put_start = time.perf_counter()
+            while not stop_event.is_set():
+                try:
+                    out_queue.put(rows, timeout=0.5)
+                    break
+                except queue.Full:
+                    continue
+            stats['encoder_blocked_seconds'] += time.perf_counter() - put_start # Writer-bound time
+            stats['encoded'] += len(rows)
+    finally:
+        # Tell the writer no more batches are coming (unless it already stopped)
+        while not stop_event.is_set():
+            try:
+                out_queue.put(None, timeout=0.5)
+                break
+            except queue.Full:
+                continue
+
+def writer_worker(in_queue: queue.Queue, stop_event: threading.Event, stats: dict,
+                  run_state: dict, total: int):
+    """Drains in_queue on its own connection, writing with write_rows and advancing the checkpoint."""
+    conn = connect_db()
+    cur = conn.cursor()
+    pending_rows = []
+    flush_size = COPY_FLUSH_ROWS if LOAD_METHOD == "copy" else BATCH_SIZE
+
+    def flush_pending():
+        if not pending_rows:
+            return
+        write_start = time.perf_counter()
+        write_rows(cur, pending_rows)
+        stats['write_seconds'] += time.perf_counter() - write_start
+        # The rows (with their content hashes) are committed before the checkpoint records them
+        stats['written'] += len(pending_rows)
+        run_state['embedded'] += len(pending_rows)
+        save_checkpoint(CHECKPOINT_FILE, run_state)
+        log.info(f"Stored {len(pending_rows)} rows via {LOAD_METHOD}. Total items: {stats['written']}/{total}")
+        pending_rows.clear()
+
+    try:
+        if LOAD_METHOD == "copy":
+            create_staging_table(cur, EMBEDDING_DIMENSION)
+        while True:
+            get_start = time.perf_counter()
+            rows = in_queue.get()
+            stats['writer_idle_seconds'] += time.perf_counter() - get_start # Encoder-bound time
+            if rows is None:
+                break
+            pending_rows.extend(rows)
+            if len(pending_rows) >= flush_size:
+                flush_pending()
+        flush_pending()
+    finally:
+        cur.close()
+        conn.close()
+
+def run_ingestion_pipeline(model, device, items: list[dict], model_version: str, run_state: dict) -> dict:
+    """
+    Runs the encoder and writer threads over items and returns throughput stats.
+    Raises the first error from either thread after both have stopped.
+    """
+    if LENGTH_SORT_BATCHES:
+        lengths = get_token_lengths(model, [item['chunk_text'] for item in items])
+        for item, length in zip(items, lengths):
+            item['token_length'] = length
+        file_order_efficiency = padding_efficiency(lengths, BATCH_SIZE)
+        # Rows are keyed by chunk_id, so the write order does not need restoring
+        items = [items[i] for i in length_sorted_order(lengths)]
+        log.info(
+            f"Length-sorted {len(items)} chunks (tokens: min {min(lengths)}, max {max(lengths)}). Padding efficiency at "
+            f"batch size {BATCH_SIZE}: {file_order_efficiency:.1%} -> {padding_efficiency([item['token_length'] for item in items], BATCH_SIZE):.1%}"
+        )
+    encode_pool = start_encode_pool(device)
+    # Autotune measures the in-process model, which doesn't reflect per-worker thread counts
+    batch_size = autotune_batch_size(model, device, items) if encode_pool is None else BATCH_SIZE
+    if LENGTH_SORT_BATCHES and REPORT_LENGTH_SORT_SPEEDUP and len(items) >= LENGTH_SORT_BENCHMARK_SAMPLE:
+        # Benchmark on a file-order sample so both orders see the real length mix
+        benchmark_length_sorting(model, device, sorted(items, key=lambda item: item['file_position']), batch_size)
+    work_queue: queue.Queue = queue.Queue(maxsize=PIPELINE_QUEUE_BATCHES)
+    stop_event = threading.Event()
+    errors: list[Exception] = []
+    stats = {
+        'encoded': 0, 'written': 0, 'batch_size': batch_size,
+        'encode_seconds': 0.0, 'write_seconds': 0.0,
+        'encoder_blocked_seconds': 0.0, 'writer_idle_seconds': 0.0,
+    }
+
+    def run_guarded(target, *args):
+        try:
+            target(*args)
+        except Exception as e:
+            errors.append(e)
+            stop_event.set()
+
+    threads = [
+        threading.Thread(target=run_guarded, name="embedding-encoder",
+                         args=(encoder_worker, model, device, items, batch_size, model_version, work_queue, stop_event, stats, encode_pool)),
+        threading.Thread(target=run_guarded, name="embedding-writer",
+                         args=(writer_worker, work_queue, stop_event, stats, run_state, len(items))),
+    ]
+    start_time = time.perf_counter()
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        if encode_pool is not None:
+            if errors:
+                encode_pool.terminate()
+            else:
+                encode_pool.close()
+            encode_pool.join()
+    stats['elapsed_seconds'] = time.perf_counter() - start_time
+    if errors:
+        raise errors[0]
+
+    elapsed = max(stats['elapsed_seconds'], 1e-9)
+    log.info(
+        f"Pipeline throughput: {stats['written'] / elapsed:.1f} chunks/sec overall "
+        f"({stats['written']} chunks in {elapsed:.2f}s, batch size {batch_size}, "
+        f"{CPU_ENCODE_WORKERS if encode_pool is not None else 1} encode process(es)). "
+        f"Encode: {stats['encoded'] / max(stats['encode_seconds'], 1e-9):.1f} chunks/sec, "
+        f"write: {stats['written'] / max(stats['write_seconds'], 1e-9):.1f} chunks/sec."
+    )
+    log.info(
+        f"Encoder waited {stats['encoder_blocked_seconds']:.2f}s on a full queue (writer-bound); "
+        f"writer waited {stats['writer_idle_seconds']:.2f}s on an empty queue (encoder-bound)."
+    )
+    return stats
+
 # --- Helper Function to Load Corpus ---
 def load_corpus_data(corpus_file: Path) -> list[dict]:
-    """Loads data from the JSON Lines corpus file."""
+    """
+    Loads data from the JSON Lines corpus file (streamed via src.chunk_corpus).
+    The full list is kept because ingestion diffs it against the table and sorts it by length.
+    """
     data = []
+    seen_ids: dict[str, int] = {} # Disambiguates duplicate derived IDs
+    read_stats: dict[str, int] = {}
     log.info(f"Loading corpus from {corpus_file}...")
     try:
-        with corpus_file.open('r', encoding='utf-8') as f:
-            for i, line in enumerate(f):
-                try:
-                    item = json.loads(line)
-                    # Ensure essential keys exist
-                    if 'chunk_text' in item and item['chunk_text'].strip():
-                         # Assign a default chunk_id if missing, ensuring uniqueness might require more robust logic
-                         # Using metadata['solution_name'] + index or similar might be better if IDs aren't reliable
-                         default_id = f"item_{i}"
-                         item['chunk_id'] = item.get('metadata', {}).get('chunk_id', default_id)
-                         # Ensure metadata exists
-                         item['metadata'] = item.get('metadata', {})
-                         data.append(item)
-                    else:
-                         log.warning(f"Skipping line {i+1}: Missing or empty 'chunk_text'.")
-                except json.JSONDecodeError:
-                    log.warning(f"Skipping invalid JSON on line {i+1}: {line.strip()}")
-        log.info(f"Loaded {len(data)} valid items from corpus.")
+        for i, item in enumerate(iter_chunks(corpus_file, read_stats)):
+            # Ensure essential keys exist
+            if not (isinstance(item.get('chunk_text'), str) and item['chunk_text'].strip()):
+                log.warning(f"Skipping record {i+1}: Missing or empty 'chunk_text'.")
+                continue
+            # Ensure metadata exists
+            item['metadata'] = item.get('metadata') or {}
+            # Prefer an explicit chunk_id; otherwise derive one from the chunk's identity
+            # (not its line number) so inserting a chunk doesn't shift every later ID.
+            chunk_id = item['metadata'].get('chunk_id') or derive_chunk_id(item['metadata'], f"item_{i}")
+            if chunk_id in seen_ids:
+                seen_ids[chunk_id] += 1
+                chunk_id = f"{chunk_id}#{seen_ids[chunk_id]}"
+            else:
+                seen_ids[chunk_id] = 0
+            item['chunk_id'] = chunk_id
+            item['content_hash'] = compute_content_hash(item['chunk_text'], item['metadata'])
+            item['file_position'] = len(data)
+            data.append(item)
+        log.info(f"Loaded {len(data)} valid items from corpus ({read_stats['lines_read']} lines, {read_stats['invalid_json']} invalid).")
         return data
     except FileNotFoundError:
         log.error(f"Corpus file not found: {corpus_file}")
@@ -100,6 +664,12 @@ def create_table_if_not_exists(cursor, dimension: int):
         COMMENT ON COLUMN shl_embeddings.chunk_id IS 'Unique identifier linking back to the source document chunk.';
         COMMENT ON COLUMN shl_embeddings.metadata IS 'Metadata associated with the chunk (e.g., solution name, source type).';
         COMMENT ON COLUMN shl_embeddings.embedding IS '{dimension}-dimensional vector embedding from fine-tuned model.';
+        -- Incremental ingestion bookkeeping (added to existing tables too)
+        ALTER TABLE shl_embeddings ADD COLUMN IF NOT EXISTS content_hash TEXT;
+        ALTER TABLE shl_embeddings ADD COLUMN IF NOT EXISTS model_version TEXT;
+        ALTER TABLE shl_embeddings ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ DEFAULT now();
+        COMMENT ON COLUMN shl_embeddings.content_hash IS 'SHA-256 of chunk text + metadata; unchanged chunks are not re-embedded.';
+        COMMENT ON COLUMN shl_embeddings.model_version IS 'Embedding model version that produced this row.';
         """
         cursor.execute(create_table_query)
         # No commit needed here if autocommit is True
@@ -109,6 +679,47 @@ def create_table_if_not_exists(cursor, dimension: int):
         raise # Re-raise the error to be caught by the main loop
 
 # --- Main Function ---
+def create_hnsw_index(cursor):
+    """Creates the HNSW index if it doesn't exist (CONCURRENTLY, so reads and writes aren't blocked)."""
+    log.info("Optionally creating HNSW index on embeddings (if it doesn't exist)...")
+    index_query = f"""
+    CREATE INDEX CONCURRENTLY IF NOT EXISTS {HNSW_INDEX_NAME}
+    ON shl_embeddings
+    USING hnsw (embedding vector_cosine_ops);
+    """
+    try:
+         # Setting maintenance_work_mem might require superuser privileges
+         # and might not be necessary if default is sufficient.
+         # Consider removing if it causes issues or isn't needed.
+         # cursor.execute("SET maintenance_work_mem = '2GB';") # Optional
+         index_start_time = time.time()
+         cursor.execute(index_query)
+         # No explicit commit needed here because autocommit is True
+         log.info(f"HNSW index checked/created successfully in {time.time() - index_start_time:.2f} seconds.")
+    except psycopg2.Error as e:
+         # No explicit rollback needed because autocommit is True
+         if "already exists" in str(e):
+             log.info(f"Index '{HNSW_INDEX_NAME}' already exists.")
+         # This error shouldn't happen now with autocommit=True
+         elif "cannot run inside a transaction block" in str(e):
+             log.warning(f"Index creation failed unexpectedly: {e}. Autocommit might not be working as expected.")
+         else:
+             log.warning(f"Could not create index (it might exist or another error occurred): {e}")
+
+def restore_dropped_index():
+    """Rebuilds the HNSW index on a fresh connection after a run that dropped it failed."""
+    log.warning(f"Run ended before {HNSW_INDEX_NAME} was rebuilt. Rebuilding it now...")
+    try:
+        conn = connect_db()
+    except psycopg2.Error as e:
+        log.error(f"Could not reconnect to rebuild {HNSW_INDEX_NAME}; create it manually or rerun the script: {e}")
+        return
+    try:
+        with conn.cursor() as cur:
+            create_hnsw_index(cur)
+    finally:
+        conn.close()
+
 def embed_and_store():
     """Main function to generate and store embeddings."""
 
@@ -146,6 +757,8 @@ def embed_and_store():
     except Exception as e:
         log.error(f"Failed to load model: {e}", exc_info=True)
         return
+    model_version = get_model_version(MODEL_PATH)
+    log.info(f"Embedding model version: {model_version}")
 
     # --- Load Corpus Data ---
     corpus_data = load_corpus_data(CORPUS_FILE)
@@ -156,104 +769,69 @@ def embed_and_store():
     # --- Database Connection and Operations ---
     conn = None
     cur = None
+    index_dropped = False
     try:
         # Explicitly use variables from the imported config module here
         log.info(f"Connecting to PostgreSQL database '{config.DB_NAME}' on {config.DB_HOST}:{config.DB_PORT}...")
-        conn = psycopg2.connect(
-            dbname=config.DB_NAME,
-            user=config.DB_USER,
-            password=config.DB_PASSWORD,
-            host=config.DB_HOST,
-            port=config.DB_PORT
-        )
-        conn.autocommit = True # Explicitly set autocommit mode
+        conn = connect_db()
         cur = conn.cursor()
-        log.info("Database connection successful.")
-
-        # *** Crucial: Register the pgvector adapter ***
-        # Needs to be registered *after* connection is established
-        register_vector(conn)
-        log.info("pgvector adapter registered with psycopg2 connection.")
+        log.info("Database connection successful (pgvector adapter registered).")
 
         # --- Create Table If Needed ---
         create_table_if_not_exists(cur, EMBEDDING_DIMENSION)
 
-        # --- Prepare for Batch Insertion ---
-        # Upsert: Insert or update if chunk_id already exists
-        insert_query = """
-            INSERT INTO shl_embeddings (chunk_id, chunk_text, metadata, embedding)
-            VALUES (%s, %s, %s, %s)
-            ON CONFLICT (chunk_id) DO UPDATE SET
-                chunk_text = EXCLUDED.chunk_text,
-                metadata = EXCLUDED.metadata,
-                embedding = EXCLUDED.embedding;
-        """
-        total_processed = 0
-        start_time_embedding = time.time()
-
-        # --- Iterate, Encode, and Insert Batches ---
-        log.info(f"Starting embedding generation and storage (Batch Size: {BATCH_SIZE})...")
-        data_to_insert_batch = []
-        for i in range(0, len(corpus_data), BATCH_SIZE):
-            batch_items = corpus_data[i : i + BATCH_SIZE]
-            batch_texts = [item['chunk_text'] for item in batch_items]
-
-            if not batch_texts: continue # Skip empty batches if any
-
-            # Generate embeddings for the batch
-            batch_embeddings_np = model.encode(
-                batch_texts,
-                convert_to_numpy=True,
-                show_progress_bar=False,
-                device=device.type
+        # --- Diff Corpus Against Stored Rows ---
+        to_embed, to_delete = plan_ingestion(cur, corpus_data, model_version)
+        corpus_fingerprint = hashlib.sha256(
+            "".join(f"{item['chunk_id']}:{item['content_hash']}\n" for item in corpus_data).encode('utf-8')
+        ).hexdigest()
+        checkpoint = load_checkpoint(CHECKPOINT_FILE)
+        resuming = bool(checkpoint) and checkpoint.get('corpus_fingerprint') == corpus_fingerprint \
+            and checkpoint.get('model_version') == model_version
+        if resuming:
+            log.info(
+                f"Resuming interrupted run started at {checkpoint.get('started_at')}: "
+                f"{checkpoint.get('embedded', 0)} chunks were already committed; {len(to_embed)} remain."
             )
+        elif checkpoint:
+            log.info("Found checkpoint from a run over a different corpus or model. Starting a new run.")
+        run_state = {
+            'corpus_fingerprint': corpus_fingerprint,
+            'model_version': model_version,
+            'started_at': checkpoint['started_at'] if resuming else time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'embedded': checkpoint.get('embedded', 0) if resuming else 0,
+        }
+        save_checkpoint(CHECKPOINT_FILE, run_state)
 
-            # Prepare data tuples for current batch insertion
-            current_batch_data = []
-            for item, embedding_np in zip(batch_items, batch_embeddings_np):
-                metadata_json = json.dumps(item.get('metadata', {}))
-                current_batch_data.append((
-                    item['chunk_id'],
-                    item['chunk_text'],
-                    metadata_json,
-                    embedding_np # Pass the numpy array directly
-                ))
-
-            # Insert the current batch
-            if current_batch_data:
-                execute_batch(cur, insert_query, current_batch_data, page_size=len(current_batch_data))
-                # No explicit commit needed here because autocommit is True
-                total_processed += len(current_batch_data)
-                log.info(f"Processed and inserted batch {i//BATCH_SIZE + 1}. Total items: {total_processed}/{len(corpus_data)}")
-
-        end_time_embedding = time.time()
-        log.info(f"Successfully processed and stored {total_processed} embeddings in {end_time_embedding - start_time_embedding:.2f} seconds.")
+        if not to_embed and not to_delete:
+            log.info("Embeddings are up to date. Nothing to ingest.")
 
-        # --- Optional: Create Index After Insertion (if not already done) ---
-        log.info("Optionally creating HNSW index on embeddings (if it doesn't exist)...")
-        index_query = f"""
-        CREATE INDEX CONCURRENTLY IF NOT EXISTS shl_embeddings_hnsw_idx
-        ON shl_embeddings
-        USING hnsw (embedding vector_cosine_ops);
-        """
-        try:
-             # Setting maintenance_work_mem might require superuser privileges
-             # and might not be necessary if default is sufficient.
-             # Consider removing if it causes issues or isn't needed.
-             # cur.execute("SET maintenance_work_mem = '2GB';") # Optional
-             cur.execute(index_query)
-             # No explicit commit needed here because autocommit is True
-             log.info("HNSW index checked/created successfully.")
-        except psycopg2.Error as e:
-             # No explicit rollback needed because autocommit is True
-             if "already exists" in str(e):
-                 log.info("Index 'shl_embeddings_hnsw_idx' already exists.")
-             # This error shouldn't happen now with autocommit=True
-             elif "cannot run inside a transaction block" in str(e):
-                 log.warning(f"Index creation failed unexpectedly: {e}. Autocommit might not be working as expected.")
-             else:
-                 log.warning(f"Could not create index (it might exist or another error occurred): {e}")
+        # --- Prepare for Loading ---
+        cur.execute("SELECT count(*) FROM shl_embeddings;")
+        stored_count = cur.fetchone()[0]
+        if DROP_INDEX_FOR_BULK_LOAD and to_embed and len(to_embed) >= REBUILD_INDEX_FRACTION * max(stored_count, 1):
+            # Maintaining an HNSW graph row by row is far slower than building it once after the load
+            log.info(f"Rewriting {len(to_embed)} of {stored_count} rows: dropping {HNSW_INDEX_NAME} until the load finishes.")
+            cur.execute(f"DROP INDEX IF EXISTS {HNSW_INDEX_NAME};")
+            index_dropped = True
+
+        # --- Encode and Load (only new/changed chunks) ---
+        if to_embed:
+            log.info(f"Starting embedding generation and storage for {len(to_embed)} chunks (Load Method: {LOAD_METHOD})...")
+            stats = run_ingestion_pipeline(model, device, to_embed, model_version, run_state)
+            log.info(f"Successfully processed and stored {stats['written']} embeddings in {stats['elapsed_seconds']:.2f} seconds.")
+
+        # --- Remove Chunks No Longer in the Corpus ---
+        if to_delete:
+            cur.execute("DELETE FROM shl_embeddings WHERE chunk_id = ANY(%s);", (to_delete,))
+            log.info(f"Deleted {cur.rowcount} rows for chunks no longer in the corpus.")
 
+        # Run finished: drop the checkpoint so the next run starts fresh
+        CHECKPOINT_FILE.unlink(missing_ok=True)
+
+        # --- Optional: Create Index After Insertion (if not already done) ---
+        create_hnsw_index(cur)
+        index_dropped = False
 
     except psycopg2.OperationalError as e:
         log.error(f"Database connection failed: {e}")
@@ -270,6 +848,9 @@ def embed_and_store():
         if conn:
             conn.close()
             log.info("Database connection closed.")
+        # Don't leave the API on sequential scans if the run failed after dropping the index
+        if index_dropped:
+            restore_dropped_index()
 
 # --- Run the Script ---
 if __name__ == "__main__":
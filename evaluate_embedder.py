@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+"""
+Scores saved Sentence Transformer models offline against the fine-tuning validation set.
+
+For every model directory (the final model and each training checkpoint by default),
+the corpus is encoded once and cached on disk, keyed by the model files and the corpus
+contents, so re-scoring a model only encodes the validation queries. MRR@k, NDCG@k,
+Recall@k and Accuracy@k are computed with vectorized NumPy top-k over the full
+query x corpus similarity matrix instead of InformationRetrievalEvaluator's per-query loops.
+
+Set EVAL_MODEL_DIRS (comma-separated paths) to score specific model directories.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple
+
+import numpy as np
+import torch
+from sentence_transformers import SentenceTransformer
+
+from finetune_embedder import (
+    CHECKPOINT_SAVE_DIR,
+    OUTPUT_MODEL_DIR,
+    PROCESSED_CHUNKS_FILE,
+    VALIDATION_TRIPLETS_FILE,
+    create_ir_eval_data,
+    load_corpus,
+    load_triplets,
+)
+
+# --- Configuration ---
+# Models to score. Defaults to the final fine-tuned model plus every checkpoint under CHECKPOINT_SAVE_DIR.
+EVAL_MODEL_DIRS = [Path(p.strip()) for p in os.getenv("EVAL_MODEL_DIRS", "").split(",") if p.strip()]
+EMBEDDING_CACHE_DIR = Path("eval_embedding_cache") # One .npy of corpus embeddings per (model, corpus)
+RESULTS_FILE = Path("embedder_eval_results.jsonl") # Appended to on every run for comparison over time
+
+METRIC_K_VALUES = (1, 3, 5, 10) # Cutoffs for Accuracy@k / Recall@k
+RANKING_K = 10 # Cutoff for MRR@k / NDCG@k
+ENCODE_BATCH_SIZE = 64
+QUERY_BLOCK_SIZE = 1024 # Queries scored per matrix product; bounds the (block x corpus) score matrix
+
+# --- Setup Logging ---
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(module)s - %(message)s'
+)
+log = logging.getLogger(__name__)
+
+# --- Model Discovery ---
+def checkpoint_step(checkpoint_dir: Path) -> Optional[int]:
+    """Global step from a checkpoint directory name ("checkpoint-500", or "500" from older fit()), else None."""
+    match = re.fullmatch(r"(?:checkpoint-)?(\d+)", checkpoint_dir.name)
+    return int(match.group(1)) if match else None
+
+def resolve_model_dirs() -> List[Path]:
+    """Returns the model directories to score (EVAL_MODEL_DIRS, or the final model plus checkpoints)."""
+    if EVAL_MODEL_DIRS:
+        candidates = EVAL_MODEL_DIRS
+    else:
+        candidates = [OUTPUT_MODEL_DIR]
+        if CHECKPOINT_SAVE_DIR.is_dir():
+            # Checkpoints are named by global step; sort by step so the table reads in training order
+            checkpoints = [p for p in CHECKPOINT_SAVE_DIR.iterdir() if p.is_dir() and checkpoint_step(p) is not None]
+            candidates += sorted(checkpoints, key=checkpoint_step)
+    model_dirs = [p for p in candidates if (p / "modules.json").is_file() or (p / "config.json").is_file()]
+    for skipped in set(candidates) - set(model_dirs):
+        log.warning(f"Skipping {skipped}: not a saved Sentence Transformer model directory.")
+    return model_dirs
+
+def get_device() -> str:
+    if torch.cuda.is_available():
+        return "cuda"
+    if torch.backends.mps.is_available() and torch.backends.mps.is_built():
+        return "mps"
+    return "cpu"
+
+# --- Cache Keys ---
+def model_fingerprint(model_dir: Path) -> str:
+    """Hashes relative path, size and mtime of every file in a model dir (cheap; detects re-saved weights)."""
+    digest = hashlib.sha256()
+    for path in sorted(p for p in model_dir.rglob("*") if p.is_file()):
+        stat = path.stat()
+        digest.update(f"{path.relative_to(model_dir)}:{stat.st_size}:{stat.st_mtime_ns}\n".encode("utf-8"))
+    return digest.hexdigest()
+
+def corpus_fingerprint(doc_texts: List[str]) -> str:
+    digest = hashlib.sha256()
+    for text in doc_texts:
+        digest.update(text.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+# --- Evaluation Set ---
+def build_eval_set(validation_triplets: List[List[str]], corpus: Dict[str, str]) -> Optional[Tuple[List[str], List[str], List[Set[int]]]]:
+    """
+    Maps validation triplets onto a de-duplicated corpus.
+
+    Returns (doc_texts, query_texts, relevant) where relevant[i] holds indices into
+    doc_texts for query i. Chunks with identical text are encoded and ranked once.
+    Queries whose positive couldn't be mapped to the corpus are dropped.
+    """
+    eval_data = create_ir_eval_data(validation_triplets, corpus)
+    if not eval_data:
+        return None
+    queries, relevant_docs = eval_data
+
+    doc_texts: List[str] = []
+    text_index: Dict[str, int] = {}
+    doc_index: Dict[str, int] = {}
+    for doc_id, text in corpus.items():
+        if text not in text_index:
+            text_index[text] = len(doc_texts)
+            doc_texts.append(text)
+        doc_index[doc_id] = text_index[text]
+
+    query_texts: List[str] = []
+    relevant: List[Set[int]] = []
+    for query_id, query_text in queries.items():
+        relevant_ids = relevant_docs.get(query_id)
+        if not relevant_ids:
+            continue
+        query_texts.append(query_text)
+        relevant.append({doc_index[doc_id] for doc_id in relevant_ids})
+
+    log.info(f"Evaluation set: {len(query_texts)} queries over {len(doc_texts)} unique corpus documents "
+             f"({len(corpus) - len(doc_texts)} duplicate chunk texts merged).")
+    return doc_texts, query_texts, relevant
+
+# --- Encoding ---
+def encode_corpus_cached(model: SentenceTransformer, model_dir: Path, doc_texts: List[str], corpus_key: str) -> np.ndarray:
+    """Returns L2-normalized float32 corpus embeddings, loading them from EMBEDDING_CACHE_DIR when present."""
+    cache_key = hashlib.sha256(f"{model_fingerprint(model_dir)}:{corpus_key}:{model.max_seq_length}".encode("utf-8")).hexdigest()
+    cache_path = EMBEDDING_CACHE_DIR / f"{cache_key}.npy"
+    if cache_path.is_file():
+        embeddings = np.load(cache_path)
+        if embeddings.shape[0] == len(doc_texts):
+            log.info(f"Loaded cached corpus embeddings for {model_dir} from {cache_path}.")
+            return embeddings
+        log.warning(f"Cached embeddings {cache_path} have the wrong shape {embeddings.shape}. Re-encoding.")
+
+    start_time = time.time()
+    embeddings = model.encode(
+        doc_texts,
+        batch_size=ENCODE_BATCH_SIZE,
+        show_progress_bar=True,
+        convert_to_numpy=True,
+        normalize_embeddings=True,
+    ).astype(np.float32, copy=False)
+    log.info(f"Encoded {len(doc_texts)} corpus documents in {time.time() - start_time:.2f} seconds.")
+
+    EMBEDDING_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    tmp_path = cache_path.with_suffix(".tmp")
+    with tmp_path.open("wb") as f:
+        np.save(f, embeddings)
+    os.replace(tmp_path, cache_path)
+    return embeddings
+
+# --- Metrics ---
+def top_k_indices(query_embeddings: np.ndarray, corpus_embeddings: np.ndarray, k: int) -> np.ndarray:
+    """Returns (num_queries, k) corpus indices ranked by descending cosine similarity."""
+    k = min(k, corpus_embeddings.shape[0])
+    results = np.empty((query_embeddings.shape[0], k), dtype=np.int64)
+    for start in range(0, query_embeddings.shape[0], QUERY_BLOCK_SIZE):
+        scores = query_embeddings[start:start + QUERY_BLOCK_SIZE] @ corpus_embeddings.T
+        candidates = np.argpartition(-scores, k - 1, axis=1)[:, :k] # Unordered top-k in O(corpus)
+        candidate_scores = np.take_along_axis(scores, candidates, axis=1)
+        order = np.argsort(-candidate_scores, axis=1)
+        results[start:start + QUERY_BLOCK_SIZE] = np.take_along_axis(candidates, order, axis=1)
+    return results
+
+def compute_metrics(ranked: np.ndarray, relevant: List[Set[int]], num_docs: int) -> Dict[str, float]:
+    """Computes Accuracy@k, Recall@k, MRR@RANKING_K and NDCG@RANKING_K from ranked corpus indices."""
+    num_queries, depth = ranked.shape
+    # Encode (query, doc) pairs as single integers so relevance lookup is one np.isin call
+    relevant_keys = np.fromiter((q * num_docs + d for q, docs in enumerate(relevant) for d in docs), dtype=np.int64)
+    hits = np.isin(ranked + (np.arange(num_queries, dtype=np.int64) * num_docs)[:, None], relevant_keys)
+    num_relevant = np.array([len(docs) for docs in relevant], dtype=np.float64)
+
+    metrics: Dict[str, float] = {}
+    for k in METRIC_K_VALUES:
+        k_hits = hits[:, :min(k, depth)]
+        metrics[f"accuracy@{k}"] = float(k_hits.any(axis=1).mean())
+        metrics[f"recall@{k}"] = float((k_hits.sum(axis=1) / num_relevant).mean())
+
+    k = min(RANKING_K, depth)
+    k_hits = hits[:, :k]
+    first_hit = k_hits.argmax(axis=1)
+    metrics[f"mrr@{RANKING_K}"] = float(np.where(k_hits.any(axis=1), 1.0 / (first_hit + 1), 0.0).mean())
+    discounts = 1.0 / np.log2(np.arange(2, k + 2))
+    dcg = (k_hits * discounts).sum(axis=1)
+    ideal_dcg = np.cumsum(discounts)[np.minimum(num_relevant, k).astype(np.int64) - 1]
+    metrics[f"ndcg@{RANKING_K}"] = float((dcg / ideal_dcg).mean())
+    return metrics
+
+def evaluate_model_dir(model_dir: Path, doc_texts: List[str], query_texts: List[str], relevant: List[Set[int]], corpus_key: str, device: str) -> Dict[str, float]:
+    """Scores one saved model directory. Returns the metric dict."""
+    model = SentenceTransformer(str(model_dir), device=device)
+    corpus_embeddings = encode_corpus_cached(model, model_dir, doc_texts, corpus_key)
+
+    start_time = time.time()
+    query_embeddings = model.encode(
+        query_texts,
+        batch_size=ENCODE_BATCH_SIZE,
+        show_progress_bar=False,
+        convert_to_numpy=True,
+        normalize_embeddings=True,
+    ).astype(np.float32, copy=False)
+    ranked = top_k_indices(query_embeddings, corpus_embeddings, max(max(METRIC_K_VALUES), RANKING_K))
+    metrics = compute_metrics(ranked, relevant, len(doc_texts))
+    log.info(f"Scored {len(query_texts)} queries against {model_dir} in {time.time() - start_time:.2f} seconds.")
+    return metrics
+
+# --- Main Execution ---
+def main():
+    validation_triplets = load_triplets(VALIDATION_TRIPLETS_FILE)
+    if not validation_triplets:
+        log.error(f"No validation triplets in {VALIDATION_TRIPLETS_FILE}. Run finetune_embedder.py first to create the split.")
+        return
+    corpus = load_corpus(PROCESSED_CHUNKS_FILE)
+    if not corpus:
+        return
+    eval_set = build_eval_set(validation_triplets, corpus)
+    if not eval_set:
+        return
+    doc_texts, query_texts, relevant = eval_set
+    corpus_key = corpus_fingerprint(doc_texts)
+
+    model_dirs = resolve_model_dirs()
+    if not model_dirs:
+        log.error("No model directories to evaluate.")
+        return
+
+    device = get_device()
+    log.info(f"Evaluating {len(model_dirs)} model(s) on {device}.")
+    results = []
+    for model_dir in model_dirs:
+        try:
+            metrics = evaluate_model_dir(model_dir, doc_texts, query_texts, relevant, corpus_key, device)
+        except Exception as e:
+            log.error(f"Failed to evaluate {model_dir}: {e}", exc_info=True)
+            continue
+        results.append({
+            "evaluated_at": datetime.now().isoformat(timespec="seconds"),
+            "model_dir": str(model_dir),
+            "num_queries": len(query_texts),
+            "num_docs": len(doc_texts),
+            "metrics": metrics,
+        })
+        if device == "cuda":
+            torch.cuda.empty_cache()
+
+    if not results:
+        return
+    with RESULTS_FILE.open("a", encoding="utf-8") as f:
+        for result in results:
+            f.write(json.dumps(result) + "\n")
+    log.info(f"Appended {len(results)} result(s) to {RESULTS_FILE}.")
+
+    # --- Summary ---
+    metric_names = list(results[0]["metrics"])
+    log.info("--- Evaluation Summary ---")
+    log.info(" | ".join(["model".ljust(40)] + [name.rjust(11) for name in metric_names]))
+    for result in results:
+        log.info(" | ".join([result["model_dir"][-40:].ljust(40)] + [f"{result['metrics'][name]:11.4f}" for name in metric_names]))
+    best = max(results, key=lambda r: r["metrics"][f"ndcg@{RANKING_K}"])
+    log.info(f"Best by ndcg@{RANKING_K}: {best['model_dir']} ({best['metrics'][f'ndcg@{RANKING_K}']:.4f})")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+Exports the fine-tuned Sentence Transformer to ONNX for CPU serving.
+
+1. Loads the model from config.MODEL_PATH on CPU.
+2. Exports the transformer (token embeddings) to ONNX with dynamic batch/sequence axes.
+3. Applies dynamic int8 quantization (weights only) with ONNX Runtime.
+4. Runs a parity check: encodes sample sentences with torch and with the
+   ONNX encoder used by the API (src/onnx_encoder.py) and compares them.
+
+Set EMBEDDING_BACKEND=onnx for the API to serve with the quantized model.
+"""
+
+import logging
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+from sentence_transformers import SentenceTransformer
+from onnxruntime.quantization import quantize_dynamic, QuantType
+
+from src import config
+from src.onnx_encoder import OnnxSentenceEncoder
+
+# --- Configuration ---
+MODEL_PATH = config.MODEL_PATH
+OUTPUT_DIR = config.ONNX_MODEL_DIR
+FP32_MODEL_FILE = "model.onnx"
+QUANTIZED_MODEL_FILE = config.ONNX_MODEL_FILE
+ONNX_OPSET = 14
+
+# Parity thresholds (cosine similarity between torch and ONNX embeddings)
+MIN_COSINE_FP32 = 0.9999 # fp32 export should be numerically identical up to float noise
+MIN_COSINE_QUANTIZED = 0.98 # int8 weights lose a little precision
+TIMING_ROUNDS = 20
+
+# Sample texts covering short queries and long, PDF-like chunks
+PARITY_SENTENCES = [
+    "cognitive ability test for graduate roles",
+    "Java developer assessment under 40 minutes",
+    "personality questionnaire for managers",
+    "Solution Name: Verify G+\nDescription: Measures general mental ability for graduate and entry-level positions.\nJob Levels: Graduate, Entry-Level\nAssessment Length (minutes): 36\nTest Type: A",
+    "The Occupational Personality Questionnaire (OPQ32) assesses behavioural styles relevant to workplace performance across 32 dimensions. " * 8,
+]
+
+# --- Setup Logging ---
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(module)s - %(message)s'
+)
+log = logging.getLogger(__name__)
+
+class TokenEmbeddingWrapper(torch.nn.Module):
+    """Wraps the HF transformer so the exported graph returns last_hidden_state only."""
+
+    def __init__(self, auto_model):
+        super().__init__()
+        self.auto_model = auto_model
+
+    def forward(self, input_ids, attention_mask):
+        return self.auto_model(input_ids=input_ids, attention_mask=attention_mask).last_hidden_state
+
+# --- Export ---
+def export_to_onnx(st_model: SentenceTransformer, output_path: Path):
+    """Exports the transformer module of a SentenceTransformer to ONNX."""
+    transformer = st_model[0]
+    wrapper = TokenEmbeddingWrapper(transformer.auto_model).eval()
+    dummy = transformer.tokenizer(
+        ["dummy input for tracing"],
+        return_tensors="pt",
+        padding=True,
+        truncation=True,
+        max_length=st_model.max_seq_length
+    )
+    log.info(f"Exporting ONNX graph (opset {ONNX_OPSET}) to {output_path}...")
+    with torch.no_grad():
+        torch.onnx.export(
+            wrapper,
+            (dummy["input_ids"], dummy["attention_mask"]),
+            str(output_path),
+            input_names=["input_ids", "attention_mask"],
+            output_names=["token_embeddings"],
+            dynamic_axes={
+                "input_ids": {0: "batch", 1: "sequence"},
+                "attention_mask": {0: "batch", 1: "sequence"},
+                "token_embeddings": {0: "batch", 1: "sequence"},
+            },
+            opset_version=ONNX_OPSET,
+            do_constant_folding=True,
+        )
+    log.info(f"Exported fp32 model ({output_path.stat().st_size / 1e6:.1f} MB).")
+
+def quantize_model(fp32_path: Path, quantized_path: Path):
+    """Applies dynamic int8 weight quantization to an ONNX model."""
+    log.info(f"Quantizing {fp32_path.name} -> {quantized_path.name} (dynamic, QInt8)...")
+    quantize_dynamic(
+        model_input=str(fp32_path),
+        model_output=str(quantized_path),
+        weight_type=QuantType.QInt8,
+    )
+    log.info(f"Quantized model size: {quantized_path.stat().st_size / 1e6:.1f} MB.")
+
+# --- Parity Check ---
+def time_encode(encode_fn, text: str) -> float:
+    """Returns mean single-query encode latency in milliseconds."""
+    encode_fn(text) # Warm-up
+    start_time = time.perf_counter()
+    for _ in range(TIMING_ROUNDS):
+        encode_fn(text)
+    return (time.perf_counter() - start_time) * 1000 / TIMING_ROUNDS
+
+def check_parity(st_model: SentenceTransformer, onnx_path: Path, min_cosine: float) -> bool:
+    """Compares normalized torch embeddings against the ONNX encoder's output."""
+    encoder = OnnxSentenceEncoder(MODEL_PATH, onnx_path, intra_op_threads=config.ONNX_INTRA_OP_THREADS)
+    torch_emb = st_model.encode(PARITY_SENTENCES, convert_to_numpy=True, normalize_embeddings=True)
+    onnx_emb = encoder.encode(PARITY_SENTENCES, normalize_embeddings=True)
+    cosines = np.sum(torch_emb * onnx_emb, axis=1)
+
+    torch_ms = time_encode(lambda t: st_model.encode(t, show_progress_bar=False), PARITY_SENTENCES[0])
+    onnx_ms = time_encode(encoder.encode, PARITY_SENTENCES[0])
+
+    passed = bool(cosines.min() >= min_cosine)
+    log.info(f"--- Parity: {onnx_path.name} ---")
+    log.info(f"Cosine vs torch: min={cosines.min():.6f} mean={cosines.mean():.6f} (threshold {min_cosine})")
+    log.info(f"Single-query latency: torch={torch_ms:.1f} ms, onnx={onnx_ms:.1f} ms ({torch_ms / onnx_ms:.2f}x)")
+    log.info(f"Result: {'PASSED' if passed else 'FAILED'}")
+    return passed
+
+# --- Main ---
+def main() -> int:
+    if not MODEL_PATH.exists():
+        log.error(f"Model directory not found at '{MODEL_PATH}'.")
+        return 1
+
+    log.info(f"Loading model from {MODEL_PATH} on CPU...")
+    st_model = SentenceTransformer(str(MODEL_PATH), device="cpu")
+    if st_model.get_sentence_embedding_dimension() != config.EMBEDDING_DIMENSION:
+        log.error(f"Model dimension mismatch! Model reports {st_model.get_sentence_embedding_dimension()} but config expects {config.EMBEDDING_DIMENSION}.")
+        return 1
+
+    OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+    fp32_path = OUTPUT_DIR / FP32_MODEL_FILE
+    quantized_path = OUTPUT_DIR / QUANTIZED_MODEL_FILE
+
+    export_to_onnx(st_model, fp32_path)
+    quantize_model(fp32_path, quantized_path)
+
+    fp32_ok = check_parity(st_model, fp32_path, MIN_COSINE_FP32)
+    quantized_ok = check_parity(st_model, quantized_path, MIN_COSINE_QUANTIZED)
+    if not (fp32_ok and quantized_ok):
+        log.error("Parity check failed. Do not deploy the ONNX backend with this export.")
+        return 1
+
+    log.info(f"ONNX export complete. Set EMBEDDING_BACKEND=onnx to serve {quantized_path}.")
+    return 0
+
+# --- Run the Export ---
+if __name__ == "__main__":
+    sys.exit(main())
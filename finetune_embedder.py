@@ -3,8 +3,10 @@
 Fine-tunes a Sentence Transformer model using triplet data for information retrieval.
 
 Loads pre-generated triplets (anchor, positive, negative) and a corpus of text chunks.
-Trains the model using MultipleNegativesRankingLoss. Includes functionality for
-evaluation during training using InformationRetrievalEvaluator.
+Trains the model using MultipleNegativesRankingLoss (optionally its cached-gradient
+variant for large effective batches, with AMP on CUDA). By default, checkpoints are
+saved during training and scored afterwards with evaluate_embedder.py; evaluation during
+training with InformationRetrievalEvaluator can be enabled via EVALUATION_MODE.
 """
 
 import json
@@ -22,6 +24,8 @@ from sentence_transformers import SentenceTransformer, InputExample, losses, eva
 from sentence_transformers.evaluation import InformationRetrievalEvaluator, SimilarityFunction
 from torch.utils.data import DataLoader
 
+from src.chunk_corpus import iter_chunks # Streaming JSONL reader shared with chunk_data
+
 # --- Configuration ---
 
 # Model Configuration
@@ -34,10 +38,24 @@ INPUT_TRIPLET_FILE = Path("finetuning_triplets_v2_english.jsonl")
 # NOTE: PROCESSED_CHUNKS_FILE is needed for the evaluator's corpus
 PROCESSED_CHUNKS_FILE = Path("processed_shl_chunks.jsonl")
 OUTPUT_MODEL_DIR = Path("shl_finetuned_model_with_eval")
+# The held-out validation triplets are written here so evaluate_embedder.py can score saved models offline
+VALIDATION_TRIPLETS_FILE = Path("finetuning_validation_triplets.jsonl")
 CHECKPOINT_SAVE_DIR = Path("shl_finetuned_checkpoints")
 
 # Training Parameters
-TRAIN_BATCH_SIZE = 4  # Adjust based on GPU/MPS memory (e.g., 4, 8, 16)
+TRAIN_BATCH_SIZE = 4  # Adjust based on GPU/MPS memory (e.g., 4, 8, 16). Used with LOSS_TYPE "mnrl".
+# "mnrl": MultipleNegativesRankingLoss; in-batch negatives are limited by what fits in memory.
+# "cached_mnrl": CachedMultipleNegativesRankingLoss (GradCache). Embeds the batch in mini-batches
+#   without gradients, computes the loss over the full batch, then backpropagates mini-batch by
+#   mini-batch, so batches of hundreds (many more in-batch negatives) fit in the memory of a small one.
+LOSS_TYPE = "cached_mnrl"
+CACHED_TRAIN_BATCH_SIZE = 256 # Effective batch size for "cached_mnrl"
+CACHED_MINI_BATCH_SIZE = 16 # Memory-bound chunk size for "cached_mnrl"; lower it if you hit OOM
+# Mixed precision (fp16 autocast + grad scaling). Only applied on CUDA; MPS/CPU train in fp32.
+USE_AMP = True
+# Quick end-to-end check (e.g. on CPU): train 1 epoch on a small subset and skip evaluation
+DRY_RUN = False
+DRY_RUN_MAX_TRIPLETS = 256
 NUM_EPOCHS = 2        # Start with 1-2 for testing, increase for full training
 LEARNING_RATE = 2e-5
 # Max sequence length for the transformer model.
@@ -48,8 +66,14 @@ MAX_SEQ_LENGTH: Optional[int] = 384 # Example: align with MiniLM's typical usage
 # Evaluation Parameters
 VALIDATION_SPLIT_PERCENTAGE = 0.05 # Use 5% of triplets for validation (min 50 samples)
 MIN_VALIDATION_SAMPLES = 50
-# Evaluate N times per epoch. Set to 0 or None to disable evaluation during training.
+SPLIT_SEED = 42 # Fixed so the validation split is reproducible across runs
+# Evaluate (or checkpoint, in "offline" mode) N times per epoch. Set to 0 or None to disable.
 EVALUATION_STEPS_PER_EPOCH: Optional[int] = 4
+# "offline": save a checkpoint at each evaluation step and score them after training with
+#   evaluate_embedder.py, which encodes the corpus once per checkpoint and caches it.
+# "in_training": run InformationRetrievalEvaluator at each evaluation step; it re-encodes the
+#   full corpus every time, and fit() keeps the best-scoring model in OUTPUT_MODEL_DIR.
+EVALUATION_MODE = "offline"
 # Similarity function for InformationRetrievalEvaluator
 IR_EVAL_SIMILARITY_FUNCTION = SimilarityFunction.COSINE
 
@@ -128,39 +152,28 @@ def load_triplets(triplet_file: Path) -> Optional[List[TripletData]]:
         return None
 
 def load_corpus(chunk_file: Path) -> Optional[CorpusDict]:
-    """Loads the document corpus from a JSON Lines file for the evaluator."""
+    """Loads the document corpus from a JSON Lines file for the evaluator (streamed via src.chunk_corpus)."""
     log.info(f"Loading corpus chunks from {chunk_file} for evaluator...")
     corpus: CorpusDict = {}
     chunk_id_counter = 0
-    lines_read = 0
-    invalid_json = 0
+    read_stats: Dict[str, int] = {}
     missing_text = 0
     try:
-        with chunk_file.open('r', encoding='utf-8') as f:
-            for line in f:
-                lines_read += 1
-                try:
-                    data = json.loads(line)
-                    chunk_text = data.get(CHUNK_TEXT_KEY)
-                    if chunk_text and not chunk_text.isspace():
-                        # Use a simple numerical ID for the corpus dictionary
-                        current_id = f"doc_{chunk_id_counter}"
-                        corpus[current_id] = chunk_text.strip()
-                        chunk_id_counter += 1
-                    else:
-                        missing_text += 1
-                        log.debug(f"Skipping corpus line {lines_read}: Missing or empty '{CHUNK_TEXT_KEY}'.")
-                except json.JSONDecodeError:
-                    invalid_json += 1
-                    log.warning(f"Skipping invalid JSON line {lines_read} in corpus file {chunk_file}: {line.strip()}")
-                except Exception as e:
-                    invalid_json += 1
-                    log.warning(f"Error processing corpus line {lines_read} in {chunk_file}: {e}")
-
-        log.info(f"Read {lines_read} lines from corpus file {chunk_file}.")
+        for data in iter_chunks(chunk_file, read_stats):
+            chunk_text = data.get(CHUNK_TEXT_KEY)
+            if isinstance(chunk_text, str) and chunk_text and not chunk_text.isspace():
+                # Use a simple numerical ID for the corpus dictionary
+                current_id = f"doc_{chunk_id_counter}"
+                corpus[current_id] = chunk_text.strip()
+                chunk_id_counter += 1
+            else:
+                missing_text += 1
+                log.debug(f"Skipping corpus record {chunk_id_counter + missing_text}: Missing or empty '{CHUNK_TEXT_KEY}'.")
+
+        log.info(f"Read {read_stats['lines_read']} lines from corpus file {chunk_file}.")
         log.info(f"Loaded {len(corpus)} valid documents into corpus.")
         if missing_text > 0: log.warning(f"Skipped {missing_text} corpus entries with missing/empty text.")
-        if invalid_json > 0: log.warning(f"Skipped {invalid_json} invalid/problematic JSON lines in corpus file.")
+        if read_stats['invalid_json'] > 0: log.warning(f"Skipped {read_stats['invalid_json']} invalid/problematic JSON lines in corpus file.")
 
         if not corpus:
             log.error("Corpus is empty after loading chunks. Evaluation will not be possible.")
@@ -177,6 +190,20 @@ def load_corpus(chunk_file: Path) -> Optional[CorpusDict]:
 
 # --- Evaluation Data Preparation ---
 
+def normalize_match_text(text: str) -> str:
+    """Collapses whitespace so positives still match corpus chunks after stripping/re-wrapping."""
+    return " ".join(text.split())
+
+def save_validation_triplets(validation_triplets: List[TripletData], output_file: Path):
+    """Writes the validation split as JSON Lines (same format as the triplet input file)."""
+    try:
+        with output_file.open('w', encoding='utf-8') as f:
+            for triplet in validation_triplets:
+                f.write(json.dumps(triplet, ensure_ascii=False) + "\n")
+        log.info(f"Saved {len(validation_triplets)} validation triplets to {output_file}.")
+    except OSError as e:
+        log.error(f"Could not save validation triplets to {output_file}: {e}")
+
 def create_ir_eval_data(
     validation_triplets: List[TripletData],
     corpus: CorpusDict
@@ -197,13 +224,11 @@ def create_ir_eval_data(
     queries: QueriesDict = {}
     relevant_docs: RelevantDocsDict = {}
 
-    # Create a reverse map from text to potential doc_ids for faster lookup
+    # Create a reverse map from (whitespace-normalized) text to potential doc_ids for faster lookup
     # Handle potential duplicate texts mapping to multiple IDs if necessary
     text_to_ids: Dict[str, List[str]] = {}
     for doc_id, doc_text in corpus.items():
-        if doc_text not in text_to_ids:
-            text_to_ids[doc_text] = []
-        text_to_ids[doc_text].append(doc_id)
+        text_to_ids.setdefault(normalize_match_text(doc_text), []).append(doc_id)
 
     processed_queries = 0
     missing_pos_map_count = 0
@@ -214,8 +239,7 @@ def create_ir_eval_data(
         queries[query_id] = anchor_text # Anchor is the query
 
         # Find the corpus doc ID(s) corresponding to the positive text
-        # Use the pre-stripped positive_text from load_triplets
-        matched_doc_ids = text_to_ids.get(positive_text)
+        matched_doc_ids = text_to_ids.get(normalize_match_text(positive_text))
 
         if matched_doc_ids:
             # Add all matching doc IDs as relevant for this query
@@ -224,7 +248,7 @@ def create_ir_eval_data(
         else:
             missing_pos_map_count += 1
             log.warning(
-                f"Could not find exact match in corpus for positive document text "
+                f"Could not find a match in corpus for positive document text "
                 f"from validation triplet {i}. Query ID: {query_id}. "
                 f"Positive text snippet: '{positive_text[:100]}...'"
             )
@@ -280,7 +304,7 @@ def train_model():
     # but evaluation cannot.
 
     # --- Split Data ---
-    random.shuffle(all_triplets)
+    random.Random(SPLIT_SEED).shuffle(all_triplets)
     num_validation = int(len(all_triplets) * VALIDATION_SPLIT_PERCENTAGE)
     # Ensure a minimum number of validation samples if possible
     num_validation = max(num_validation, min(MIN_VALIDATION_SAMPLES, len(all_triplets) // 10))
@@ -297,20 +321,31 @@ def train_model():
     else:
         validation_triplets = all_triplets[:num_validation]
         training_triplets = all_triplets[num_validation:]
+        save_validation_triplets(validation_triplets, VALIDATION_TRIPLETS_FILE)
 
+    if DRY_RUN:
+        training_triplets = training_triplets[:DRY_RUN_MAX_TRIPLETS]
+        validation_triplets = []
+        log.warning(f"DRY_RUN enabled: training on {len(training_triplets)} triplets for 1 epoch without evaluation.")
     log.info(f"Data split: {len(training_triplets)} training triplets, {len(validation_triplets)} validation triplets.")
 
-    # Prepare training samples (positive pairs for MultipleNegativesRankingLoss)
-    # InputExample format: texts=[anchor, positive]
-    train_samples_mnrl = [InputExample(texts=[t[0], t[1]]) for t in training_triplets]
-    log.info(f"Created {len(train_samples_mnrl)} positive pairs for MNRL training.")
+    # Prepare training samples for MultipleNegativesRankingLoss
+    # InputExample format: texts=[anchor, positive, hard_negative]. The loss scores each anchor
+    # against every positive *and* every mined hard negative in the batch.
+    train_samples_mnrl = [InputExample(texts=[t[0], t[1], t[2]]) for t in training_triplets if len(t) == 3 and t[2]]
+    skipped_without_negative = len(training_triplets) - len(train_samples_mnrl)
+    if skipped_without_negative:
+        log.warning(f"Skipped {skipped_without_negative} training triplets without a mined hard negative.")
+    log.info(f"Created {len(train_samples_mnrl)} (anchor, positive, hard negative) triplets for MNRL training.")
     if not train_samples_mnrl:
         log.error("No training samples could be created. Check triplet data.")
         return
 
     # --- Prepare Evaluator (if possible) ---
     evaluator: Optional[InformationRetrievalEvaluator] = None
-    if validation_triplets and corpus and EVALUATION_STEPS_PER_EPOCH is not None and EVALUATION_STEPS_PER_EPOCH > 0:
+    if EVALUATION_MODE == "offline":
+        log.info("EVALUATION_MODE is 'offline': no evaluation during training. Score the saved checkpoints with evaluate_embedder.py.")
+    elif validation_triplets and corpus and EVALUATION_STEPS_PER_EPOCH is not None and EVALUATION_STEPS_PER_EPOCH > 0:
         eval_data = create_ir_eval_data(validation_triplets, corpus)
         if eval_data:
             val_queries, val_relevant_docs = eval_data
@@ -374,25 +409,50 @@ def train_model():
         return
 
     # --- Prepare DataLoader and Loss ---
-    log.info("Preparing DataLoader...")
-    # MNRL works best with larger batch sizes if memory allows
-    train_dataloader = DataLoader(train_samples_mnrl, shuffle=True, batch_size=TRAIN_BATCH_SIZE)
+    # Both losses treat all other items in a batch as negatives for a given anchor-positive pair,
+    # so they work best with large batches.
+    use_cached_loss = LOSS_TYPE == "cached_mnrl"
+    if use_cached_loss and not hasattr(losses, "CachedMultipleNegativesRankingLoss"):
+        log.warning("CachedMultipleNegativesRankingLoss requires sentence-transformers >= 2.6. Falling back to MultipleNegativesRankingLoss.")
+        use_cached_loss = False
+    train_batch_size = CACHED_TRAIN_BATCH_SIZE if use_cached_loss else TRAIN_BATCH_SIZE
+    if DRY_RUN:
+        # Keep at least two batches so the dry run exercises more than a single step
+        dry_run_batch_size = max(2, min(train_batch_size, len(train_samples_mnrl) // 2 or 2))
+        if dry_run_batch_size != train_batch_size:
+            log.warning(f"DRY_RUN: reducing batch size from {train_batch_size} to {dry_run_batch_size} for {len(train_samples_mnrl)} samples.")
+            train_batch_size = dry_run_batch_size
+
+    log.info(f"Preparing DataLoader (batch size {train_batch_size})...")
+    train_dataloader = DataLoader(train_samples_mnrl, shuffle=True, batch_size=train_batch_size)
+    # Make sure the mined hard negatives actually reach the loss, not just (anchor, positive) pairs
+    samples_with_negative = sum(1 for example in train_dataloader.dataset if len(example.texts) == 3 and example.texts[2])
+    log.info(f"{samples_with_negative} of {len(train_dataloader.dataset)} training samples carry a hard negative.")
+
+    if use_cached_loss:
+        log.info(f"Initializing CachedMultipleNegativesRankingLoss (mini-batch size {CACHED_MINI_BATCH_SIZE}).")
+        train_loss = losses.CachedMultipleNegativesRankingLoss(model=model, mini_batch_size=CACHED_MINI_BATCH_SIZE)
+    else:
+        log.info("Initializing MultipleNegativesRankingLoss.")
+        train_loss = losses.MultipleNegativesRankingLoss(model=model)
 
-    log.info("Initializing MultipleNegativesRankingLoss.")
-    # This loss treats all other items in a batch as negatives for a given anchor-positive pair.
-    train_loss = losses.MultipleNegativesRankingLoss(model=model)
+    use_amp = USE_AMP and device.type == "cuda"
+    if USE_AMP and not use_amp:
+        log.info(f"AMP is only enabled on CUDA; training in fp32 on {device.type}.")
+    num_epochs = 1 if DRY_RUN else NUM_EPOCHS
 
     # --- Configure Training Steps ---
     steps_per_epoch = len(train_dataloader)
-    num_training_steps = steps_per_epoch * NUM_EPOCHS
+    num_training_steps = steps_per_epoch * num_epochs
     warmup_steps = math.ceil(num_training_steps * 0.10) # 10% warmup
 
     # Calculate evaluation steps, handle potential division by zero or invalid factor
     evaluation_steps = 0
-    if evaluator and EVALUATION_STEPS_PER_EPOCH and EVALUATION_STEPS_PER_EPOCH > 0 and steps_per_epoch > 0:
+    offline_eval = EVALUATION_MODE == "offline" and not DRY_RUN
+    if (evaluator or offline_eval) and EVALUATION_STEPS_PER_EPOCH and EVALUATION_STEPS_PER_EPOCH > 0 and steps_per_epoch > 0:
         evaluation_steps = steps_per_epoch // EVALUATION_STEPS_PER_EPOCH
         evaluation_steps = max(1, evaluation_steps) # Ensure at least 1 step if eval is enabled
-        log.info(f"Evaluator will run approx. every {evaluation_steps} steps.")
+        log.info(f"{'Evaluator will run' if evaluator else 'Checkpoints for offline evaluation will be saved'} approx. every {evaluation_steps} steps.")
     elif evaluator:
         log.warning(f"Cannot determine evaluation steps (EVALUATION_STEPS_PER_EPOCH={EVALUATION_STEPS_PER_EPOCH}, steps_per_epoch={steps_per_epoch}). Evaluation might not run as intended.")
 
@@ -401,8 +461,10 @@ def train_model():
     log.info("--- Training Configuration ---")
     log.info(f"Base Model: {BASE_MODEL_NAME}")
     log.info(f"Device: {device.type}")
-    log.info(f"Num Epochs: {NUM_EPOCHS}")
-    log.info(f"Train Batch Size: {TRAIN_BATCH_SIZE}")
+    log.info(f"Num Epochs: {num_epochs}")
+    log.info(f"Loss: {'CachedMultipleNegativesRankingLoss' if use_cached_loss else 'MultipleNegativesRankingLoss'}")
+    log.info(f"Train Batch Size: {train_batch_size}" + (f" (mini-batches of {CACHED_MINI_BATCH_SIZE})" if use_cached_loss else ""))
+    log.info(f"Mixed Precision (AMP): {'Yes' if use_amp else 'No'}")
     log.info(f"Learning Rate: {LEARNING_RATE}")
     log.info(f"Effective Max Sequence Length: {effective_max_seq_length}")
     log.info(f"Total Training Steps: {num_training_steps}")
@@ -410,7 +472,7 @@ def train_model():
     log.info(f"Input Triplets File: {INPUT_TRIPLET_FILE}")
     log.info(f"Output Model Path: {OUTPUT_MODEL_DIR}")
     log.info(f"Checkpoint Path: {CHECKPOINT_SAVE_DIR}")
-    log.info(f"Evaluator Enabled: {'Yes' if evaluator else 'No'}")
+    log.info(f"Evaluator Enabled: {'Yes' if evaluator else 'No'} (mode: {EVALUATION_MODE})")
     if evaluator:
         log.info(f"Evaluation Steps: {evaluation_steps}")
         log.info(f"Validation Split: {VALIDATION_SPLIT_PERCENTAGE*100:.1f}% ({len(validation_triplets)} samples)")
@@ -428,7 +490,7 @@ def train_model():
         CHECKPOINT_SAVE_DIR.mkdir(parents=True, exist_ok=True)
 
         # Configure checkpoint saving strategy based on evaluation
-        checkpoint_save_steps = evaluation_steps if evaluator and evaluation_steps > 0 else 0
+        checkpoint_save_steps = evaluation_steps if evaluation_steps > 0 else 0
         # If eval is disabled or steps are 0, don't save checkpoints based on steps during fit()
         # You might save at the end of epochs instead if desired, or just rely on the final save.
         if checkpoint_save_steps == 0:
@@ -439,19 +501,19 @@ def train_model():
 
 
         model.fit(train_objectives=[(train_dataloader, train_loss)],
-                  epochs=NUM_EPOCHS,
+                  epochs=num_epochs,
                   optimizer_params={'lr': LEARNING_RATE},
                   warmup_steps=warmup_steps,
                   output_path=str(OUTPUT_MODEL_DIR), # fit expects string path
                   checkpoint_path=str(CHECKPOINT_SAVE_DIR), # fit expects string path
                   checkpoint_save_steps=checkpoint_save_steps,
-                  checkpoint_save_total_limit=3, # Keep last 3 checkpoints
+                  # Keep last 3 checkpoints; offline evaluation needs all of them (0 = no limit)
+                  checkpoint_save_total_limit=0 if evaluator is None else 3,
                   evaluator=evaluator, # Pass the evaluator object
-                  evaluation_steps=evaluation_steps, # Steps between evaluations
+                  evaluation_steps=evaluation_steps if evaluator else 0, # Steps between evaluations
                   show_progress_bar=True,
-                  # Consider use_amp=True if on CUDA and want potential speedup/memory saving,
-                  # but test stability. MPS support for AMP can be experimental.
-                  use_amp=False #(device.type == 'cuda') # Example: enable only for CUDA
+                  # fp16 autocast on CUDA only; MPS support for AMP can be experimental.
+                  use_amp=use_amp
                   )
 
         end_time = datetime.now()
@@ -465,7 +527,8 @@ def train_model():
         if "allocate" in str(e).lower() or "out of memory" in str(e).lower():
             log.critical(
                 f"CRITICAL: Out of Memory Error during training on device '{device.type}'. "
-                f"Try reducing 'TRAIN_BATCH_SIZE' (currently {TRAIN_BATCH_SIZE}). "
+                f"Try reducing {'CACHED_MINI_BATCH_SIZE' if use_cached_loss else 'TRAIN_BATCH_SIZE'} "
+                f"(currently {CACHED_MINI_BATCH_SIZE if use_cached_loss else TRAIN_BATCH_SIZE}). "
                 f"If using MPS, ensure PyTorch is up-to-date."
              )
         elif "mps" in str(e).lower() and "datatype" in str(e).lower():
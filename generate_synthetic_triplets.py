@@ -5,8 +5,13 @@ import os
 import logging
 import time
 import re
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dotenv import load_dotenv
 import google.generativeai as genai # Use the specific import
+from src.chunk_corpus import iter_chunks # Streaming JSONL reader shared with chunk_data
+from src.paths import MODEL_PATH # Same model directory as config.MODEL_PATH, without config's API validation
 
 # Load environment variables from .env file
 load_dotenv()
@@ -24,17 +29,137 @@ OUTPUT_JSONL = "finetuning_triplets_v2_english.jsonl" # New output name
 NUM_QUERIES_PER_ASSESSMENT = 10
 TARGET_TRIPLET_COUNT = 10000 # Adjust as needed
 MAX_LLM_RETRIES = 3
-LLM_RETRY_DELAY = 5 # seconds
+LLM_RETRY_DELAY = 5 # seconds (base delay; doubles on each retry)
+LLM_MAX_RETRY_DELAY = 60 # seconds
+# Concurrent query generation: parallel in-flight LLM calls, throttled by a token bucket
+LLM_CONCURRENCY = 8
+LLM_REQUESTS_PER_MINUTE = 60 # Keep below the API key's per-minute quota
+LLM_BURST = 5 # Requests allowed back-to-back before the rate limit applies
+# Resumability: each solution's generated queries are appended to the journal as soon as they
+# arrive; a rerun skips solutions already journaled with the same prompt.
+QUERY_JOURNAL_FILE = "synthetic_query_journal.jsonl"
+# Raw LLM responses cached by prompt hash, so reruns never pay twice for the same prompt
+LLM_CACHE_DIR = "llm_response_cache"
+USE_LLM_CACHE = True
+# Hard negative mining: encode the corpus with the current model and take negatives from each
+# anchor's nearest neighbours in other solutions (falls back to random same-test-type negatives).
+HARD_NEGATIVE_MINING = True
+MINING_MODEL_PATH = MODEL_PATH
+MINING_ENCODE_BATCH_SIZE = 64
+MINING_QUERY_BATCH_SIZE = 1024 # Anchors scored against the corpus per matrix multiply
+HARD_NEGATIVE_TOP_K = 50 # Neighbours considered per anchor
+HARD_NEGATIVE_POOL_SIZE = 5 # Negative sampled from this many hardest eligible neighbours
+HARD_NEGATIVE_MAX_SIMILARITY = 0.95 # Skip neighbours this close to the anchor (likely false negatives)
 TARGET_LANGUAGE = 'en' # Focus on English triplets
 
 # --- Setup Logging ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 log = logging.getLogger(__name__)
 
+# --- LLM Client and Rate Limiting ---
+class TokenBucket:
+    """Thread-safe token bucket: `rate` tokens per second, holding at most `capacity`."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a token is available, then takes it."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_seconds = (1 - self.tokens) / self.rate
+            time.sleep(wait_seconds)
+
+llm_rate_limiter = TokenBucket(LLM_REQUESTS_PER_MINUTE / 60.0, LLM_BURST)
+_llm_model = None
+_llm_model_lock = threading.Lock()
+
+def get_llm_model():
+    """Configures genai and builds the GenerativeModel once; shared by all threads."""
+    global _llm_model
+    with _llm_model_lock:
+        if _llm_model is None:
+            genai.configure(api_key=GOOGLE_API_KEY)
+            _llm_model = genai.GenerativeModel(LLM_MODEL_NAME)
+        return _llm_model
+
+# --- Response Cache and Query Journal ---
+def get_prompt_hash(prompt):
+    """SHA-256 of the model name and prompt text."""
+    return hashlib.sha256(f"{LLM_MODEL_NAME}\n{prompt}".encode('utf-8')).hexdigest()
+
+def read_cached_response(prompt):
+    """Returns the cached LLM response for a prompt, or None."""
+    cache_path = os.path.join(LLM_CACHE_DIR, f"{get_prompt_hash(prompt)}.txt")
+    try:
+        with open(cache_path, 'r', encoding='utf-8') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+def write_cached_response(prompt, response_text):
+    """Atomically stores an LLM response under its prompt hash."""
+    os.makedirs(LLM_CACHE_DIR, exist_ok=True)
+    cache_path = os.path.join(LLM_CACHE_DIR, f"{get_prompt_hash(prompt)}.txt")
+    tmp_path = f"{cache_path}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(response_text)
+    os.replace(tmp_path, cache_path)
+
+_journal_lock = threading.Lock()
+
+def load_query_journal(journal_file):
+    """
+    Loads journaled query results as {solution_name: entry}. A line torn by a crash
+    mid-write is skipped by iter_chunks; later entries for a solution win.
+    """
+    if not os.path.exists(journal_file):
+        return {}
+    journal = {entry['solution_name']: entry for entry in iter_chunks(journal_file) if 'solution_name' in entry}
+    log.info(f"Loaded {len(journal)} journaled solutions from {journal_file}.")
+    return journal
+
+def journal_ends_with_newline(journal_file):
+    """False if the journal's last line was torn by a crash (no trailing newline)."""
+    if not os.path.exists(journal_file) or os.path.getsize(journal_file) == 0:
+        return True
+    with open(journal_file, 'rb') as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b'\n'
+
+def append_to_journal(journal_file, entry):
+    """Appends one solution's result and flushes it to disk before returning."""
+    with _journal_lock:
+        # Terminate a torn last line first, so this entry isn't glued onto it and lost too
+        prefix = '' if journal_ends_with_newline(journal_file) else '\n'
+        with open(journal_file, 'a', encoding='utf-8') as f:
+            f.write(prefix + json.dumps(entry) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+def get_retry_delay(attempt):
+    """Exponential backoff with jitter for the given 1-based retry attempt."""
+    return min(LLM_RETRY_DELAY * (2 ** (attempt - 1)), LLM_MAX_RETRY_DELAY) + random.uniform(0, 1)
+
 # --- LLM Interaction Function ---
 def call_llm(prompt):
     """Sends a prompt to the configured LLM and returns the text response."""
     log.debug(f"Sending prompt to LLM ({LLM_MODEL_NAME})...")
+    if USE_LLM_CACHE:
+        cached_response = read_cached_response(prompt)
+        if cached_response is not None:
+            log.debug("LLM response served from cache.")
+            return cached_response
     if not GOOGLE_API_KEY:
         log.error("GOOGLE_API_KEY not configured.")
         return None
@@ -42,8 +167,8 @@ def call_llm(prompt):
     retries = 0
     while retries < MAX_LLM_RETRIES:
         try:
-            genai.configure(api_key=GOOGLE_API_KEY)
-            model = genai.GenerativeModel(LLM_MODEL_NAME)
+            model = get_llm_model()
+            llm_rate_limiter.acquire() # Every attempt counts against the quota
             # Configure safety settings to be less restrictive if appropriate,
             # but be aware of the implications. Test default first.
             # safety_settings = [
@@ -65,7 +190,10 @@ def call_llm(prompt):
                          if hasattr(candidate.content.parts[0], 'text'):
                             response_text = candidate.content.parts[0].text
                             log.debug(f"LLM Response received (first 100 chars): {response_text[:100]}")
-                            return response_text.strip()
+                            response_text = response_text.strip()
+                            if USE_LLM_CACHE:
+                                write_cached_response(prompt, response_text)
+                            return response_text
                          else:
                             log.warning(f"LLM ({LLM_MODEL_NAME}) response part missing 'text' attribute.")
                             raise Exception("Part missing text") # Force retry
@@ -86,11 +214,12 @@ def call_llm(prompt):
 
         except Exception as e:
             retries += 1
-            log.warning(f"LLM call failed (Attempt {retries}/{MAX_LLM_RETRIES}): {e}. Retrying in {LLM_RETRY_DELAY}s...")
             if retries >= MAX_LLM_RETRIES:
-                log.error(f"LLM call failed after {MAX_LLM_RETRIES} attempts for prompt: {prompt[:100]}...")
+                log.error(f"LLM call failed after {MAX_LLM_RETRIES} attempts ({e}) for prompt: {prompt[:100]}...")
                 return None # Indicate failure
-            time.sleep(LLM_RETRY_DELAY + random.uniform(0, 1)) # Add jitter
+            retry_delay = get_retry_delay(retries)
+            log.warning(f"LLM call failed (Attempt {retries}/{MAX_LLM_RETRIES}): {e}. Retrying in {retry_delay:.1f}s...")
+            time.sleep(retry_delay)
     return None
 
 
@@ -99,64 +228,58 @@ def call_llm(prompt):
 # ** CORRECTED load_processed_chunks **
 # Checks metadata['languages'] (plural) and filters based on list content
 def load_processed_chunks(jsonl_file, target_language='en'):
-    """Loads chunk data, filtering by target language stored in the 'languages' list within metadata."""
+    """
+    Loads chunk data, filtering by target language stored in the 'languages' list within metadata.
+    Records are streamed via src.chunk_corpus, so only matching chunks are held in memory.
+    """
     chunks = []
     log.info(f"Loading and filtering chunks for language '{target_language}' from {jsonl_file}...")
-    lines_read = 0
-    invalid_json = 0
+    read_stats = {}
     missing_lang_key = 0 # Count chunks missing the 'languages' key entirely
     empty_lang_list = 0  # Count chunks where 'languages' list is empty
     lang_mismatch = 0
     lang_match_count = 0
     try:
-        with open(jsonl_file, 'r', encoding='utf-8') as f:
-            for line in f:
-                lines_read += 1
-                try:
-                    data = json.loads(line)
-                    metadata = data.get('metadata', {})
-
-                    # --- CORRECTED Language Filtering Logic ---
-                    # 1. Get the list associated with the 'languages' (plural) key
-                    langs_list = metadata.get('languages')
-
-                    # 2. Check if the key exists and the list is not empty or None
-                    if langs_list and isinstance(langs_list, list):
-                        # 3. Check if any language string in the list indicates English
-                        #    (case-insensitive check for 'english')
-                        is_target_language = any(target_language in lang.lower() for lang in langs_list if isinstance(lang, str))
-
-                        if is_target_language:
-                            if data.get('chunk_text'): # Ensure text exists
-                                chunks.append(data)
-                                lang_match_count += 1
-                            else:
-                                log.debug(f"Skipping chunk with no text: {metadata.get('solution_name', 'N/A')}")
-                        else:
-                            # This chunk has a language list, but not the target language
-                            lang_mismatch += 1
-                            # Optional: Log the languages found if debugging mismatch
-                            # log.debug(f"Language mismatch for {metadata.get('solution_name', 'N/A')}. Found: {langs_list}")
-
-                    elif isinstance(langs_list, list) and not langs_list:
-                        # 'languages' key exists but the list is empty
-                        empty_lang_list += 1
-                        log.debug(f"Chunk has empty 'languages' list: {metadata.get('solution_name', 'N/A')}. Skipping.")
+        for data in iter_chunks(jsonl_file, read_stats):
+            metadata = data.get('metadata', {})
+
+            # --- CORRECTED Language Filtering Logic ---
+            # 1. Get the list associated with the 'languages' (plural) key
+            langs_list = metadata.get('languages')
+
+            # 2. Check if the key exists and the list is not empty or None
+            if langs_list and isinstance(langs_list, list):
+                # 3. Check if any language string in the list indicates English
+                #    (case-insensitive check for 'english')
+                is_target_language = any(target_language in lang.lower() for lang in langs_list if isinstance(lang, str))
+
+                if is_target_language:
+                    if data.get('chunk_text'): # Ensure text exists
+                        chunks.append(data)
+                        lang_match_count += 1
                     else:
-                        # 'languages' key is missing or not a list
-                        missing_lang_key += 1
-                        log.warning(f"Chunk missing 'languages' key or not a list: {metadata.get('solution_name', 'N/A')}. Skipping.")
-                    # ------------------------------------------
-
-                except json.JSONDecodeError:
-                    log.warning(f"Skipping invalid JSON line in {jsonl_file}: {line.strip()}")
-                    invalid_json += 1
+                        log.debug(f"Skipping chunk with no text: {metadata.get('solution_name', 'N/A')}")
+                else:
+                    # This chunk has a language list, but not the target language
+                    lang_mismatch += 1
+                    # Optional: Log the languages found if debugging mismatch
+                    # log.debug(f"Language mismatch for {metadata.get('solution_name', 'N/A')}. Found: {langs_list}")
+
+            elif isinstance(langs_list, list) and not langs_list:
+                # 'languages' key exists but the list is empty
+                empty_lang_list += 1
+                log.debug(f"Chunk has empty 'languages' list: {metadata.get('solution_name', 'N/A')}. Skipping.")
+            else:
+                # 'languages' key is missing or not a list
+                missing_lang_key += 1
+                log.warning(f"Chunk missing 'languages' key or not a list: {metadata.get('solution_name', 'N/A')}. Skipping.")
+            # ------------------------------------------
 
-        log.info(f"Read {lines_read} lines. Loaded {len(chunks)} chunks matching language '{target_language}'.")
+        log.info(f"Read {read_stats['lines_read']} lines. Loaded {len(chunks)} chunks matching language '{target_language}'.")
         if missing_lang_key > 0: log.warning(f"Skipped {missing_lang_key} chunks missing 'languages' key or not a list.")
         if empty_lang_list > 0: log.warning(f"Skipped {empty_lang_list} chunks with an empty 'languages' list.")
         if lang_mismatch > 0: log.warning(f"Skipped {lang_mismatch} chunks with non-target language(s).")
-        if invalid_json > 0: log.warning(f"Skipped {invalid_json} invalid JSON lines.")
+        if read_stats['invalid_json'] > 0: log.warning(f"Skipped {read_stats['invalid_json']} invalid JSON lines.")
 
         if not chunks:
             log.error(f"No chunks found for target language '{target_language}'. Check input file and preprocessing steps.")
@@ -169,70 +292,156 @@ def load_processed_chunks(jsonl_file, target_language='en'):
         log.critical(f"CRITICAL: Error loading chunk file {jsonl_file}: {e}", exc_info=True)
         return None
 
-# ** CORRECTED get_core_info_chunk **
-# Removed the incorrect internal check for singular 'language' key
-def get_core_info_chunk(solution_name, all_english_chunks):
-    """Finds the English core_info chunk for a specific solution."""
-    for chunk in all_english_chunks:
-        # Trust that all_english_chunks is already filtered
-        if chunk['metadata']['solution_name'] == solution_name and \
-           chunk['metadata']['source_type'] == 'core_info':
+# --- Chunk Indexes ---
+# Max random draws from a bucket before falling back to filtering it (draws hitting the excluded solution)
+NEGATIVE_SAMPLE_ATTEMPTS = 20
+
+class ChunkIndex:
+    """
+    Lookups over the English chunks, built once so triplet mining doesn't rescan the corpus:
+    - core_by_solution: solution_name -> first core_info chunk
+    - pdf_by_solution: solution_name -> PDF chunks, in corpus order
+    - by_test_type: test type code -> chunks carrying it, for same-type negatives
+    - all_chunks: every chunk, for fallback negatives
+    """
+
+    def __init__(self, all_english_chunks):
+        self.all_chunks = all_english_chunks
+        self.core_by_solution = {}
+        self.pdf_by_solution = {}
+        self.by_test_type = {}
+        for chunk in all_english_chunks:
+            metadata = chunk.get('metadata', {})
+            solution_name = metadata.get('solution_name')
+            if metadata.get('source_type') == 'core_info':
+                self.core_by_solution.setdefault(solution_name, chunk)
+            else:
+                self.pdf_by_solution.setdefault(solution_name, []).append(chunk)
+            # chunk_data stores test types as a list of codes under 'test_type'
+            for test_type in metadata.get('test_type') or []:
+                self.by_test_type.setdefault(test_type, []).append(chunk)
+        log.info(f"Indexed {len(all_english_chunks)} chunks: {len(self.core_by_solution)} core_info, "
+                 f"{sum(len(chunks) for chunks in self.pdf_by_solution.values())} PDF, {len(self.by_test_type)} test types.")
+
+    @property
+    def solution_names(self):
+        """Sorted names of all solutions with at least one chunk."""
+        return sorted(set(self.core_by_solution) | set(self.pdf_by_solution))
+
+def sample_other_solution(bucket, exclude_solution_name):
+    """
+    Uniformly picks a chunk from `bucket` whose solution differs from `exclude_solution_name`.
+    Uses rejection sampling (O(1) expected); filters the bucket only if that keeps missing.
+    """
+    if not bucket:
+        return None
+    for _ in range(NEGATIVE_SAMPLE_ATTEMPTS):
+        chunk = random.choice(bucket)
+        if chunk.get('metadata', {}).get('solution_name') != exclude_solution_name:
             return chunk
-    # Log warning if not found (optional, can be verbose)
-    # log.warning(f"Could not find English core_info chunk for solution: {solution_name}")
-    return None
+    candidates = [chunk for chunk in bucket if chunk.get('metadata', {}).get('solution_name') != exclude_solution_name]
+    return random.choice(candidates) if candidates else None
 
-# ** CORRECTED get_pdf_chunks **
-# Removed the incorrect internal check for singular 'language' key
-def get_pdf_chunks(solution_name, all_english_chunks):
+def get_core_info_chunk(solution_name, chunk_index):
+    """Finds the English core_info chunk for a specific solution."""
+    return chunk_index.core_by_solution.get(solution_name)
+
+def get_pdf_chunks(solution_name, chunk_index):
     """Finds all English PDF chunks for a specific solution."""
-    # Trust that all_english_chunks is already filtered
-    return [chunk for chunk in all_english_chunks
-            if chunk['metadata']['solution_name'] == solution_name and
-               chunk['metadata']['source_type'] != 'core_info']
-
-# ** CORRECTED get_relevant_negative_chunk **
-# Removed the incorrect internal check for singular 'language' key
-# Added safe access for metadata keys
-def get_relevant_negative_chunk(exclude_solution_name, positive_test_type, all_english_chunks):
+    return list(chunk_index.pdf_by_solution.get(solution_name, []))
+
+def get_relevant_negative_chunk(exclude_solution_name, positive_test_types, chunk_index):
     """
     Gets a random English chunk from a DIFFERENT solution.
-    Tries to find one with the same 'Test Type' for harder negatives.
+    Tries to find one sharing a test type code with the positive for harder negatives.
     Falls back to any other English chunk if same-type is not found.
     """
-    potential_negatives = [
-        chunk for chunk in all_english_chunks
-        # Safely access solution name from metadata
-        if chunk.get('metadata', {}).get('solution_name') != exclude_solution_name
-        # Trust that all_english_chunks is already filtered for language
-    ]
-
-    if not potential_negatives:
+    valid_types = [t for t in (positive_test_types or []) if isinstance(t, str) and t and t != 'N/A']
+    if valid_types:
+        # Pick one of the positive's types, then a chunk of that type
+        test_type = random.choice(valid_types)
+        negative = sample_other_solution(chunk_index.by_test_type.get(test_type), exclude_solution_name)
+        if negative:
+            log.debug(f"Selecting negative with matching test type '{test_type}' for excluded '{exclude_solution_name}'.")
+            return negative
+        log.debug(f"No negatives with test type '{test_type}' found for {exclude_solution_name}. Falling back to any other English solution.")
+
+    # Fallback: choose any chunk from a different English solution
+    negative = sample_other_solution(chunk_index.all_chunks, exclude_solution_name)
+    if not negative:
         log.warning(f"No other English solutions found to select a negative for '{exclude_solution_name}'.")
-        return None
+    return negative
 
-    # Try for same Test Type negative (if positive_test_type is known and valid)
-    # Ensure positive_test_type is a valid string before comparing
-    if positive_test_type and isinstance(positive_test_type, str) and positive_test_type != 'N/A':
-        same_type_negatives = [
-            chunk for chunk in potential_negatives
-            # Safely get 'Test Type' from negative chunk metadata
-            if chunk.get('metadata', {}).get('Test Type') == positive_test_type
-        ]
-        if same_type_negatives:
-            log.debug(f"Selecting negative with matching Test Type '{positive_test_type}' for excluded '{exclude_solution_name}'.")
-            return random.choice(same_type_negatives)
-        else:
-            log.debug(f"No negatives with Test Type '{positive_test_type}' found for {exclude_solution_name}. Falling back to any other English solution.")
+# --- Hard Negative Mining ---
+class HardNegativeMiner:
+    """
+    Encodes the English corpus once with the current model and keeps the normalized
+    embeddings as an exact (flat) inner-product index. For a batch of anchors it returns,
+    per anchor, a near neighbour from a different solution: a chunk the model currently
+    ranks close to the anchor but which is not relevant, i.e. a hard negative.
+    """
 
-    # Fallback: choose any chunk from a different English solution
-    # Add check to prevent error if potential_negatives is empty (shouldn't happen after initial check, but safe)
-    if potential_negatives:
-        return random.choice(potential_negatives)
-    else:
-        # This case should ideally not be reached due to the check at the start
-        log.error(f"Potential negatives list became empty unexpectedly for '{exclude_solution_name}'.")
-        return None
+    def __init__(self, chunks, model_path=MINING_MODEL_PATH):
+        # Heavy imports only when mining is enabled
+        import numpy as np
+        import torch
+        from sentence_transformers import SentenceTransformer
+        self.np = np
+        device = "cuda" if torch.cuda.is_available() else "mps" if torch.backends.mps.is_available() else "cpu"
+        log.info(f"Loading mining model from {model_path} on {device}...")
+        self.model = SentenceTransformer(str(model_path), device=device)
+        self.chunks = chunks
+        self.solution_names = [chunk.get('metadata', {}).get('solution_name') for chunk in chunks]
+        start_time = time.time()
+        self.embeddings = self.encode([chunk['chunk_text'] for chunk in chunks])
+        log.info(f"Encoded {len(chunks)} corpus chunks for mining in {time.time() - start_time:.1f}s.")
+
+    def encode(self, texts):
+        return self.model.encode(
+            texts, batch_size=MINING_ENCODE_BATCH_SIZE, convert_to_numpy=True,
+            normalize_embeddings=True, show_progress_bar=False
+        ).astype(self.np.float32)
+
+    def mine(self, anchors, exclude_solution_names):
+        """Returns one hard negative chunk (or None) per anchor."""
+        np = self.np
+        anchor_embeddings = self.encode(anchors)
+        k = min(HARD_NEGATIVE_TOP_K, len(self.chunks))
+        negatives = []
+        for start in range(0, len(anchors), MINING_QUERY_BATCH_SIZE):
+            scores = anchor_embeddings[start : start + MINING_QUERY_BATCH_SIZE] @ self.embeddings.T
+            # Top-k per row without a full sort, then order those k by score
+            top_k = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            top_k = np.take_along_axis(top_k, np.argsort(-np.take_along_axis(scores, top_k, axis=1), axis=1), axis=1)
+            for row, exclude_solution_name in enumerate(exclude_solution_names[start : start + MINING_QUERY_BATCH_SIZE]):
+                pool = [
+                    self.chunks[i] for i in top_k[row]
+                    if self.solution_names[i] != exclude_solution_name
+                    # Near-duplicates of the anchor are likely unlabeled positives, not negatives
+                    and scores[row, i] < HARD_NEGATIVE_MAX_SIMILARITY
+                ][:HARD_NEGATIVE_POOL_SIZE]
+                # Sample among the hardest few so one chunk doesn't become every anchor's negative
+                negatives.append(random.choice(pool) if pool else None)
+        return negatives
+
+def select_negatives(candidates, chunk_index, miner=None):
+    """
+    Picks a negative chunk for each (anchor, positive_chunk, solution_name) candidate.
+    Uses the miner in one batch when given; candidates it can't serve (and all of them
+    without a miner) get a random same-test-type negative from another solution.
+    """
+    if not candidates:
+        return []
+    negatives = [None] * len(candidates)
+    if miner is not None:
+        negatives = miner.mine([anchor for anchor, _, _ in candidates], [solution_name for _, _, solution_name in candidates])
+        log.info(f"Mined hard negatives for {sum(1 for n in negatives if n)}/{len(candidates)} anchors.")
+    for i, (anchor, positive_chunk, solution_name) in enumerate(candidates):
+        if negatives[i] is None:
+            # Use test types from the *positive* chunk chosen for this triplet
+            positive_test_types = positive_chunk.get('metadata', {}).get('test_type')
+            negatives[i] = get_relevant_negative_chunk(solution_name, positive_test_types, chunk_index)
+    return negatives
 
 
 def parse_llm_query_response(response_text):
@@ -320,6 +529,84 @@ except ImportError:
     pd = type('obj', (object,), {'isna': isnan})() # Mock pd.isna
 
 
+# --- Query Generation ---
+def build_query_prompt(core_chunk, num_queries_per):
+    """Builds the hiring-manager query generation prompt for one solution's core_info chunk."""
+    # Use the refined prompt - send the full core text to LLM for context
+    return f"""Act as a Hiring Manager looking for SHL assessments. Based ONLY on the following assessment information:
+--- ASSESSMENT START ---
+{core_chunk['chunk_text']}
+--- ASSESSMENT END ---
+
+Generate {num_queries_per} diverse, realistic English search queries focused *specifically* on the details mentioned above. Create queries that:
+1. Ask about specific skills explicitly mentioned (e.g., "assessment for [skill]").
+2. Target the described job levels (e.g., "entry-level [assessment type] test").
+3. Inquire about the assessment length (e.g., "quick test under [duration] mins for [purpose]").
+4. Mention the test type codes if present (e.g., "SHL test with type [code]").
+5. Combine 2-3 of the above aspects (e.g., "managerial assessment for [skill] under [duration] minutes").
+6. Reflect a hiring need related to the assessment's description (e.g., "test for identifying high-potential graduates").
+
+Output ONLY the numbered list of queries in English. Do not add commentary. Ensure queries are distinct.
+
+Generated Queries:"""
+
+def generate_queries_for_solution(solution_name, core_chunk, num_queries_per):
+    """Calls the LLM for one solution. Returns the parsed queries, or None on failure."""
+    response_text = call_llm(build_query_prompt(core_chunk, num_queries_per))
+    if not response_text:
+        return None
+    return parse_llm_query_response(response_text)
+
+def generate_queries_concurrently(solution_jobs, num_queries_per, journal_file=QUERY_JOURNAL_FILE):
+    """
+    Generates queries for [(solution_name, core_chunk)] with LLM_CONCURRENCY worker threads.
+    Each task retries with backoff inside call_llm; the shared token bucket keeps the
+    aggregate request rate under LLM_REQUESTS_PER_MINUTE.
+
+    Solutions already in the journal with the same prompt hash are reused without an API
+    call; every newly completed solution is appended to the journal immediately, so a crash
+    or quota error loses at most the in-flight requests. Failures and empty query lists are
+    not journaled (or reused) and are retried on the next run.
+    Returns {solution_name: queries or None}.
+    """
+    results = {}
+    journal = load_query_journal(journal_file)
+    pending_jobs = []
+    for solution_name, core_chunk in solution_jobs:
+        entry = journal.get(solution_name)
+        if entry and entry.get('queries') and entry.get('prompt_hash') == get_prompt_hash(build_query_prompt(core_chunk, num_queries_per)):
+            results[solution_name] = entry['queries']
+        else:
+            pending_jobs.append((solution_name, core_chunk))
+    if results:
+        log.info(f"Resuming: {len(results)} solutions reused from the journal, {len(pending_jobs)} to generate.")
+
+    start_time = time.time()
+    with ThreadPoolExecutor(max_workers=LLM_CONCURRENCY, thread_name_prefix="llm-query") as executor:
+        futures = {
+            executor.submit(generate_queries_for_solution, solution_name, core_chunk, num_queries_per): (solution_name, core_chunk)
+            for solution_name, core_chunk in pending_jobs
+        }
+        for completed, future in enumerate(as_completed(futures), start=1):
+            solution_name, core_chunk = futures[future]
+            try:
+                results[solution_name] = future.result()
+            except Exception as e:
+                log.error(f"    Query generation task for {solution_name} raised: {e}", exc_info=True)
+                results[solution_name] = None
+            queries = results[solution_name]
+            if queries:
+                append_to_journal(journal_file, {
+                    "solution_name": solution_name,
+                    "prompt_hash": get_prompt_hash(build_query_prompt(core_chunk, num_queries_per)),
+                    "queries": queries,
+                })
+            log.info(f"  [{completed}/{len(futures)}] {solution_name}: "
+                     f"{'failed' if queries is None else f'{len(queries)} queries'}")
+    log.info(f"Query generation for {len(futures)} solutions took {time.time() - start_time:.1f}s "
+             f"({LLM_CONCURRENCY} workers, {LLM_REQUESTS_PER_MINUTE} requests/min limit).")
+    return results
+
 # --- Main Data Generation Logic (V2) ---
 def generate_triplets_v2(all_english_chunks, num_queries_per, target_count):
     """Generates query-based and core-to-pdf triplets focusing on English and better negatives."""
@@ -328,8 +615,10 @@ def generate_triplets_v2(all_english_chunks, num_queries_per, target_count):
         return []
 
     triplets = []
+    # Build lookups once; every per-query/per-solution lookup below uses them
+    chunk_index = ChunkIndex(all_english_chunks)
     # Get unique solution names ONLY from the filtered English chunks
-    unique_solution_names = sorted(list(set(chunk['metadata']['solution_name'] for chunk in all_english_chunks)))
+    unique_solution_names = chunk_index.solution_names
     log.info(f"Found {len(unique_solution_names)} unique solutions with English chunks.")
     if not unique_solution_names:
         log.error("No unique solutions identified from the English chunks.")
@@ -340,41 +629,23 @@ def generate_triplets_v2(all_english_chunks, num_queries_per, target_count):
     query_target_pairs = []
     generated_query_count = 0
     failed_query_gen = 0
-    processed_solutions_for_queries = 0
-    for i, solution_name in enumerate(unique_solution_names):
+    solution_jobs = []
+    for solution_name in unique_solution_names:
         # Find the English core_info chunk for this solution
-        core_chunk = get_core_info_chunk(solution_name, all_english_chunks)
+        core_chunk = get_core_info_chunk(solution_name, chunk_index)
 
         if not core_chunk:
             # This log should now be less frequent if loading works
             log.debug(f"  Skipping query generation for {solution_name} (no English core chunk found).")
             continue
-
-        processed_solutions_for_queries += 1
-        log.info(f"  Generating queries for solution {processed_solutions_for_queries}/{len(unique_solution_names)}: {solution_name}")
-
-        # Use the refined prompt - send the full core text to LLM for context
-        prompt = f"""Act as a Hiring Manager looking for SHL assessments. Based ONLY on the following assessment information:
---- ASSESSMENT START ---
-{core_chunk['chunk_text']}
---- ASSESSMENT END ---
-
-Generate {num_queries_per} diverse, realistic English search queries focused *specifically* on the details mentioned above. Create queries that:
-1. Ask about specific skills explicitly mentioned (e.g., "assessment for [skill]").
-2. Target the described job levels (e.g., "entry-level [assessment type] test").
-3. Inquire about the assessment length (e.g., "quick test under [duration] mins for [purpose]").
-4. Mention the test type codes if present (e.g., "SHL test with type [code]").
-5. Combine 2-3 of the above aspects (e.g., "managerial assessment for [skill] under [duration] minutes").
-6. Reflect a hiring need related to the assessment's description (e.g., "test for identifying high-potential graduates").
-
-Output ONLY the numbered list of queries in English. Do not add commentary. Ensure queries are distinct.
-
-Generated Queries:"""
-
-        response_text = call_llm(prompt)
-        if response_text:
-            generated_queries = parse_llm_query_response(response_text)
-            log.info(f"    LLM generated {len(generated_queries)} queries.")
+        solution_jobs.append((solution_name, core_chunk))
+    processed_solutions_for_queries = len(solution_jobs)
+
+    query_results = generate_queries_concurrently(solution_jobs, num_queries_per)
+    # Assemble in sorted solution order so output doesn't depend on completion order
+    for solution_name, core_chunk in solution_jobs:
+        generated_queries = query_results.get(solution_name)
+        if generated_queries is not None:
             generated_query_count += len(generated_queries)
             for query in generated_queries:
                 # Store with the core chunk for later negative selection context
@@ -382,22 +653,20 @@ Generated Queries:"""
         else:
             failed_query_gen += 1
             log.error(f"    Failed to generate queries for {solution_name} after retries.")
-        # Optional small delay
-        # time.sleep(0.5)
 
     log.info(f"Generated {len(query_target_pairs)} total synthetic query-solution pairs from {processed_solutions_for_queries} solutions.")
     if failed_query_gen > 0 : log.warning(f"Failed to generate queries for {failed_query_gen} solutions.")
 
-    log.info("Creating (Query, Positive, Negative) triplets...")
+    log.info("Selecting (Query, Positive) pairs...")
     skipped_query_triplets = 0
-    query_based_count = 0
+    query_candidates = [] # (anchor, positive_chunk, solution_name); negatives are assigned in one batch below
     for item in query_target_pairs:
         query = item['query']
         target_solution = item['solution_name']
         anchor_core_chunk = item['core_chunk'] # Use the core chunk associated with the query
 
         # Select Positive (English Only) from the target solution
-        pdf_chunks = get_pdf_chunks(target_solution, all_english_chunks)
+        pdf_chunks = get_pdf_chunks(target_solution, chunk_index)
         possible_positives = [anchor_core_chunk] + pdf_chunks # Core chunk is always a possibility
 
         if not possible_positives:
@@ -405,32 +674,12 @@ Generated Queries:"""
              skipped_query_triplets += 1
              continue
         positive_chunk = random.choice(possible_positives) # Randomly pick core or PDF chunk
-
-        # Select Negative (Relevant English Negative)
-        # Use test type from the *positive* chunk chosen for this triplet
-        positive_test_type = positive_chunk.get('metadata', {}).get('Test Type')
-        negative_chunk = get_relevant_negative_chunk(target_solution, positive_test_type, all_english_chunks)
-
-        if not negative_chunk:
-            log.warning(f"Could not find suitable English negative chunk for query '{query}' (target: {target_solution}). Skipping triplet.")
-            skipped_query_triplets += 1
-            continue
-
-        # Ensure all parts are strings before adding
-        triplets.append([
-            str(query),
-            str(positive_chunk['chunk_text']),
-            str(negative_chunk['chunk_text'])
-        ])
-        query_based_count += 1
-
-    log.info(f"Generated {query_based_count} query-based triplets. Skipped {skipped_query_triplets} due to missing positive/negative.")
+        query_candidates.append((str(query), positive_chunk, target_solution))
 
     # == 2. Generate Core-Info-Based Triplets (Anchor = Summarized Core) ==
-    log.info("Creating (Summarized Core, Positive Chunk, Negative) triplets...")
-    core_based_count = 0
-    skipped_core_triplets = 0
-    needed_core_based = max(0, target_count - len(triplets))
+    log.info("Selecting (Summarized Core, Positive Chunk) pairs...")
+    core_candidates = []
+    needed_core_based = max(0, target_count - len(query_candidates))
     if len(unique_solution_names) == 0:
         log.warning("No unique solutions found for core-based triplet generation.")
         target_per_solution = 0
@@ -443,11 +692,11 @@ Generated Queries:"""
     shuffled_solutions = random.sample(unique_solution_names, len(unique_solution_names))
 
     for solution_name in shuffled_solutions:
-        if len(triplets) >= target_count:
+        if len(query_candidates) + len(core_candidates) >= target_count:
              log.info("Target triplet count reached during core-based generation.")
              break
 
-        core_chunk = get_core_info_chunk(solution_name, all_english_chunks)
+        core_chunk = get_core_info_chunk(solution_name, chunk_index)
         if not core_chunk: continue # Need core chunk
 
         processed_solutions_for_core_triplets += 1
@@ -459,7 +708,7 @@ Generated Queries:"""
             continue # Skip if summarization failed
 
         # Potential positives: core chunk itself + its PDF chunks
-        pdf_chunks = get_pdf_chunks(solution_name, all_english_chunks)
+        pdf_chunks = get_pdf_chunks(solution_name, chunk_index)
         # Ensure core chunk itself is included as a potential positive
         possible_positives = [core_chunk] + pdf_chunks
         random.shuffle(possible_positives)
@@ -467,34 +716,37 @@ Generated Queries:"""
         added_for_solution = 0
         for positive_chunk in possible_positives:
             # Check overall target count inside the loop
-            if len(triplets) >= target_count:
+            if len(query_candidates) + len(core_candidates) >= target_count:
                  break
             # Check per-solution target count
             if added_for_solution >= target_per_solution and target_per_solution > 0:
                  break # Stop adding for this solution if target met
+            core_candidates.append((str(summarized_anchor), positive_chunk, solution_name))
+            added_for_solution += 1
 
-            # Select Negative (Relevant English Negative)
-            positive_test_type = positive_chunk.get('metadata', {}).get('Test Type')
-            negative_chunk = get_relevant_negative_chunk(solution_name, positive_test_type, all_english_chunks)
+    log.info(f"Processed {processed_solutions_for_core_triplets} solutions for core-based triplets.")
 
+    # == 3. Select Negatives (mined in batch, or random same-type) ==
+    miner = HardNegativeMiner(chunk_index.all_chunks) if HARD_NEGATIVE_MINING else None
+    for label, candidates, skipped in (
+        ("query-based", query_candidates, skipped_query_triplets),
+        ("core-info-based", core_candidates, 0),
+    ):
+        negatives = select_negatives(candidates, chunk_index, miner)
+        added = 0
+        for (anchor, positive_chunk, solution_name), negative_chunk in zip(candidates, negatives):
             if not negative_chunk:
-                log.debug(f"Could not find negative for core-based triplet {solution_name}. Skipping.")
-                skipped_core_triplets += 1
-                continue # Skip this specific triplet
-
-            # Ensure all parts are strings
+                log.debug(f"Could not find suitable English negative chunk for anchor '{anchor[:80]}' (target: {solution_name}). Skipping triplet.")
+                skipped += 1
+                continue
+            # Ensure all parts are strings before adding
             triplets.append([
-                str(summarized_anchor),
+                anchor,
                 str(positive_chunk['chunk_text']),
                 str(negative_chunk['chunk_text'])
             ])
-            core_based_count += 1
-            added_for_solution += 1
-
-        # log.debug(f"  Added {added_for_solution} core-based triplets for {solution_name}")
-
-    log.info(f"Processed {processed_solutions_for_core_triplets} solutions for core-based triplets.")
-    log.info(f"Generated {core_based_count} core-info-based triplets. Skipped {skipped_core_triplets} due to missing negatives.")
+            added += 1
+        log.info(f"Generated {added} {label} triplets. Skipped {skipped} due to missing positive/negative.")
     log.info(f"Total triplets generated: {len(triplets)}")
 
     # Shuffle the final list
@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+"""
+HTTP load generator for the recommendation API.
+
+Drives a weighted mix of endpoints (/recommend, /recommend_raw, and any batch
+endpoint that takes a list of queries) with a weighted mix of queries, either:
+
+- closed loop (LOADGEN_ARRIVAL_RATE=0): LOADGEN_CONCURRENCY workers each send the
+  next request as soon as the previous one returns, or
+- open loop (LOADGEN_ARRIVAL_RATE > 0): requests arrive as a Poisson process at the
+  given rate and are served by up to LOADGEN_CONCURRENCY in-flight requests. Latency
+  is measured from the scheduled arrival time, so queueing behind a slow server is
+  counted instead of hidden.
+
+Reports throughput, error rate (by status) and latency percentiles and histograms,
+overall and per endpoint, and saves them as JSON. To test offline, run the API with
+LLM_BACKEND=fake (and FAKE_LLM_LATENCY_MS to simulate Gemini) against a local DB:
+
+    LLM_BACKEND=fake uvicorn src.api:app --port 8080
+    python load_test_api.py
+"""
+
+import bisect
+import json
+import logging
+import math
+import os
+import random
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import requests
+
+# --- Configuration ---
+BASE_URL = os.getenv("LOADGEN_BASE_URL", "http://127.0.0.1:8080").rstrip("/") # Port used by the README and Dockerfile.api
+# Endpoint mix as "path:weight,...". Paths listed in LOADGEN_BATCH_ENDPOINTS get {"queries": [...]}, others {"query": ...}.
+ENDPOINTS = os.getenv("LOADGEN_ENDPOINTS", "/recommend:1,/recommend_raw:1")
+BATCH_ENDPOINTS = {p.strip() for p in os.getenv("LOADGEN_BATCH_ENDPOINTS", "").split(",") if p.strip()}
+BATCH_SIZE = int(os.getenv("LOADGEN_BATCH_SIZE", "8"))
+# JSON Lines with a "query" and an optional "weight" per line (the benchmark query set by default)
+QUERIES_FILE = Path(os.getenv("LOADGEN_QUERIES_FILE", "benchmark_queries.jsonl"))
+CONCURRENCY = int(os.getenv("LOADGEN_CONCURRENCY", "10")) # Max in-flight requests
+ARRIVAL_RATE = float(os.getenv("LOADGEN_ARRIVAL_RATE", "0")) # Requests/second; 0 = closed loop
+DURATION_SECONDS = float(os.getenv("LOADGEN_DURATION_SECONDS", "60"))
+WARMUP_SECONDS = float(os.getenv("LOADGEN_WARMUP_SECONDS", "5")) # Requests started before this are not counted
+REQUEST_TIMEOUT_SECONDS = float(os.getenv("LOADGEN_TIMEOUT_SECONDS", "90"))
+SEED = int(os.getenv("LOADGEN_SEED", "0"))
+RESULTS_DIR = Path("load_test_results")
+
+# Histogram bucket upper bounds (ms); roughly log-spaced
+HISTOGRAM_BUCKETS_MS = [25, 50, 100, 250, 500, 750, 1000, 1500, 2000, 3000, 5000, 7500, 10000, 20000, 30000, 60000]
+
+# --- Setup Logging ---
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+log = logging.getLogger(__name__)
+logging.getLogger("urllib3").setLevel(logging.WARNING)
+
+# --- Workload ---
+def parse_weighted(spec: str) -> List[Tuple[str, float]]:
+    """Parses "a:2,b:1" (weight defaults to 1)."""
+    items = []
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        name, sep, weight = part.rpartition(":")
+        if sep and weight.replace(".", "", 1).isdigit():
+            items.append((name, float(weight)))
+        else:
+            items.append((part, 1.0))
+    return items
+
+def load_queries(path: Path) -> List[Tuple[str, float]]:
+    queries = []
+    with path.open("r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                queries.append((record["query"], float(record.get("weight", 1))))
+    log.info(f"Loaded {len(queries)} queries from {path}.")
+    return queries
+
+class Workload:
+    """Draws (endpoint, payload) pairs from the weighted endpoint and query mixes. Thread-safe."""
+
+    def __init__(self, endpoints: List[Tuple[str, float]], queries: List[Tuple[str, float]], seed: int):
+        self.endpoints, self.endpoint_weights = zip(*endpoints)
+        self.queries, self.query_weights = zip(*queries)
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def next_request(self) -> Tuple[str, Dict]:
+        with self._lock:
+            endpoint = self._rng.choices(self.endpoints, self.endpoint_weights)[0]
+            if endpoint in BATCH_ENDPOINTS:
+                return endpoint, {"queries": self._rng.choices(self.queries, self.query_weights, k=BATCH_SIZE)}
+            return endpoint, {"query": self._rng.choices(self.queries, self.query_weights)[0]}
+
+    def next_interarrival(self) -> float:
+        with self._lock:
+            return self._rng.expovariate(ARRIVAL_RATE)
+
+# --- Results ---
+class LatencyRecorder:
+    """Collects per-request outcomes. Thread-safe."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies_ms: Dict[str, List[float]] = defaultdict(list)
+        self.statuses: Dict[str, Counter] = defaultdict(Counter)
+
+    def record(self, endpoint: str, status: str, latency_ms: float):
+        with self._lock:
+            self.statuses[endpoint][status] += 1
+            if status == "200":
+                self.latencies_ms[endpoint].append(latency_ms)
+
+def percentile(values: List[float], pct: float) -> float:
+    """Nearest-rank percentile of pre-sorted values."""
+    if not values:
+        return float("nan")
+    return values[max(0, math.ceil(pct / 100 * len(values)) - 1)]
+
+def histogram(values: List[float]) -> Dict[str, int]:
+    counts = [0] * (len(HISTOGRAM_BUCKETS_MS) + 1)
+    for value in values:
+        counts[bisect.bisect_left(HISTOGRAM_BUCKETS_MS, value)] += 1
+    labels = [f"<={bound}" for bound in HISTOGRAM_BUCKETS_MS] + [f">{HISTOGRAM_BUCKETS_MS[-1]}"]
+    return dict(zip(labels, counts))
+
+def summarize(latencies: List[float], statuses: Counter, elapsed: float) -> Dict:
+    latencies = sorted(latencies)
+    total = sum(statuses.values())
+    errors = total - statuses.get("200", 0)
+    return {
+        "requests": total,
+        "throughput_rps": statuses.get("200", 0) / elapsed if elapsed else 0.0,
+        "error_rate": errors / total if total else 0.0,
+        "statuses": dict(statuses),
+        "latency_ms": {
+            "p50": percentile(latencies, 50), "p90": percentile(latencies, 90), "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99), "max": latencies[-1] if latencies else float("nan"),
+            "mean": sum(latencies) / len(latencies) if latencies else float("nan"),
+        },
+        "histogram_ms": histogram(latencies),
+    }
+
+# --- Load Generation ---
+_sessions = threading.local()
+
+def get_session() -> requests.Session:
+    """One keep-alive session per worker thread (requests.Session isn't thread-safe)."""
+    if not hasattr(_sessions, "session"):
+        _sessions.session = requests.Session()
+    return _sessions.session
+
+def send_request(endpoint: str, payload: Dict, scheduled_at: float, measure_from: float, recorder: LatencyRecorder):
+    """Sends one request; latency is measured from `scheduled_at` (arrival time in open-loop mode)."""
+    try:
+        response = get_session().post(BASE_URL + endpoint, json=payload, timeout=REQUEST_TIMEOUT_SECONDS)
+        status = str(response.status_code)
+    except requests.exceptions.Timeout:
+        status = "timeout"
+    except requests.exceptions.RequestException as e:
+        status = f"error:{type(e).__name__}"
+    latency_ms = (time.perf_counter() - scheduled_at) * 1000
+    if scheduled_at >= measure_from:
+        recorder.record(endpoint, status, latency_ms)
+
+def run_closed_loop(workload: Workload, recorder: LatencyRecorder, measure_from: float, stop_at: float):
+    def worker():
+        while time.perf_counter() < stop_at:
+            endpoint, payload = workload.next_request()
+            send_request(endpoint, payload, time.perf_counter(), measure_from, recorder)
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(CONCURRENCY)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+def run_open_loop(workload: Workload, recorder: LatencyRecorder, measure_from: float, stop_at: float) -> int:
+    """Schedules Poisson arrivals. Returns how many arrivals found every worker busy (server falling behind)."""
+    backlogged = 0
+    in_flight = threading.Semaphore(CONCURRENCY)
+
+    def run(endpoint: str, payload: Dict, scheduled_at: float):
+        try:
+            send_request(endpoint, payload, scheduled_at, measure_from, recorder)
+        finally:
+            in_flight.release()
+
+    with ThreadPoolExecutor(max_workers=CONCURRENCY) as executor:
+        next_arrival = time.perf_counter()
+        while next_arrival < stop_at:
+            delay = next_arrival - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            if not in_flight.acquire(blocking=False):
+                backlogged += 1
+                in_flight.acquire() # Wait; the queueing delay is charged to this request's latency
+            endpoint, payload = workload.next_request()
+            executor.submit(run, endpoint, payload, next_arrival)
+            next_arrival += workload.next_interarrival()
+    return backlogged
+
+# --- Reporting ---
+def log_summary(name: str, summary: Dict):
+    latency = summary["latency_ms"]
+    log.info(f"[{name}] {summary['requests']} requests, {summary['throughput_rps']:.2f} req/s, "
+             f"error rate {summary['error_rate']:.2%} {summary['statuses']}")
+    log.info(f"[{name}] latency ms: p50 {latency['p50']:.0f} | p90 {latency['p90']:.0f} | p95 {latency['p95']:.0f} | "
+             f"p99 {latency['p99']:.0f} | max {latency['max']:.0f} | mean {latency['mean']:.0f}")
+    peak = max(summary["histogram_ms"].values()) or 1
+    for label, count in summary["histogram_ms"].items():
+        if count:
+            log.info(f"[{name}]   {label:>8s} ms {count:7d} {'#' * max(1, round(40 * count / peak))}")
+
+# --- Main Execution ---
+def main() -> int:
+    endpoints = parse_weighted(ENDPOINTS)
+    queries = load_queries(QUERIES_FILE)
+    if not endpoints or not queries:
+        log.error("Need at least one endpoint and one query.")
+        return 1
+    workload = Workload(endpoints, queries, SEED)
+    recorder = LatencyRecorder()
+
+    mode = f"open loop at {ARRIVAL_RATE:.2f} req/s" if ARRIVAL_RATE > 0 else "closed loop"
+    log.info(f"Load testing {BASE_URL} ({mode}, concurrency {CONCURRENCY}, {DURATION_SECONDS:.0f}s + {WARMUP_SECONDS:.0f}s warm-up).")
+    log.info(f"Endpoint mix: {endpoints}")
+    start = time.perf_counter()
+    measure_from = start + WARMUP_SECONDS
+    stop_at = measure_from + DURATION_SECONDS
+    backlogged = 0
+    if ARRIVAL_RATE > 0:
+        backlogged = run_open_loop(workload, recorder, measure_from, stop_at)
+    else:
+        run_closed_loop(workload, recorder, measure_from, stop_at)
+    elapsed = time.perf_counter() - measure_from # Includes draining requests still in flight at stop_at
+
+    all_latencies = [value for values in recorder.latencies_ms.values() for value in values]
+    all_statuses = sum(recorder.statuses.values(), Counter())
+    results = {
+        "run_at": datetime.now().isoformat(timespec="seconds"),
+        "base_url": BASE_URL,
+        "mode": "open" if ARRIVAL_RATE > 0 else "closed",
+        "arrival_rate": ARRIVAL_RATE,
+        "concurrency": CONCURRENCY,
+        "duration_seconds": DURATION_SECONDS,
+        "endpoints": dict(endpoints),
+        "backlogged_arrivals": backlogged,
+        "overall": summarize(all_latencies, all_statuses, elapsed),
+        "per_endpoint": {
+            endpoint: summarize(recorder.latencies_ms[endpoint], recorder.statuses[endpoint], elapsed)
+            for endpoint in recorder.statuses
+        },
+    }
+
+    log.info("--- Load Test Results ---")
+    log_summary("overall", results["overall"])
+    for endpoint, summary in results["per_endpoint"].items():
+        log_summary(endpoint, summary)
+    if backlogged:
+        log.warning(f"{backlogged} arrivals waited for a free slot; the server could not keep up with {ARRIVAL_RATE:.2f} req/s at concurrency {CONCURRENCY}.")
+
+    RESULTS_DIR.mkdir(parents=True, exist_ok=True)
+    output_path = RESULTS_DIR / f"{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+    with output_path.open("w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    log.info(f"Saved load test results to {output_path}.")
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
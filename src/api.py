@@ -1,17 +1,41 @@
+import time
+_import_start_time = time.perf_counter() # Measures the module import phase of a cold start
 import logging
 import os # Added import
+import threading
 from fastapi import FastAPI, HTTPException, Request, status
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel, Field
 from contextlib import asynccontextmanager
 import uvicorn
-import time
 from typing import List, Dict, Optional, Any # Added Any for broader type hinting
 
 # Import project modules
 from . import config
 from . import retriever
 from . import rag_pipeline
+from . import metrics
+
+# --- Startup State ---
+# Durations (seconds) of each startup phase, reported by /_ah/ready for cold-start tuning.
+startup_timings: Dict[str, float] = {"module_import": time.perf_counter() - _import_start_time}
+startup_complete = threading.Event() # Set once the startup loader has finished (successfully or not)
+startup_error: Optional[str] = None
+# State of each component readiness depends on. Set by initialize_resources; the DB
+# pool entry is refreshed by live checks (see check_components). Written from the startup
+# thread and threadpool workers, so read and write it only through the helpers below.
+component_status: Dict[str, bool] = {
+    "config_valid": config.IS_CONFIG_VALID,
+    "model_loaded": False,
+    "model_warmed": False,
+    "db_pool": False,
+    "index_ready": False,
+}
+_component_status_lock = threading.Lock()
+DB_HEALTH_CHECK_INTERVAL_SECONDS = 10 # Re-ping the DB at most this often from readiness probes
+_last_db_check_time = 0.0
+_db_check_lock = threading.Lock() # One live DB re-check at a time; concurrent probes use the last result
 
 # --- Setup Logging ---
 # Configure logging for FastAPI/Uvicorn if needed, or rely on RAG pipeline logging
@@ -20,6 +44,7 @@ log = logging.getLogger(__name__) # Use the same logger or configure FastAPI's
 # --- Pydantic Models ---
 class HealthResponse(BaseModel):
     status: str = "healthy"
+    components: Optional[Dict[str, bool]] = Field(None, description="Readiness of each component (model, warm-up, DB pool, index).")
 
 class RecommendRequest(BaseModel):
     query: str = Field(..., description="Job description or natural language query for assessment recommendations.")
@@ -40,30 +65,118 @@ class RecommendResponse(BaseModel):
     )
 
 
-# --- FastAPI Lifecycle Events ---
-@asynccontextmanager
-async def lifespan(app: FastAPI):
-    # Startup logic
-    log.info("API Startup: Initializing resources...")
-    start_time = time.time()
+# --- Component Status ---
+def set_component_status(**updates: bool):
+    """Updates one or more component_status entries atomically."""
+    with _component_status_lock:
+        component_status.update(updates)
+
+def get_component_status() -> Dict[str, bool]:
+    """Consistent snapshot of component_status."""
+    with _component_status_lock:
+        return dict(component_status)
+
+# --- Startup Loading ---
+def _timed_phase(name: str, func):
+    """Runs one startup phase and records its duration in startup_timings."""
+    phase_start = time.perf_counter()
+    result = func()
+    startup_timings[name] = time.perf_counter() - phase_start
+    log.info(f"Startup phase '{name}' finished in {startup_timings[name]:.2f} seconds.")
+    return result
+
+def initialize_resources():
+    """
+    Loads the embedding model and DB connection pool, then warms both up,
+    recording each phase. Runs inline in eager mode, or on a background
+    thread in background mode. Readiness is only reported once every
+    component in component_status is up.
+    """
+    global startup_error
+    start_time = time.perf_counter()
     try:
         if not config.IS_CONFIG_VALID:
-             log.error("API cannot start due to invalid configuration. Check logs.")
-             # This won't actually stop FastAPI startup here, but logs the error.
-             # Consider raising an exception if startup should halt.
-        else:
-             log.info("Loading embedding model...")
-             retriever.load_embedding_model()
-             log.info("Initializing database connection pool...")
-             retriever.init_connection_pool()
-             log.info("RAG pipeline dependencies initialized.")
-        end_time = time.time()
-        log.info(f"API Startup complete in {end_time - start_time:.2f} seconds.")
+            startup_error = "Invalid configuration"
+            log.error("API cannot start due to invalid configuration. Check logs.")
+            return
+        _timed_phase("import_model_libraries", retriever.import_model_libraries)
+        log.info("Loading embedding model...")
+        _timed_phase("load_embedding_model", retriever.load_embedding_model)
+        set_component_status(model_loaded=retriever.is_model_loaded())
+        log.info("Warming up embedding model...")
+        set_component_status(model_warmed=_timed_phase("warm_up_model", retriever.warm_up_model))
+        log.info("Initializing database connection pool...")
+        _timed_phase("init_connection_pool", retriever.init_connection_pool)
+        set_component_status(db_pool=retriever.check_db_health())
+        log.info("Loading chunk store...")
+        _timed_phase("load_chunk_store", retriever.load_chunk_store)
+        log.info("Warming up vector index...")
+        set_component_status(index_ready=_timed_phase("warm_up_index", retriever.warm_up_index))
+        startup_timings["total_load"] = time.perf_counter() - start_time
+
+        not_ready = [name for name, ok in get_component_status().items() if not ok]
+        if not_ready:
+            startup_error = f"Components not ready: {', '.join(not_ready)}"
+            log.error(f"API Startup incomplete. {startup_error}")
+            return
+        log.info(f"RAG pipeline dependencies initialized in {startup_timings['total_load']:.2f} seconds.")
     except Exception as e:
+        startup_error = str(e)
         log.exception(f"API Startup failed: {e}")
+    finally:
+        startup_complete.set()
+
+def check_components() -> Dict[str, bool]:
+    """
+    Returns the current component status. The DB pool is re-checked with a
+    live query at most every DB_HEALTH_CHECK_INTERVAL_SECONDS, so an instance
+    whose database goes away stops reporting ready (and recovers, re-warming
+    the index, once it comes back). Blocking; call from a thread.
+    """
+    global _last_db_check_time
+    set_component_status(model_loaded=retriever.is_model_loaded())
+    if startup_complete.is_set() and retriever.db_connection_pool and _db_check_lock.acquire(blocking=False):
+        try:
+            now = time.monotonic()
+            if now - _last_db_check_time >= DB_HEALTH_CHECK_INTERVAL_SECONDS:
+                _last_db_check_time = now
+                db_ok = retriever.check_db_health()
+                if not db_ok:
+                    # The index has to be re-warmed once the database comes back
+                    set_component_status(db_pool=False, index_ready=False)
+                else:
+                    set_component_status(db_pool=True)
+                    current = get_component_status()
+                    if current["model_warmed"] and not current["index_ready"]:
+                        set_component_status(index_ready=retriever.warm_up_index())
+        finally:
+            _db_check_lock.release()
+    return get_component_status()
+
+def is_ready(components: Dict[str, bool]) -> bool:
+    """True if the startup loader finished and every component is up."""
+    return startup_complete.is_set() and all(components.values())
+
+def require_ready():
+    """Raises 503 while startup is still loading (or failed) so clients can retry elsewhere."""
+    if not is_ready(get_component_status()):
+        detail = f"Service is not ready: {startup_error}" if startup_error else "Service is warming up. Please retry shortly."
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=detail)
+
+# --- FastAPI Lifecycle Events ---
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Startup logic
+    log.info(f"API Startup: Initializing resources (mode: {config.STARTUP_MODE})...")
+    if config.STARTUP_MODE == "background":
+        # Start serving immediately; /_ah/ready reports 503 until the loader thread finishes.
+        threading.Thread(target=initialize_resources, name="startup-loader", daemon=True).start()
+    else:
         # Depending on severity, you might want the app to not start.
         # FastAPI doesn't have a direct way to halt startup from lifespan errors,
-        # but subsequent requests will likely fail if resources aren't ready.
+        # but subsequent requests will be rejected with 503 if resources aren't ready.
+        initialize_resources()
+        log.info(f"API Startup complete. Phase timings: {startup_timings}")
     yield
     # Shutdown logic
     log.info("API Shutdown: Cleaning up resources...")
@@ -78,6 +191,28 @@ app = FastAPI(
     lifespan=lifespan # Use the lifespan context manager
 )
 
+# --- Metrics ---
+# Pool gauges are read from retriever.get_pool_stats() when /metrics is scraped
+metrics.register_pool_collector(retriever.get_pool_stats)
+# Only these paths get their own label; anything else is grouped to keep label cardinality bounded
+METRICS_ENDPOINTS = {"/recommend", "/recommend_raw", "/health", "/_ah/live", "/_ah/ready"}
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    start_time = time.perf_counter()
+    status_code = 500 # Reported if the handler raises past the exception handlers
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+        return response
+    finally:
+        path = request.url.path
+        if path != "/metrics":
+            metrics.REQUEST_DURATION.labels(
+                endpoint=path if path in METRICS_ENDPOINTS else "other",
+                status=str(status_code),
+            ).observe(time.perf_counter() - start_time)
+
 # --- API Endpoints ---
 
 @app.get(
@@ -85,13 +220,22 @@ app = FastAPI(
     response_model=HealthResponse,
     tags=["Status"],
     summary="Health Check",
-    description="Provides a simple status check to verify the API is running and healthy."
+    description="Reports whether the model is loaded and warmed up and the database pool and index are usable. Returns 503 if any component is down."
 )
 async def health_check():
-    """Returns a status message indicating the API is healthy."""
-    # Could add checks here for DB connection, model loading status etc.
-    # For now, just confirms the API endpoint is reachable.
-    return HealthResponse(status="healthy")
+    """Returns 'healthy' with per-component status, or 503 'unhealthy' if any component is down."""
+    components = await run_in_threadpool(check_components)
+    if not is_ready(components):
+        return JSONResponse(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            content={"status": "unhealthy", "components": components}
+        )
+    return HealthResponse(status="healthy", components=components)
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics_endpoint():
+    """Prometheus scrape endpoint: request/stage latency histograms, pipeline counters and DB pool gauges."""
+    return Response(content=metrics.render_latest(), media_type=metrics.CONTENT_TYPE_LATEST)
 
 @app.get("/_ah/live", include_in_schema=False)
 async def live_check():
@@ -100,9 +244,22 @@ async def live_check():
 
 @app.get("/_ah/ready", include_in_schema=False)
 async def ready_check():
-    """App Engine Flex readiness check."""
-    # You could add more complex checks here if needed, e.g., DB connectivity
-    return JSONResponse(content={"status": "ok"})
+    """
+    App Engine Flex / Cloud Run readiness check. Returns 503 until the model is
+    loaded and warmed up and the DB pool and index respond.
+    """
+    components = await run_in_threadpool(check_components)
+    if not is_ready(components):
+        return JSONResponse(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            content={
+                "status": "error" if startup_error else "starting",
+                "error": startup_error,
+                "components": components,
+                "timings": startup_timings,
+            }
+        )
+    return JSONResponse(content={"status": "ok", "components": components, "timings": startup_timings})
 
 
 @app.post(
@@ -126,10 +283,11 @@ async def recommend_assessments(request: RecommendRequest):
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Server configuration is invalid. Please check server logs."
         )
+    require_ready()
 
     try:
-        # Call the RAG pipeline
-        result = rag_pipeline.get_recommendations(request.query)
+        # Call the RAG pipeline in the threadpool so the event loop keeps serving other requests
+        result = await run_in_threadpool(rag_pipeline.get_recommendations, request.query)
 
         if result is None:
             # This indicates an internal error during the RAG process
@@ -180,10 +338,11 @@ async def recommend_assessments_raw(request: RecommendRequest) -> Dict[str, Any]
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Server configuration is invalid. Please check server logs."
         )
+    require_ready()
 
     try:
-        # Call the RAG pipeline
-        result = rag_pipeline.get_recommendations(request.query)
+        # Call the RAG pipeline in the threadpool so the event loop keeps serving other requests
+        result = await run_in_threadpool(rag_pipeline.get_recommendations, request.query)
 
         if result is None:
             # This indicates an internal error during the RAG process
@@ -0,0 +1,113 @@
+import gzip
+import io
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, Optional, Union
+
+# orjson parses/serializes JSON several times faster than the stdlib; fall back when absent.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+log = logging.getLogger(__name__)
+
+PathLike = Union[str, Path]
+
+# --- JSON ---
+def loads(line: Union[str, bytes]) -> Dict:
+    """Parses one JSON line (orjson when installed)."""
+    if orjson is not None:
+        return orjson.loads(line)
+    return json.loads(line)
+
+def dumps(record: Dict) -> bytes:
+    """Serializes one record to a JSON line (UTF-8 bytes, trailing newline)."""
+    if orjson is not None:
+        return orjson.dumps(record, option=orjson.OPT_APPEND_NEWLINE | orjson.OPT_SERIALIZE_NUMPY)
+    return (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+
+# --- File Handles ---
+def _open_binary(path: Path, mode: str):
+    """Opens `path` in binary mode, compressing by suffix: .gz (gzip) or .zst (zstandard, optional)."""
+    if path.suffix == ".gz":
+        return gzip.open(path, mode + "b")
+    if path.suffix == ".zst":
+        import zstandard # Optional dependency, only needed for .zst corpora
+        if mode == "r":
+            return zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True)
+        return zstandard.ZstdCompressor().stream_writer(open(path, "wb"), closefd=True)
+    return open(path, mode + "b")
+
+# --- Reading ---
+def iter_chunks(path: PathLike, stats: Optional[Dict[str, int]] = None) -> Iterator[Dict]:
+    """
+    Yields one record per line of a (optionally compressed) JSON Lines chunk corpus.
+
+    Lines that are blank, not valid JSON or not JSON objects are logged and skipped.
+    If `stats` is given, 'lines_read' and 'invalid_json' counts are accumulated into it.
+    Raises FileNotFoundError if the file doesn't exist.
+    """
+    path = Path(path)
+    counts = stats if stats is not None else {}
+    counts.setdefault("lines_read", 0)
+    counts.setdefault("invalid_json", 0)
+    with _open_binary(path, "r") as raw:
+        for line in io.BufferedReader(raw) if path.suffix == ".zst" else raw:
+            counts["lines_read"] += 1
+            if not line.strip():
+                continue
+            try:
+                record = loads(line)
+            except ValueError: # json.JSONDecodeError and orjson.JSONDecodeError both subclass ValueError
+                counts["invalid_json"] += 1
+                log.warning(f"Skipping invalid JSON on line {counts['lines_read']} of {path}: {line[:200]!r}")
+                continue
+            if not isinstance(record, dict):
+                counts["invalid_json"] += 1
+                log.warning(f"Skipping non-object JSON on line {counts['lines_read']} of {path}.")
+                continue
+            yield record
+
+# --- Writing ---
+class ChunkCorpusWriter:
+    """
+    Streams records to a (optionally compressed) JSON Lines file.
+
+    Writes go to a temporary file that replaces `path` only when the writer is closed
+    without an error, so readers never see a half-written corpus.
+
+        with ChunkCorpusWriter(output_path) as writer:
+            for record in records:
+                writer.write(record)
+    """
+
+    def __init__(self, path: PathLike):
+        self.path = Path(path)
+        self.tmp_path = self.path.with_name(f"{self.path.name}.tmp{self.path.suffix if self.path.suffix in ('.gz', '.zst') else ''}")
+        self.count = 0
+        self._file = None
+
+    def __enter__(self) -> "ChunkCorpusWriter":
+        self._file = _open_binary(self.tmp_path, "w")
+        return self
+
+    def write(self, record: Dict):
+        self._file.write(dumps(record))
+        self.count += 1
+
+    def write_all(self, records: Iterable[Dict]) -> int:
+        """Writes every record from an iterable. Returns how many were written."""
+        for record in records:
+            self.write(record)
+        return self.count
+
+    def __exit__(self, exc_type, exc, tb):
+        self._file.close()
+        if exc_type is None:
+            os.replace(self.tmp_path, self.path)
+        else:
+            self.tmp_path.unlink(missing_ok=True)
+        return False
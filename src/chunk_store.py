@@ -0,0 +1,102 @@
+import logging
+import threading
+import time
+from typing import Dict, Iterable, List, Optional
+
+from psycopg2 import sql
+
+from . import metrics
+
+log = logging.getLogger(__name__)
+
+# Metadata keys the pipeline and prompt actually read (prompt_templates.format_context_for_prompt
+# plus the keys chunk_data writes for the same facts). Everything else (languages lists,
+# PDF filenames, chunk indexes) is dropped when chunks are stored.
+PROMPT_METADATA_FIELDS = (
+    "solution_name",
+    "url", "detail_url",
+    "adaptive_support", "adaptive_irt",
+    "remote_support", "remote_testing",
+    "duration", "assessment_length",
+    "test_type",
+    "job_levels",
+    "description",
+    "source_type",
+)
+
+def project_metadata(metadata: Optional[Dict]) -> Dict:
+    """Trims a chunk's metadata to PROMPT_METADATA_FIELDS."""
+    if not metadata:
+        return {}
+    return {key: metadata[key] for key in PROMPT_METADATA_FIELDS if key in metadata}
+
+class ChunkStore:
+    """
+    In-process copy of chunk texts and trimmed metadata keyed by chunk_id.
+
+    The similarity query only returns (chunk_id, distance); hits are hydrated
+    from here so chunk text and JSONB metadata are read and decoded once at
+    startup instead of on every request. Chunks missing from the store (e.g.
+    rows ingested after startup) are fetched from the DB in one query and cached.
+    """
+
+    def __init__(self):
+        self._chunks: Dict[str, Dict] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._chunks)
+
+    def load_from_db(self, conn, table: sql.Composable, fetch_size: int = 2000) -> int:
+        """Loads every chunk from `table` using a server-side cursor. Returns the number loaded."""
+        start_time = time.time()
+        loaded: Dict[str, Dict] = {}
+        with conn.cursor(name="chunk_store_load") as cur:
+            cur.itersize = fetch_size
+            cur.execute(sql.SQL("SELECT chunk_id, chunk_text, metadata FROM {table};").format(table=table))
+            for chunk_id, chunk_text, metadata in cur:
+                loaded[chunk_id] = {"chunk_text": chunk_text, "metadata": project_metadata(metadata)}
+        conn.rollback() # Close the read transaction opened by the named cursor
+        with self._lock:
+            self._chunks = loaded
+        log.info(f"Chunk store loaded {len(loaded)} chunks in {time.time() - start_time:.2f} seconds.")
+        return len(loaded)
+
+    def fetch_missing(self, conn, table: sql.Composable, chunk_ids: Iterable[str]):
+        """Fetches chunks not yet in the store from `table` and caches them."""
+        chunk_ids = list(chunk_ids)
+        missing = [chunk_id for chunk_id in chunk_ids if chunk_id not in self._chunks]
+        metrics.CHUNK_STORE_LOOKUPS.labels(result="hit").inc(len(chunk_ids) - len(missing))
+        metrics.CHUNK_STORE_LOOKUPS.labels(result="miss").inc(len(missing))
+        if not missing:
+            return
+        with conn.cursor() as cur:
+            cur.execute(
+                sql.SQL("SELECT chunk_id, chunk_text, metadata FROM {table} WHERE chunk_id = ANY(%s);").format(table=table),
+                (missing,)
+            )
+            rows = cur.fetchall()
+        with self._lock:
+            for chunk_id, chunk_text, metadata in rows:
+                self._chunks[chunk_id] = {"chunk_text": chunk_text, "metadata": project_metadata(metadata)}
+        log.info(f"Chunk store fetched {len(rows)} of {len(missing)} missing chunks from the DB.")
+
+    def hydrate(self, hits: List[Dict]) -> List[Dict]:
+        """
+        Turns [{chunk_id, distance}] hits into full chunk dicts
+        ({chunk_id, chunk_text, metadata, distance}), in hit order.
+        Hits whose chunk is unknown are dropped.
+        """
+        hydrated = []
+        for hit in hits:
+            chunk = self._chunks.get(hit["chunk_id"])
+            if chunk is None:
+                log.warning(f"Chunk '{hit['chunk_id']}' not found in chunk store. Skipping.")
+                continue
+            hydrated.append({
+                "chunk_id": hit["chunk_id"],
+                "chunk_text": chunk["chunk_text"],
+                "metadata": chunk["metadata"],
+                "distance": hit["distance"],
+            })
+        return hydrated
@@ -2,31 +2,46 @@ import os
 from pathlib import Path
 from dotenv import load_dotenv, find_dotenv # Import find_dotenv
 
-# Define project root relative to this file
-project_root = Path(__file__).parent.parent
+from .paths import MODEL_PATH, project_root # Path to the fine-tuned sentence transformer model
 
 # --- Environment Variable Loading ---
 # Attempt to load .env file for local development using find_dotenv.
 # In App Engine, variables are injected directly and os.getenv below will read them.
-dotenv_path = find_dotenv()
-if dotenv_path:
-    print(f"Attempting to load environment variables from: {dotenv_path}")
-    load_dotenv(dotenv_path=dotenv_path)
-else:
-    print("No .env file found, relying on system environment variables (or App Engine injected variables).")
+# On Cloud Run (K_SERVICE is set) variables are always injected, so skip the filesystem walk.
+if os.getenv("K_SERVICE") is None:
+    dotenv_path = find_dotenv()
+    if dotenv_path:
+        print(f"Attempting to load environment variables from: {dotenv_path}")
+        load_dotenv(dotenv_path=dotenv_path)
+    else:
+        print("No .env file found, relying on system environment variables (or App Engine injected variables).")
 
 
 # --- Model Configuration ---
-# Path to the fine-tuned sentence transformer model
-MODEL_PATH = project_root / "shl_finetuned_mpnet_model_H100"
 # Dimension of the embeddings generated by the model
 EMBEDDING_DIMENSION = 768 # From create_store_embeddings.py
+# Inference backend for the query encoder: "torch" (SentenceTransformer) or "onnx" (ONNX Runtime, CPU)
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch").lower()
+# Directory and file produced by export_onnx_model.py (int8 dynamically quantized graph)
+ONNX_MODEL_DIR = MODEL_PATH / "onnx"
+ONNX_MODEL_FILE = os.getenv("ONNX_MODEL_FILE", "model_quantized.onnx")
+# Intra-op threads for ONNX Runtime (0 lets ORT pick based on available cores)
+ONNX_INTRA_OP_THREADS = int(os.getenv("ONNX_INTRA_OP_THREADS", "0"))
 
 # --- Gemini Configuration ---
 # Ensure GEMINI_API_KEY is set in your .env file or app.yaml
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 GEMINI_MODEL_NAME = "gemini-1.5-flash-latest" # Or specific flash version if needed
 
+# --- LLM Backend ---
+# "gemini" (default) or "fake": a local stand-in that answers from retrieved metadata
+# without network calls or quota, for load tests and CI (see src/llm_backend.py).
+LLM_BACKEND = os.getenv("LLM_BACKEND", "gemini").lower()
+FAKE_LLM_LATENCY_MS = float(os.getenv("FAKE_LLM_LATENCY_MS", "0")) # Simulated latency per call
+FAKE_LLM_LATENCY_JITTER_MS = float(os.getenv("FAKE_LLM_LATENCY_JITTER_MS", "0")) # Uniform +/- jitter
+FAKE_LLM_ERROR_RATE = float(os.getenv("FAKE_LLM_ERROR_RATE", "0")) # Fraction of calls that fail (0-1)
+FAKE_LLM_SEED = int(os.getenv("FAKE_LLM_SEED", "0"))
+
 # --- Database Configuration (Fetched from environment) ---
 DB_NAME = os.getenv("DB_NAME")
 DB_USER = os.getenv("DB_USER")
@@ -38,6 +53,17 @@ DB_TABLE_NAME = "shl_embeddings"           # Table created by create_store_embed
 # e.g., "your-project:your-region:your-instance"
 CLOUD_SQL_INSTANCE_CONNECTION_NAME = os.getenv("CLOUD_SQL_INSTANCE_CONNECTION_NAME")
 
+# --- Database Pool Configuration ---
+# Requests one API worker serves concurrently (match Cloud Run --concurrency / threadpool size).
+API_WORKER_CONCURRENCY = int(os.getenv("API_WORKER_CONCURRENCY", "10"))
+# Pool size follows worker concurrency so requests never queue on connections they can't get.
+# Connections opened at startup; the rest are opened on demand and then kept (see db_pool.py).
+DB_POOL_MIN_CONN = int(os.getenv("DB_POOL_MIN_CONN", "1"))
+DB_POOL_MAX_CONN = int(os.getenv("DB_POOL_MAX_CONN", str(API_WORKER_CONCURRENCY)))
+DB_POOL_CHECKOUT_TIMEOUT_SECONDS = float(os.getenv("DB_POOL_CHECKOUT_TIMEOUT_SECONDS", "10"))
+# Connections idle longer than this are validated with SELECT 1 before reuse
+DB_POOL_VALIDATE_IDLE_SECONDS = float(os.getenv("DB_POOL_VALIDATE_IDLE_SECONDS", "30"))
+
 # --- GCS Model Configuration (for App Engine deployment) ---
 GCS_MODEL_BUCKET = os.getenv("GCS_MODEL_BUCKET") # e.g., "ml-modelo"
 GCS_MODEL_BLOB_NAME = os.getenv("GCS_MODEL_BLOB_NAME") # e.g., "shl_model_h100.zip"
@@ -57,12 +83,20 @@ CORPUS_FILE = project_root / "processed_shl_chunks.jsonl"
 # --- Device Preference for Model Loading ---
 DEVICE_PREFERENCE = "cuda" # Try "cuda", then "mps", fallback to "cpu"
 
+# --- Startup Mode ---
+# "eager": load the model and DB pool inside the API lifespan hook before serving (default, local dev).
+# "background": start serving immediately and load in a background thread; /_ah/ready returns 503
+# until loading finishes. Also keeps configuration validation quiet on success.
+STARTUP_MODE = os.getenv("STARTUP_MODE", "eager").lower()
+
 # --- Validation ---
-def validate_config():
-    """Checks if essential configuration variables are set."""
+def validate_config(verbose: bool = True):
+    """
+    Checks if essential configuration variables are set.
+    Errors and warnings are always printed; the success summary only when verbose.
+    """
     essential_vars = {
         "MODEL_PATH": MODEL_PATH,
-        "GEMINI_API_KEY": GEMINI_API_KEY,
         "DB_NAME": DB_NAME,
         "DB_USER": DB_USER,
         # DB_PASSWORD is read from secret file in retriever.py for Cloud Run
@@ -89,7 +123,20 @@ def validate_config():
          print(f"Warning: Model path does not exist: {MODEL_PATH}")
          # Don't add to missing if it's just a warning for now, retriever will handle loading error
 
-    if GEMINI_API_KEY is None:
+    if EMBEDDING_BACKEND not in ("torch", "onnx"):
+         print(f"Warning: Unknown EMBEDDING_BACKEND '{EMBEDDING_BACKEND}'. Expected 'torch' or 'onnx'.")
+         missing.append("EMBEDDING_BACKEND")
+    elif EMBEDDING_BACKEND == "onnx" and not (ONNX_MODEL_DIR / ONNX_MODEL_FILE).exists():
+         print(f"Warning: ONNX backend selected but {ONNX_MODEL_DIR / ONNX_MODEL_FILE} does not exist. Run export_onnx_model.py first.")
+
+    if LLM_BACKEND not in ("gemini", "fake"):
+         print(f"Warning: Unknown LLM_BACKEND '{LLM_BACKEND}'. Expected 'gemini' or 'fake'.")
+         missing.append("LLM_BACKEND")
+    elif LLM_BACKEND == "fake":
+         print("Warning: LLM_BACKEND is 'fake'. Recommendations are generated locally from retrieved metadata, not by Gemini.")
+
+    # The key is only needed when the Gemini backend is used
+    if GEMINI_API_KEY is None and LLM_BACKEND == "gemini":
         print("Warning: GEMINI_API_KEY is not set in environment variables.")
         # Add to missing if critical
         if "GEMINI_API_KEY" not in missing: missing.append("GEMINI_API_KEY")
@@ -119,9 +166,13 @@ def validate_config():
         print(f"Current working directory: {os.getcwd()}")
         print("----------------------------\n")
         return False
+    elif not verbose:
+        return True
     else:
         print("\n--- Configuration Loaded Successfully ---")
         print(f"Model Path: {MODEL_PATH}")
+        print(f"Embedding Backend: {EMBEDDING_BACKEND}")
+        print(f"LLM Backend: {LLM_BACKEND}")
         print(f"Gemini Model: {GEMINI_MODEL_NAME}")
         if is_cloud_run:
             print(f"DB Connection: Via Unix Socket (Instance: {CLOUD_SQL_INSTANCE_CONNECTION_NAME})")
@@ -131,11 +182,12 @@ def validate_config():
         print(f"DB User: {DB_USER}")
         print(f"DB Table: {DB_TABLE_NAME}")
         print(f"Device Preference: {DEVICE_PREFERENCE}")
+        print(f"Startup Mode: {STARTUP_MODE}")
         print("---------------------------------------\n")
         return True
 
 # Run validation when the module is imported
-IS_CONFIG_VALID = validate_config()
+IS_CONFIG_VALID = validate_config(verbose=STARTUP_MODE != "background")
 
 if __name__ == "__main__":
     # Example of how to access config variables
@@ -0,0 +1,188 @@
+import logging
+import threading
+import time
+from collections import deque
+from typing import Dict, Optional
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
+from pgvector.psycopg2 import register_vector
+
+log = logging.getLogger(__name__)
+
+class PooledConnection(psycopg2.extensions.connection):
+    """psycopg2 connection that remembers per-connection setup done by the pool."""
+    vector_registered = False # register_vector() runs a catalog query; do it once per connection
+    last_used = 0.0 # time.monotonic() of the last release, used for stale checks
+    prepared_statements = frozenset() # Names PREPAREd on this session (replaced by a set on first use)
+
+class VectorConnectionPool:
+    """
+    Thread-safe PostgreSQL pool for the API.
+
+    Keeps its own stack of idle connections (psycopg2's ThreadedConnectionPool closes
+    every connection returned beyond `minconn`, which would redo register_vector and the
+    PREPAREd similarity statement for every concurrent request past the first), with:
+    - blocking checkout (waits up to `checkout_timeout` for a free slot instead
+      of raising PoolError immediately when all connections are in use),
+    - connections kept open once created (only `minconn` are opened eagerly; up to
+      `maxconn` are opened on demand and retained, never trimmed on release),
+    - one-time pgvector type registration per physical connection,
+    - validation of connections that are closed, left in a failed
+      transaction, or idle longer than `validate_idle_seconds` (SELECT 1),
+    - wait-time and usage counters exposed through stats().
+    """
+
+    def __init__(self, minconn: int, maxconn: int, checkout_timeout: float = 10.0,
+                 validate_idle_seconds: float = 30.0, **connect_kwargs):
+        if maxconn < 1 or minconn < 0 or minconn > maxconn:
+            raise ValueError(f"Invalid pool size: minconn={minconn}, maxconn={maxconn}")
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.checkout_timeout = checkout_timeout
+        self.validate_idle_seconds = validate_idle_seconds
+        self._connect_kwargs = connect_kwargs
+        # Idle connections, most recently used last (LIFO keeps the warm ones busy)
+        self._idle = deque()
+        self._idle_lock = threading.Lock()
+        self._closed = False
+        # One slot per connection; getconn() blocks on this rather than failing when exhausted.
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            "checkouts": 0,
+            "checkout_timeouts": 0,
+            "stale_discarded": 0,
+            "in_use": 0,
+            "wait_seconds_total": 0.0,
+            "wait_seconds_max": 0.0,
+        }
+        try:
+            for _ in range(minconn):
+                self._idle.append(self._connect())
+        except Exception:
+            self.closeall()
+            raise
+
+    # --- Checkout / Release ---
+    def getconn(self) -> PooledConnection:
+        """Checks out a validated connection with pgvector registered. Raises PoolError on timeout."""
+        wait_start = time.perf_counter()
+        if not self._slots.acquire(timeout=self.checkout_timeout):
+            with self._stats_lock:
+                self._stats["checkout_timeouts"] += 1
+            raise psycopg2.pool.PoolError(
+                f"Timed out after {self.checkout_timeout}s waiting for a DB connection ({self.maxconn} in use)."
+            )
+        try:
+            conn = self._checkout_valid_connection()
+        except Exception:
+            self._slots.release()
+            raise
+        wait_seconds = time.perf_counter() - wait_start
+        with self._stats_lock:
+            self._stats["checkouts"] += 1
+            self._stats["in_use"] += 1
+            self._stats["wait_seconds_total"] += wait_seconds
+            self._stats["wait_seconds_max"] = max(self._stats["wait_seconds_max"], wait_seconds)
+        return conn
+
+    def putconn(self, conn: PooledConnection):
+        """Returns a connection to the pool, discarding it if it is closed or unusable."""
+        try:
+            discard = bool(conn.closed)
+            if not discard and conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback() # Don't hand the next request an open or failed transaction
+                except psycopg2.Error:
+                    discard = True
+            conn.last_used = time.monotonic()
+            self._release(conn, close=discard)
+        finally:
+            with self._stats_lock:
+                self._stats["in_use"] -= 1
+            self._slots.release()
+
+    def closeall(self):
+        """Closes every idle connection; connections still checked out are closed when returned."""
+        with self._idle_lock:
+            self._closed = True
+            idle, self._idle = list(self._idle), deque()
+        for conn in idle:
+            conn.close()
+
+    # --- Idle Stack ---
+    def _connect(self) -> PooledConnection:
+        return psycopg2.connect(connection_factory=PooledConnection, **self._connect_kwargs)
+
+    def _acquire(self) -> PooledConnection:
+        """Pops the most recently returned idle connection, or opens a new one (the caller holds a slot)."""
+        with self._idle_lock:
+            if self._closed:
+                raise psycopg2.pool.PoolError("Connection pool is closed.")
+            conn = self._idle.pop() if self._idle else None
+        return conn if conn is not None else self._connect()
+
+    def _release(self, conn: PooledConnection, close: bool = False):
+        """Keeps the connection idle for reuse, or closes it if asked to or the pool is closed."""
+        with self._idle_lock:
+            if not close and not self._closed:
+                self._idle.append(conn)
+                return
+        if not conn.closed:
+            conn.close()
+
+    # --- Validation ---
+    def _checkout_valid_connection(self) -> PooledConnection:
+        """Gets an idle (or new) connection, replacing stale ones (at most maxconn + 1 tries)."""
+        last_error: Optional[Exception] = None
+        for _ in range(self.maxconn + 1):
+            conn = self._acquire()
+            if self._is_usable(conn):
+                if not conn.vector_registered:
+                    try:
+                        register_vector(conn)
+                        conn.commit() # register_vector's catalog query opens a transaction
+                    except Exception:
+                        self._release(conn, close=True)
+                        raise
+                    conn.vector_registered = True
+                return conn
+            with self._stats_lock:
+                self._stats["stale_discarded"] += 1
+            self._release(conn, close=True)
+            last_error = psycopg2.OperationalError("Discarded stale pooled connection.")
+        raise last_error or psycopg2.OperationalError("Could not obtain a usable DB connection.")
+
+    def _is_usable(self, conn: PooledConnection) -> bool:
+        """Cheap checks first; SELECT 1 only for connections idle longer than validate_idle_seconds."""
+        if conn.closed:
+            return False
+        if conn.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+            return False
+        if not conn.last_used:
+            return True # Freshly opened by the pool, never handed out yet
+        idle_seconds = time.monotonic() - conn.last_used
+        if idle_seconds < self.validate_idle_seconds:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1;")
+                cur.fetchone()
+            conn.rollback()
+            return True
+        except psycopg2.Error as e:
+            log.warning(f"Pooled connection failed validation after {idle_seconds:.0f}s idle: {e}")
+            return False
+
+    # --- Metrics ---
+    def stats(self) -> Dict[str, float]:
+        """Snapshot of pool counters (checkouts, timeouts, discarded, in use, wait times)."""
+        with self._stats_lock:
+            snapshot = dict(self._stats)
+        snapshot["max_size"] = self.maxconn
+        snapshot["wait_seconds_avg"] = (
+            snapshot["wait_seconds_total"] / snapshot["checkouts"] if snapshot["checkouts"] else 0.0
+        )
+        return snapshot
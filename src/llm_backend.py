@@ -0,0 +1,251 @@
+import json
+import logging
+import random
+import threading
+import time
+from typing import Dict, List, Optional
+
+import google.generativeai as genai
+import google.generativeai.types as genai_types # For function calling types
+
+from . import config
+from . import metrics
+from . import prompt_templates
+from . import web_utils
+
+log = logging.getLogger(__name__)
+
+class LLMBackendError(Exception):
+    """Raised by a backend when the LLM call fails (used for injected failures by the fake backend)."""
+
+class LLMBackend:
+    """
+    What rag_pipeline needs from an LLM:
+
+    - extract_url_text: turn a job posting URL into text to embed (None to fall back to the URL itself)
+    - generate_recommendations: answer the recommendation prompt with the raw JSON text
+    """
+    name = "base"
+
+    def _record_usage(self, response):
+        """Counts tokens from a Gemini-style response's usage_metadata, when present."""
+        usage = getattr(response, "usage_metadata", None)
+        if usage is not None:
+            metrics.record_llm_tokens(self.name, getattr(usage, "prompt_token_count", 0), getattr(usage, "candidates_token_count", 0))
+
+    def extract_url_text(self, url: str) -> Optional[str]:
+        raise NotImplementedError
+
+    def generate_recommendations(self, prompt: str, retrieved_chunks: List[Dict]) -> Optional[str]:
+        raise NotImplementedError
+
+# --- Gemini ---
+# Function tool Gemini calls to fetch the URL's text
+extract_text_tool = genai_types.Tool(
+    function_declarations=[
+        genai_types.FunctionDeclaration(
+            name='extract_text_from_url',
+            description='Fetches the main text content from a given web URL.',
+            # Define parameters using OpenAPI schema format (dictionary)
+            parameters={
+                'type': 'object', # Use lowercase 'object'
+                'properties': {
+                    'url': {
+                        'type': 'string', # Use lowercase 'string'
+                        'description': "The URL to fetch content from."
+                    }
+                },
+                'required': ['url']
+            }
+        )
+    ]
+)
+
+# Configure safety settings to be less restrictive if needed,
+# but be mindful of API policies. Start with defaults.
+SAFETY_SETTINGS = [
+    {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
+    {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
+    {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
+    {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
+]
+
+class GeminiBackend(LLMBackend):
+    """Google Gemini via google-generativeai. The client is configured and the models built once."""
+    name = "gemini"
+
+    def __init__(self, model_name: str = config.GEMINI_MODEL_NAME):
+        if not config.GEMINI_API_KEY:
+            log.error("GEMINI_API_KEY not found in configuration. Cannot configure Gemini.")
+            raise ValueError("Missing GEMINI_API_KEY")
+        genai.configure(api_key=config.GEMINI_API_KEY)
+        # Adjust temperature for creativity vs. factuality (lower is more factual)
+        self.tool_model = genai.GenerativeModel(
+            model_name,
+            safety_settings=SAFETY_SETTINGS,
+            generation_config=genai.types.GenerationConfig(temperature=0.1),
+        )
+        # JSON output is requested only for the final recommendation step
+        self.json_model = genai.GenerativeModel(
+            model_name,
+            safety_settings=SAFETY_SETTINGS,
+            generation_config=genai.types.GenerationConfig(response_mime_type="application/json", temperature=0.1),
+        )
+        log.info(f"Gemini backend initialized with model '{model_name}'.")
+
+    def extract_url_text(self, url: str) -> Optional[str]:
+        # First call: Ask Gemini to use the tool
+        log.info("Asking Gemini to call URL extraction tool...")
+        first_response = self.tool_model.generate_content(
+            f"Please extract the main text content from this URL: {url}",
+            tools=[extract_text_tool]
+        )
+        self._record_usage(first_response)
+
+        # Check if Gemini wants to call the function
+        parts = first_response.candidates[0].content.parts
+        if not parts or not parts[0].function_call:
+            log.error("Gemini did not return a function call as expected.")
+            return None
+        function_call = parts[0].function_call
+        if function_call.name != "extract_text_from_url":
+            log.error(f"Gemini called unexpected function: {function_call.name}")
+            return None
+
+        url_to_fetch = function_call.args['url']
+        log.info(f"Gemini requested extraction for URL: {url_to_fetch}")
+        # Execute the actual Python function
+        extracted_content = web_utils.extract_text_from_url(url_to_fetch)
+
+        # Second call: Send the function result back to Gemini (history + function result)
+        log.info("Sending extracted content back to Gemini...")
+        function_response_part = genai_types.Part(
+            function_response=genai_types.FunctionResponse(
+                name='extract_text_from_url',
+                response={'content': extracted_content} # Send result back as dict
+            )
+        )
+        second_response = self.tool_model.generate_content([first_response.candidates[0].content, function_response_part])
+        self._record_usage(second_response)
+        if not hasattr(second_response, 'text'):
+            log.error("Could not get final text from Gemini after function call.")
+            return None
+        processed_text = second_response.text
+        # Check if the extraction failed (our function returns "Error: ...")
+        if processed_text.startswith("Error:"):
+            log.error(f"URL extraction failed: {processed_text}")
+            return None
+        log.info("Received processed text from Gemini after function call.")
+        return processed_text
+
+    def generate_recommendations(self, prompt: str, retrieved_chunks: List[Dict]) -> Optional[str]:
+        final_response = self.json_model.generate_content(prompt) # No tools needed here
+        self._record_usage(final_response)
+        # Accessing the text content
+        if hasattr(final_response, 'text'):
+            return final_response.text
+        try:
+            return final_response.parts[0].text
+        except (AttributeError, IndexError, TypeError) as e:
+            log.error(f"Could not extract text from Gemini final response object: {final_response}. Error: {e}")
+            try:
+                log.warning(f"Gemini final generation safety feedback: {final_response.prompt_feedback}")
+            except AttributeError:
+                pass
+            return None
+
+# --- Fake (offline) ---
+def _yes_no(value) -> Optional[str]:
+    """Maps ingest metadata flags (booleans from chunk_data, or "Yes"/"No" strings) to the prompt's "Yes"/"No"."""
+    if isinstance(value, bool):
+        return "Yes" if value else "No"
+    if isinstance(value, str) and value.strip().lower() in ("yes", "no"):
+        return value.strip().capitalize()
+    return None
+
+class FakeLLMBackend(LLMBackend):
+    """
+    Offline stand-in for load tests and CI. Answers with the distinct solutions of the
+    retrieved chunks, in rank order, as the JSON the recommendation prompt asks for,
+    so the output depends only on retrieval. Sleeps FAKE_LLM_LATENCY_MS (+/- jitter) per
+    call and fails a FAKE_LLM_ERROR_RATE fraction of calls with LLMBackendError.
+    URLs are not fetched; the pipeline falls back to embedding the URL string.
+    """
+    name = "fake"
+
+    def __init__(self,
+                 latency_ms: float = config.FAKE_LLM_LATENCY_MS,
+                 jitter_ms: float = config.FAKE_LLM_LATENCY_JITTER_MS,
+                 error_rate: float = config.FAKE_LLM_ERROR_RATE,
+                 seed: int = config.FAKE_LLM_SEED):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self._rng = random.Random(seed) # Seeded so a run's latency/error sequence is reproducible
+        self._rng_lock = threading.Lock()
+        log.info(f"Fake LLM backend initialized (latency {latency_ms:.0f}±{jitter_ms:.0f} ms, error rate {error_rate:.1%}).")
+
+    def _simulate_call(self):
+        with self._rng_lock:
+            delay_ms = max(0.0, self.latency_ms + self._rng.uniform(-self.jitter_ms, self.jitter_ms))
+            fail = self._rng.random() < self.error_rate
+        if delay_ms:
+            time.sleep(delay_ms / 1000)
+        if fail:
+            raise LLMBackendError("Injected fake LLM failure")
+
+    def extract_url_text(self, url: str) -> Optional[str]:
+        self._simulate_call()
+        return None
+
+    def generate_recommendations(self, prompt: str, retrieved_chunks: List[Dict]) -> Optional[str]:
+        self._simulate_call()
+        recommendations = []
+        seen = set()
+        for chunk in retrieved_chunks:
+            metadata = chunk.get("metadata") or {}
+            name = metadata.get("solution_name")
+            if not name or name in seen:
+                continue
+            seen.add(name)
+            recommendations.append({
+                "url": metadata.get("url") or metadata.get("detail_url", ""),
+                "adaptive_support": _yes_no(metadata.get("adaptive_support", metadata.get("adaptive_irt"))),
+                "description": metadata.get("description") or chunk.get("chunk_text", "")[:200],
+                "duration": metadata.get("duration") or metadata.get("assessment_length"),
+                "remote_support": _yes_no(metadata.get("remote_support", metadata.get("remote_testing"))),
+                "test_type": metadata.get("test_type", []),
+            })
+            if len(recommendations) >= prompt_templates.MAX_RECOMMENDATIONS:
+                break
+        response_text = json.dumps({"recommended_assessments": recommendations})
+        # ~4 characters per token, so token counters move under load tests too
+        metrics.record_llm_tokens(self.name, len(prompt) // 4, len(response_text) // 4)
+        return response_text
+
+# --- Backend Selection ---
+BACKENDS = {
+    GeminiBackend.name: GeminiBackend,
+    FakeLLMBackend.name: FakeLLMBackend,
+}
+
+_backend: Optional[LLMBackend] = None
+_backend_lock = threading.Lock()
+
+def get_llm_backend() -> LLMBackend:
+    """Returns the process-wide backend selected by config.LLM_BACKEND, creating it on first use."""
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                backend_class = BACKENDS.get(config.LLM_BACKEND)
+                if backend_class is None:
+                    raise ValueError(f"Unknown LLM_BACKEND '{config.LLM_BACKEND}'. Expected one of: {', '.join(BACKENDS)}")
+                _backend = backend_class()
+    return _backend
+
+def set_llm_backend(backend: Optional[LLMBackend]):
+    """Replaces the process-wide backend (e.g. a FakeLLMBackend with custom latency). None resets to config."""
+    global _backend
+    with _backend_lock:
+        _backend = backend
@@ -0,0 +1,109 @@
+import logging
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, Optional
+
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Histogram, REGISTRY, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+log = logging.getLogger(__name__)
+
+# Seconds; spans sub-10ms encodes/searches up to multi-second LLM calls
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 0.75, 1.0, 1.5, 2.5, 5.0, 7.5, 10.0, 20.0, 30.0, 60.0)
+
+# --- Metrics ---
+REQUEST_DURATION = Histogram(
+    "shl_request_duration_seconds", "End-to-end HTTP request latency.",
+    ["endpoint", "status"], buckets=LATENCY_BUCKETS,
+)
+STAGE_DURATION = Histogram(
+    "shl_pipeline_stage_duration_seconds",
+    "Latency of each RAG pipeline stage (url_fetch, embed, search, prompt, llm, parse).",
+    ["stage"], buckets=LATENCY_BUCKETS,
+)
+CHUNK_STORE_LOOKUPS = Counter(
+    "shl_chunk_store_lookups", "Retrieved chunks hydrated from the in-process chunk store (hit) or fetched from the DB (miss).",
+    ["result"],
+)
+LLM_TOKENS = Counter(
+    "shl_llm_tokens", "LLM tokens used, as reported by the backend (estimated by the fake backend).",
+    ["backend", "kind"],
+)
+FALLBACKS = Counter(
+    "shl_pipeline_fallbacks", "Degraded paths taken instead of failing (e.g. embedding the URL when extraction fails).",
+    ["kind"],
+)
+ERRORS = Counter(
+    "shl_pipeline_errors", "RAG pipeline failures by stage.",
+    ["stage"],
+)
+
+# --- Spans ---
+@contextmanager
+def span(stage: str, timings: Optional[Dict[str, float]] = None) -> Iterator[None]:
+    """
+    Times a pipeline stage into STAGE_DURATION. If `timings` is given, the duration
+    (milliseconds) is also stored under `stage` for the request's structured timing log.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_DURATION.labels(stage=stage).observe(elapsed)
+        if timings is not None:
+            timings[stage] = round(timings.get(stage, 0.0) + elapsed * 1000, 2)
+
+def record_llm_tokens(backend: str, prompt_tokens: Optional[int], completion_tokens: Optional[int]):
+    if prompt_tokens:
+        LLM_TOKENS.labels(backend=backend, kind="prompt").inc(prompt_tokens)
+    if completion_tokens:
+        LLM_TOKENS.labels(backend=backend, kind="completion").inc(completion_tokens)
+
+# --- DB Pool Gauges ---
+class PoolStatsCollector:
+    """Exposes VectorConnectionPool.stats() at scrape time (no bookkeeping on the request path)."""
+
+    COUNTERS = {
+        "checkouts": "Connections checked out of the pool.",
+        "checkout_timeouts": "Checkouts that timed out waiting for a free connection.",
+        "stale_discarded": "Idle connections discarded after failing validation.",
+        "wait_seconds_total": "Total seconds spent waiting for a pooled connection.",
+    }
+    GAUGES = {
+        "in_use": "Connections currently checked out.",
+        "max_size": "Maximum pool size.",
+        "wait_seconds_max": "Longest wait for a pooled connection so far.",
+        "wait_seconds_avg": "Average wait for a pooled connection.",
+    }
+
+    def __init__(self, get_stats: Callable[[], Dict[str, float]]):
+        self.get_stats = get_stats
+
+    def collect(self):
+        try:
+            stats = self.get_stats()
+        except Exception as e:
+            log.warning(f"Could not read DB pool stats for metrics: {e}")
+            return
+        for key, description in self.COUNTERS.items():
+            if key in stats:
+                metric = CounterMetricFamily(f"shl_db_pool_{key}", description)
+                metric.add_metric([], stats[key])
+                yield metric
+        for key, description in self.GAUGES.items():
+            if key in stats:
+                yield GaugeMetricFamily(f"shl_db_pool_{key}", description, value=stats[key])
+
+_pool_collector_registered = False
+
+def register_pool_collector(get_stats: Callable[[], Dict[str, float]]):
+    """Registers the pool collector once (the API module may be imported more than once under --reload)."""
+    global _pool_collector_registered
+    if not _pool_collector_registered:
+        REGISTRY.register(PoolStatsCollector(get_stats))
+        _pool_collector_registered = True
+
+def render_latest() -> bytes:
+    """Prometheus text exposition of every registered metric."""
+    return generate_latest(REGISTRY)
@@ -0,0 +1,166 @@
+import json
+import logging
+import time
+from pathlib import Path
+from typing import List, Optional, Union
+
+import numpy as np
+import onnxruntime as ort
+from tokenizers import Tokenizer
+
+log = logging.getLogger(__name__)
+
+# Pooling modes in the order sentence_transformers.models.Pooling concatenates them
+SUPPORTED_POOLING_MODES = ("cls_token", "max_tokens", "mean_tokens", "mean_sqrt_len_tokens")
+
+class OnnxSentenceEncoder:
+    """
+    CPU query encoder backed by ONNX Runtime.
+
+    Mirrors the subset of the SentenceTransformer interface used by the
+    retriever (encode, get_sentence_embedding_dimension, device) so it can be
+    swapped in without touching callers. Tokenization uses the model's own
+    tokenizer.json, pooling follows 1_Pooling/config.json, and embeddings are
+    L2-normalized when modules.json lists a Normalize module, as the
+    SentenceTransformer pipeline does.
+    """
+
+    def __init__(self, model_dir: Path, onnx_path: Path, intra_op_threads: int = 0):
+        self.model_dir = Path(model_dir)
+        self.onnx_path = Path(onnx_path)
+        self.device = "cpu"
+
+        if not self.onnx_path.exists():
+            raise FileNotFoundError(f"ONNX model not found: {self.onnx_path}")
+
+        # --- Tokenizer (same truncation length as the SentenceTransformer config) ---
+        self.max_seq_length = self._read_max_seq_length()
+        self.tokenizer = Tokenizer.from_file(str(self.model_dir / "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length=self.max_seq_length)
+        pad_id = self.tokenizer.token_to_id("<pad>")
+        self.tokenizer.enable_padding(pad_id=pad_id if pad_id is not None else 1, pad_token="<pad>")
+
+        # --- Pooling / Normalize modules (same post-processing as the SentenceTransformer) ---
+        self.pooling_modes = self._read_pooling_modes()
+        self.normalize = self._has_normalize_module()
+
+        # --- ONNX Runtime session ---
+        session_options = ort.SessionOptions()
+        session_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if intra_op_threads > 0:
+            session_options.intra_op_num_threads = intra_op_threads
+        start_time = time.time()
+        self.session = ort.InferenceSession(
+            str(self.onnx_path),
+            sess_options=session_options,
+            providers=["CPUExecutionProvider"]
+        )
+        self._input_names = {inp.name for inp in self.session.get_inputs()}
+        token_dimension = self.session.get_outputs()[0].shape[-1]
+        self._dimension = token_dimension * len(self.pooling_modes) if isinstance(token_dimension, int) else None
+        log.info(f"ONNX session created from {self.onnx_path.name} in {time.time() - start_time:.2f} seconds "
+                 f"(pooling: {'+'.join(self.pooling_modes)}, normalize: {self.normalize}).")
+
+    def _read_max_seq_length(self) -> int:
+        """Reads max_seq_length from sentence_bert_config.json (defaults to 384)."""
+        config_path = self.model_dir / "sentence_bert_config.json"
+        try:
+            with config_path.open('r', encoding='utf-8') as f:
+                return int(json.load(f).get("max_seq_length", 384))
+        except (FileNotFoundError, json.JSONDecodeError, TypeError, ValueError):
+            log.warning(f"Could not read max_seq_length from {config_path}. Using 384.")
+            return 384
+
+    def _read_modules(self) -> List[dict]:
+        """Reads modules.json (empty list if missing or unreadable)."""
+        modules_path = self.model_dir / "modules.json"
+        try:
+            with modules_path.open('r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError) as e:
+            log.warning(f"Could not read {modules_path} ({e}). Assuming mean pooling without normalization.")
+            return []
+
+    def _read_pooling_modes(self) -> List[str]:
+        """Enabled pooling modes from the Pooling module's config.json (mean pooling if absent)."""
+        pooling_module = next((m for m in self._read_modules() if m.get("type", "").endswith(".Pooling")), None)
+        config_path = self.model_dir / (pooling_module or {}).get("path", "1_Pooling") / "config.json"
+        try:
+            with config_path.open('r', encoding='utf-8') as f:
+                pooling_config = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            log.warning(f"Could not read pooling config from {config_path}. Using mean pooling.")
+            return ["mean_tokens"]
+        enabled = [key[len("pooling_mode_"):] for key, value in pooling_config.items() if key.startswith("pooling_mode_") and value]
+        unsupported = [mode for mode in enabled if mode not in SUPPORTED_POOLING_MODES]
+        if unsupported:
+            raise ValueError(f"Unsupported pooling mode(s) in {config_path}: {', '.join(unsupported)}")
+        if not enabled:
+            raise ValueError(f"No pooling mode enabled in {config_path}")
+        return [mode for mode in SUPPORTED_POOLING_MODES if mode in enabled]
+
+    def _has_normalize_module(self) -> bool:
+        return any(m.get("type", "").endswith(".Normalize") for m in self._read_modules())
+
+    def _pool(self, token_embeddings: np.ndarray, attention_mask: np.ndarray) -> np.ndarray:
+        """Applies the configured pooling modes over non-padding tokens, concatenated like Pooling does."""
+        mask = attention_mask[..., np.newaxis].astype(np.float32)
+        counts = np.clip(mask.sum(axis=1), 1e-9, None)
+        pooled = []
+        for mode in self.pooling_modes:
+            if mode == "cls_token":
+                pooled.append(token_embeddings[:, 0])
+            elif mode == "max_tokens":
+                pooled.append(np.where(mask > 0, token_embeddings, -1e9).max(axis=1))
+            elif mode == "mean_tokens":
+                pooled.append((token_embeddings * mask).sum(axis=1) / counts)
+            else: # mean_sqrt_len_tokens
+                pooled.append((token_embeddings * mask).sum(axis=1) / np.sqrt(counts))
+        return pooled[0] if len(pooled) == 1 else np.concatenate(pooled, axis=1)
+
+    def get_sentence_embedding_dimension(self) -> Optional[int]:
+        """Returns the embedding dimension reported by the ONNX graph output."""
+        return self._dimension if isinstance(self._dimension, int) else None
+
+    def encode(
+        self,
+        sentences: Union[str, List[str]],
+        batch_size: int = 32,
+        convert_to_numpy: bool = True,
+        show_progress_bar: bool = False,
+        normalize_embeddings: bool = False,
+        **kwargs
+    ) -> np.ndarray:
+        """
+        Encodes one string or a list of strings into pooled embeddings.
+
+        Returns a 1-D array for a single string and a 2-D array for a list,
+        matching SentenceTransformer.encode. As there, a Normalize module in
+        modules.json normalizes the output regardless of `normalize_embeddings`.
+        `convert_to_numpy` and `show_progress_bar` are accepted for interface
+        compatibility only.
+        """
+        single_input = isinstance(sentences, str)
+        texts = [sentences] if single_input else list(sentences)
+        all_embeddings = []
+
+        for start in range(0, len(texts), batch_size):
+            encodings = self.tokenizer.encode_batch(texts[start : start + batch_size])
+            input_ids = np.asarray([e.ids for e in encodings], dtype=np.int64)
+            attention_mask = np.asarray([e.attention_mask for e in encodings], dtype=np.int64)
+
+            feeds = {"input_ids": input_ids, "attention_mask": attention_mask}
+            feeds = {name: value for name, value in feeds.items() if name in self._input_names}
+            token_embeddings = self.session.run(None, feeds)[0]
+
+            embeddings = self._pool(token_embeddings, attention_mask)
+
+            if normalize_embeddings or self.normalize:
+                norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+                embeddings = embeddings / np.clip(norms, 1e-12, None)
+            all_embeddings.append(embeddings.astype(np.float32))
+
+        if not all_embeddings:
+            return np.zeros((0, self._dimension or 0), dtype=np.float32)
+        result = np.concatenate(all_embeddings, axis=0)
+        return result[0] if single_input else result
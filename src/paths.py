@@ -0,0 +1,11 @@
+from pathlib import Path
+
+# Filesystem locations shared by the API (via config) and the offline data/training scripts.
+# Kept free of side effects: importing config also loads .env and validates API settings,
+# which chunking workers and other offline tools don't need.
+
+# Define project root relative to this file
+project_root = Path(__file__).parent.parent
+
+# Path to the fine-tuned sentence transformer model
+MODEL_PATH = project_root / "shl_finetuned_mpnet_model_H100"
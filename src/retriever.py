@@ -1,9 +1,7 @@
-import torch
-from sentence_transformers import SentenceTransformer
 import psycopg2
 import psycopg2.pool # Explicitly import the pool submodule
 from psycopg2.extras import RealDictCursor # Return results as dictionaries
-from pgvector.psycopg2 import register_vector
+from psycopg2 import sql
 import logging
 import time # Needed for sleep
 import json
@@ -11,19 +9,22 @@ import os # Added for path operations
 import zipfile # Added for unzipping
 import tempfile # Added for temporary directory
 import shutil # Added for cleanup
+import importlib.util # Used to probe optional libraries without importing them
 from pathlib import Path # Added for path manipulation
 from typing import List, Dict, Optional, Tuple
 
 # Import configuration variables
 from . import config
+from .db_pool import VectorConnectionPool
+from .chunk_store import ChunkStore
 
-# Attempt to import GCS library, handle optional import
+# Probe for the GCS library without importing it (the import is slow and GCS loading is optional)
+storage = None
 try:
-    from google.cloud import storage
-    GCS_ENABLED = True
-except ImportError:
-    storage = None
+    GCS_ENABLED = importlib.util.find_spec("google.cloud.storage") is not None
+except ModuleNotFoundError:
     GCS_ENABLED = False
+if not GCS_ENABLED:
     logging.warning("google-cloud-storage library not found. GCS model loading disabled.")
 
 # --- Setup Logging ---
@@ -37,10 +38,38 @@ log = logging.getLogger(__name__)
 # Initialize model and device later in a function to handle potential errors
 model = None
 device = None
-# Initialize model and device later in a function to handle potential errors
-model = None
-device = None
 db_connection_pool = None # Using a pool for potentially concurrent requests in API
+# PREPARE statement for the similarity search, built once from the table name resolved
+# at pool initialization (see resolve_similarity_statement).
+SIMILARITY_STATEMENT_NAME = "shl_similarity_search"
+similarity_prepare_sql = None
+# Whether the server accepts plan_cache_mode (PostgreSQL 12+); probed once, see ensure_similarity_statement
+generic_plan_supported = None
+embeddings_table = None # sql.Identifier of the resolved embeddings table
+# Chunk texts and trimmed metadata, loaded once (see load_chunk_store). The similarity
+# query returns only ids and distances; hits are hydrated from here.
+chunk_store = ChunkStore()
+# torch and sentence_transformers are imported on first use (see import_model_libraries)
+# so importing this module stays cheap on Cloud Run cold starts.
+torch = None
+SentenceTransformer = None
+
+# --- Helper Function to Import Heavy ML Libraries ---
+def import_model_libraries():
+    """
+    Imports the libraries needed by the configured embedding backend.
+    Deferred from module import so the API can start serving health checks
+    before torch (several seconds to import) is loaded.
+    """
+    global torch, SentenceTransformer
+    if config.EMBEDDING_BACKEND == "onnx":
+        from . import onnx_encoder # noqa: F401 - imports onnxruntime/tokenizers
+        return
+    if SentenceTransformer is None:
+        import torch as torch_module
+        from sentence_transformers import SentenceTransformer as sentence_transformer_cls
+        torch = torch_module
+        SentenceTransformer = sentence_transformer_cls
 
 # --- Helper Function to Determine Device ---
 def get_device():
@@ -49,6 +78,7 @@ def get_device():
     # Check only once
     if device:
         return device
+    import_model_libraries()
 
     # Auto-detect best available device: CUDA > MPS > CPU
     if torch.cuda.is_available():
@@ -86,10 +116,14 @@ def load_embedding_model():
         log.error(f"Current working directory during load attempt: {os.getcwd()}")
         raise FileNotFoundError(f"Local model directory not found: {model_load_path}")
 
+    # --- Load the ONNX Runtime encoder (CPU, no torch graph) ---
+    if config.EMBEDDING_BACKEND == "onnx":
+        return load_onnx_embedding_model()
+
     # --- Load the SentenceTransformer model ---
     log.info(f"Loading SentenceTransformer model from: {model_load_path}")
     try:
-        current_device = get_device()
+        current_device = get_device() # Also imports torch/sentence_transformers on first use
         model = SentenceTransformer(str(model_load_path), device=current_device.type)
         log.info(f"Model loaded successfully onto {model.device} from {model_load_path}.")
 
@@ -101,6 +135,37 @@ def load_embedding_model():
         return model
     except Exception as e:
         log.error(f"Failed to load SentenceTransformer model from {model_load_path}: {e}", exc_info=True)
+        model = None # Don't leave a half-initialized model behind; readiness checks rely on this
+        raise
+
+def load_onnx_embedding_model():
+    """
+    Loads the quantized ONNX export of the model (see export_onnx_model.py)
+    into an ONNX Runtime session. Used when config.EMBEDDING_BACKEND is "onnx".
+    """
+    global model
+    from .onnx_encoder import OnnxSentenceEncoder # Imported here so the torch backend doesn't need onnxruntime
+
+    onnx_path = config.ONNX_MODEL_DIR / config.ONNX_MODEL_FILE
+    log.info(f"Loading ONNX embedding model from: {onnx_path}")
+    try:
+        model = OnnxSentenceEncoder(
+            config.MODEL_PATH,
+            onnx_path,
+            intra_op_threads=config.ONNX_INTRA_OP_THREADS
+        )
+    except Exception as e:
+        log.error(f"Failed to load ONNX model from {onnx_path}: {e}", exc_info=True)
+        raise
+
+    if model.get_sentence_embedding_dimension() != config.EMBEDDING_DIMENSION:
+        log.error(f"Model dimension mismatch! ONNX model reports {model.get_sentence_embedding_dimension()} but config expects {config.EMBEDDING_DIMENSION}.")
+        model = None
+        raise ValueError("Model dimension mismatch")
+
+    log.info(f"ONNX model loaded successfully (max_seq_length={model.max_seq_length}).")
+    return model
+
 def init_connection_pool(max_retries=5, delay_seconds=2):
     """Initializes the PostgreSQL connection pool with retries, connecting via Unix socket."""
     global db_connection_pool
@@ -134,9 +199,12 @@ def init_connection_pool(max_retries=5, delay_seconds=2):
     for attempt in range(max_retries):
         log.info(f"Attempt {attempt + 1} of {max_retries} to initialize connection pool...")
         try:
-            pool = psycopg2.pool.SimpleConnectionPool(
-                minconn=1,
-                maxconn=10, # Adjust max connections based on expected load
+            # Thread-safe pool sized from worker concurrency (see config.DB_POOL_*)
+            pool = VectorConnectionPool(
+                minconn=config.DB_POOL_MIN_CONN,
+                maxconn=config.DB_POOL_MAX_CONN,
+                checkout_timeout=config.DB_POOL_CHECKOUT_TIMEOUT_SECONDS,
+                validate_idle_seconds=config.DB_POOL_VALIDATE_IDLE_SECONDS,
                 dbname=config.DB_NAME,
                 user=config.DB_USER,
                 password=db_password,
@@ -144,12 +212,15 @@ def init_connection_pool(max_retries=5, delay_seconds=2):
                 # port is omitted when using Unix socket
                 connect_timeout=5 # Add a connection timeout
             )
-            # Test connection and register vector type
+            # Test connection (the pool registers the vector type on first checkout)
+            # and resolve the embeddings table once for the prepared similarity query
             conn = pool.getconn()
-            register_vector(conn)
-            pool.putconn(conn) # Put it back immediately after test
+            try:
+                resolve_similarity_statement(conn)
+            finally:
+                pool.putconn(conn) # Put it back immediately after test
 
-            log.info("Connection pool initialized and pgvector registered successfully.")
+            log.info(f"Connection pool initialized (min={config.DB_POOL_MIN_CONN}, max={config.DB_POOL_MAX_CONN}) and pgvector registered successfully.")
             db_connection_pool = pool # Assign to global pool only on success
             return db_connection_pool
         except psycopg2.OperationalError as e:
@@ -174,10 +245,8 @@ def get_db_connection():
     if not db_connection_pool:
         init_connection_pool() # Initialize if not already done
     try:
-        conn = db_connection_pool.getconn()
-        # Ensure vector is registered for this connection (might be redundant but safe)
-        register_vector(conn)
-        return conn
+        # The pool validates stale connections and registers pgvector once per connection
+        return db_connection_pool.getconn()
     except Exception as e:
         log.error(f"Failed to get connection from pool: {e}", exc_info=True)
         raise
@@ -211,8 +280,82 @@ def generate_embedding(text: str) -> Optional[List[float]]:
         log.error(f"Error generating embedding for text '{text[:50]}...': {e}", exc_info=True)
         return None
 
+def resolve_similarity_statement(conn):
+    """
+    Resolves config.DB_TABLE_NAME to an existing relation and builds the
+    PREPARE statement for the similarity search. Called once at pool init so
+    each request only sends EXECUTE with its parameters.
+    """
+    global similarity_prepare_sql, embeddings_table
+    with conn.cursor() as cur:
+        cur.execute("SELECT to_regclass(%s)::text;", (config.DB_TABLE_NAME,))
+        resolved_table = cur.fetchone()[0]
+    conn.rollback()
+    if resolved_table is None:
+        raise ValueError(f"Embeddings table '{config.DB_TABLE_NAME}' does not exist. Run create_store_embeddings.py first.")
+
+    embeddings_table = sql.Identifier(*resolved_table.split(".")) # to_regclass may schema-qualify the name
+    # Use the <=> operator for cosine distance (lower is better).
+    # Phase 1 of retrieval: only ids and distances come back from the index scan.
+    similarity_prepare_sql = sql.SQL("""
+        PREPARE {name} (vector, integer) AS
+        SELECT
+            chunk_id,
+            embedding <=> $1 AS distance
+        FROM {table}
+        ORDER BY distance ASC
+        LIMIT $2;
+    """).format(
+        name=sql.Identifier(SIMILARITY_STATEMENT_NAME),
+        table=embeddings_table
+    ).as_string(conn)
+    log.info(f"Similarity query will be prepared against table {resolved_table}.")
+
+def ensure_similarity_statement(conn):
+    """PREPAREs the similarity query on this connection if it hasn't been already."""
+    if SIMILARITY_STATEMENT_NAME in conn.prepared_statements:
+        return
+    if similarity_prepare_sql is None:
+        resolve_similarity_statement(conn)
+    global generic_plan_supported
+    with conn.cursor() as cur:
+        if generic_plan_supported is None:
+            try:
+                cur.execute("SET LOCAL plan_cache_mode = force_generic_plan;")
+                generic_plan_supported = True
+            except psycopg2.Error as e: # plan_cache_mode needs PostgreSQL 12+
+                generic_plan_supported = False
+                log.warning(f"Could not force a generic plan for the similarity query: {e}")
+            conn.rollback()
+        cur.execute(similarity_prepare_sql)
+    conn.commit()
+    conn.prepared_statements = set(conn.prepared_statements) | {SIMILARITY_STATEMENT_NAME}
+
+def format_vector_literal(embedding: List[float]) -> str:
+    """
+    Formats an embedding as a pgvector text literal with float32 precision.
+    Python's repr of float32 values uses ~20 characters; 9 significant digits
+    round-trip float32 exactly and cut the bytes sent per query by ~40%.
+    """
+    return "[" + ",".join(f"{value:.9g}" for value in embedding) + "]"
+
+def load_chunk_store() -> int:
+    """Loads all chunk texts and trimmed metadata into the in-process chunk store."""
+    conn = get_db_connection()
+    try:
+        if embeddings_table is None:
+            resolve_similarity_statement(conn)
+        return chunk_store.load_from_db(conn, embeddings_table)
+    finally:
+        release_db_connection(conn)
+
 def search_similar_chunks(query_embedding: List[float], top_k: int = config.TOP_K_RETRIEVAL) -> List[Dict]:
-    """Searches the database for chunks most similar to the query embedding."""
+    """
+    Searches the database for chunks most similar to the query embedding.
+    Two phases: the prepared index query returns (chunk_id, distance) only,
+    then the selected chunks are hydrated from the in-process chunk store
+    (fetching any it doesn't have yet in a single query).
+    """
     if not query_embedding:
         log.warning("search_similar_chunks received empty query embedding.")
         return []
@@ -220,36 +363,22 @@ def search_similar_chunks(query_embedding: List[float], top_k: int = config.TOP_
     conn = None
     try:
         conn = get_db_connection()
+        ensure_similarity_statement(conn)
         # Use RealDictCursor to get results as dictionaries
         with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            # Use the <=> operator for cosine distance (lower is better)
-            # Ensure the embedding column name and table name match config/creation script
-            query = f"""
-                SELECT
-                    chunk_id,
-                    chunk_text,
-                    metadata,
-                    embedding <=> %s::vector AS distance
-                FROM {config.DB_TABLE_NAME}
-                ORDER BY distance ASC
-                LIMIT %s;
-            """
-            # pgvector expects the embedding as a string representation of a list/numpy array
-            # or directly as a numpy array if the adapter handles it.
-            # Let's pass the list directly, psycopg2/pgvector should handle it.
-            cur.execute(query, (query_embedding, top_k))
-            results = cur.fetchall()
-            log.info(f"Retrieved {len(results)} chunks from DB for similarity search.")
-            # Convert metadata from JSON string back to dict if needed (depends on how it's stored/retrieved)
-            # RealDictCursor often handles JSONB correctly
-            # for res in results:
-            #     if isinstance(res.get('metadata'), str):
-            #         try:
-            #             res['metadata'] = json.loads(res['metadata'])
-            #         except json.JSONDecodeError:
-            #             log.warning(f"Failed to decode metadata JSON for chunk_id {res.get('chunk_id')}")
-            #             res['metadata'] = {} # Default to empty dict on error
-            return results # List of dictionaries
+            # Only the statement name and parameters go over the wire; the plan is reused.
+            # The query shape never changes, so use the generic plan. SET LOCAL scopes that to
+            # this transaction, leaving other statements on the pooled connection untouched.
+            execute_sql = sql.SQL("EXECUTE {name} (%s, %s);").format(name=sql.Identifier(SIMILARITY_STATEMENT_NAME))
+            if generic_plan_supported:
+                execute_sql = sql.SQL("SET LOCAL plan_cache_mode = force_generic_plan; ") + execute_sql
+            cur.execute(execute_sql, (format_vector_literal(query_embedding), top_k))
+            hits = cur.fetchall()
+        conn.rollback() # End the read transaction before hydration
+        chunk_store.fetch_missing(conn, embeddings_table, [hit["chunk_id"] for hit in hits])
+        results = chunk_store.hydrate(hits)
+        log.info(f"Retrieved {len(results)} chunks from DB for similarity search.")
+        return results # List of dictionaries
     except psycopg2.Error as e:
         log.error(f"Database error during similarity search: {e}")
         # Attempt to rollback if connection is not in autocommit mode (pool connections usually aren't)
@@ -267,6 +396,75 @@ def search_similar_chunks(query_embedding: List[float], top_k: int = config.TOP_
             release_db_connection(conn)
 
 
+# --- Warm-up and Health Checks ---
+# Short and long inputs so the first real request doesn't pay for kernel
+# selection / allocator growth at either end of the sequence length range.
+WARMUP_TEXTS = [
+    "assessment for java developers",
+    "Looking to hire mid-level professionals who are proficient in Python, SQL and Java Script. " * 12,
+]
+
+def is_model_loaded() -> bool:
+    """Returns True if an embedding model (torch or ONNX) is loaded."""
+    return model is not None
+
+def warm_up_model() -> bool:
+    """Runs dummy encodes through the loaded model. Returns True on success."""
+    if not is_model_loaded():
+        log.warning("Cannot warm up: embedding model is not loaded.")
+        return False
+    try:
+        start_time = time.time()
+        for text in WARMUP_TEXTS:
+            model.encode(text, convert_to_numpy=True, show_progress_bar=False, normalize_embeddings=True)
+        log.info(f"Embedding model warmed up in {time.time() - start_time:.2f} seconds.")
+        return True
+    except Exception as e:
+        log.error(f"Embedding model warm-up failed: {e}", exc_info=True)
+        return False
+
+def warm_up_index() -> bool:
+    """
+    Runs a top-1 similarity search with a warm-up embedding. Primes the pooled
+    connection, the query plan and the index pages. Returns True if the
+    embeddings table answered with at least one row.
+    """
+    embedding = generate_embedding(WARMUP_TEXTS[0])
+    if not embedding:
+        return False
+    start_time = time.time()
+    results = search_similar_chunks(embedding, top_k=1)
+    if not results:
+        log.error(f"Warm-up search returned no rows. Is '{config.DB_TABLE_NAME}' populated?")
+        return False
+    log.info(f"Vector index warmed up in {time.time() - start_time:.2f} seconds.")
+    return True
+
+def check_db_health() -> bool:
+    """Checks out a pooled connection and runs SELECT 1. Returns True if the DB answers."""
+    if not db_connection_pool:
+        return False
+    conn = None
+    try:
+        conn = get_db_connection()
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1;")
+            cur.fetchone()
+        conn.rollback() # End the implicit transaction opened by the SELECT
+        return True
+    except Exception as e:
+        log.warning(f"Database health check failed: {e}")
+        return False
+    finally:
+        if conn:
+            release_db_connection(conn)
+
+def get_pool_stats() -> Dict[str, float]:
+    """Returns connection pool counters (checkouts, wait times, in use), or {} if no pool."""
+    if not db_connection_pool:
+        return {}
+    return db_connection_pool.stats()
+
 # --- Cleanup Function ---
 def close_connection_pool():
     """Closes all connections in the pool."""